@@ -0,0 +1,209 @@
+import asyncio
+import time
+from concurrent.futures import Executor, FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
+from itertools import groupby
+from typing import Callable, Dict, Iterable, Iterator, NamedTuple, Optional, Tuple
+
+import engine
+import par2encode
+from constants import DEFAULT_BLOCK_COUNT, DEFAULT_GROUP_MAX_SIZE, DEFAULT_PARITY_FILE_COUNT, DEFAULT_REDUNDANCY, \
+    EntryKind, FileStatus
+from scanner import ScanEntry, bucket_files, scan_tree
+from store import ParityStore
+from throttle import priority_prefix
+from utils import group_index
+from watch import parity_files
+
+
+class FileResult(NamedTuple):
+    """Outcome of one create, verify or repair job. status is None when the job raised, error says what it raised."""
+    operation: str
+    target: str
+    files: Tuple[str, ...]
+    status: Optional[FileStatus]
+    seconds: float
+    error: Optional[str] = None
+
+
+class Settings(NamedTuple):
+    """What a job needs besides its target, plain values only so jobs can be sent to a process pool."""
+    directory: str
+    parity_file_count: int
+    redundancy: int
+    block_count: Optional[int]
+    block_size: Optional[int]
+    native_max_size: Optional[int]  # MiB
+    timeout: Optional[float]
+    fast_verify: bool
+    content_addressed: bool
+    parity_store: Optional[str]
+    priority: Tuple[str, ...]
+
+
+def quiet(message: str):
+    pass
+
+
+def repair_status(result: engine.ChainResult) -> FileStatus:
+    """REPAIRED only for a target that verified OK after its repair, otherwise the status of the last step taken."""
+    if result.reverified == FileStatus.OK:
+        return FileStatus.REPAIRED
+    return result.reverified or result.repaired or result.verified
+
+
+async def job(operation: str, target: str, files: Tuple[str, ...], settings: Settings,
+              report: Callable[[str], None]) -> FileStatus:
+    store = ParityStore(settings.parity_store, settings.directory) if settings.parity_store is not None else None
+    common = dict(timeout=settings.timeout, priority=settings.priority, store=store, report=report)
+    if operation == "create":
+        native = par2encode.NativeEncoder(0, settings.native_max_size * 2 ** 20) \
+            if settings.native_max_size is not None else None
+        create = partial(engine.par2create_group, list(files)) if target.endswith(".par2") \
+            else partial(engine.par2create, target)
+        return await create(settings.parity_file_count, settings.redundancy, settings.block_count,
+                            block_size=settings.block_size, native=native, **common)
+
+    verify = partial(engine.par2verify, in_process=settings.fast_verify, content_addressed=settings.content_addressed,
+                     **common)
+    if operation == "verify":
+        return await verify(target)
+    return repair_status(await engine.verify_chain(target, verify, partial(engine.par2repair, **common)))
+
+
+def run_job(operation: str, target: str, files: Tuple[str, ...], settings: Settings,
+            report: Callable[[str], None]) -> FileResult:
+    """Run one job on an event loop of its own, in whatever thread or process the executor picked."""
+    started = time.perf_counter()
+    try:
+        status = asyncio.run(job(operation, target, files, settings, report))
+    except Exception as e:
+        return FileResult(operation, target, files, None, time.perf_counter() - started, f"{type(e).__name__}: {e}")
+    return FileResult(operation, target, files, status, time.perf_counter() - started)
+
+
+class Par2Tortilla:
+    """What the run command does, as a library. Results come back as lazy iterators of FileResult.
+
+    The tree is walked once and the entries are kept, later operations work from them until scan(refresh=True).
+    Jobs run in the given executor, a thread or process pool the caller may share between instances and with other
+    work, or else in a thread pool of `processes` threads owned by the instance. At most `processes` jobs are handed
+    to the executor at once. Progress messages go to report, which has to be picklable for a process pool.
+    """
+
+    def __init__(self, directory: str, parity_file_count: int = DEFAULT_PARITY_FILE_COUNT,
+                 redundancy: int = DEFAULT_REDUNDANCY, block_count: Optional[int] = DEFAULT_BLOCK_COUNT,
+                 block_size: Optional[int] = None, group: bool = False, group_max_size: int = DEFAULT_GROUP_MAX_SIZE,
+                 native_max_size: Optional[int] = None, timeout: Optional[float] = None, fast_verify: bool = True,
+                 content_addressed: bool = False, parity_store: Optional[str] = None, nice: Optional[int] = None,
+                 ionice: Optional[str] = None, processes: int = 2, executor: Optional[Executor] = None,
+                 report: Callable[[str], None] = quiet):
+        if native_max_size is not None and not par2encode.available():
+            raise RuntimeError("The native encoder needs NumPy.")
+        self.settings = Settings(directory, parity_file_count, redundancy, block_count, block_size, native_max_size,
+                                 timeout, fast_verify, content_addressed, parity_store,
+                                 tuple(priority_prefix(nice, ionice)))
+        self.store = ParityStore(parity_store, directory) if parity_store is not None else None
+        self.group = group
+        self.group_max_size = group_max_size
+        self.processes = processes
+        self.executor = executor
+        self.owned_executor = None
+        self.report = report
+        self.entries: Optional[Dict[str, ScanEntry]] = None
+        self.walking: Optional[Dict[str, ScanEntry]] = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Shut the thread pool down if the instance started one, a caller's executor is left alone."""
+        if self.owned_executor is not None:
+            self.owned_executor.shutdown()
+            self.owned_executor = None
+
+    def scan(self, refresh: bool = False) -> Iterator[ScanEntry]:
+        """Entries of the tree, streamed while it is walked the first time and from memory after that. A walk that
+        was not iterated to its end is not kept."""
+        if self.entries is not None and not refresh:
+            yield from list(self.entries.values())
+            return
+        self.walking = {}
+        for entry in scan_tree(self.settings.directory, self.settings.parity_store):
+            self.walking[entry.path] = entry
+            yield entry
+        self.entries, self.walking = self.walking, None
+
+    def create(self, files: Optional[Iterable[str]] = None) -> Iterator[FileResult]:
+        """Create parity for the files, by default for all files of the scan that have none. The entries of the
+        files that got parity are updated, so a verify afterwards does not walk the tree again."""
+        if files is None:
+            files = (entry.path for entry in self.scan() if entry.kind == EntryKind.DATA_WITHOUT_PARITY)
+        if self.group:
+            max_files = self.settings.block_count or DEFAULT_BLOCK_COUNT
+            buckets = bucket_files(files, self.group_max_size * 2 ** 20, max_files)
+            jobs = ((group_index(bucket), tuple(bucket)) for bucket in buckets)
+        else:
+            jobs = ((file, (file,)) for file in files)
+        for result in self.results("create", jobs):
+            if result.status == FileStatus.CREATED:
+                self.created(result)
+            yield result
+
+    def verify(self, targets: Optional[Iterable[str]] = None) -> Iterator[FileResult]:
+        """Verify the targets, by default every data file of the scan that has parity. A target is a data file or the
+        index of a grouped recovery set."""
+        return self.results("verify", self.targets(targets))
+
+    def repair(self, targets: Optional[Iterable[str]] = None) -> Iterator[FileResult]:
+        """Verify the targets like verify, and repair and verify again those that turn out repairable. See
+        repair_status for what the status of a result means."""
+        return self.results("repair", self.targets(targets))
+
+    def targets(self, targets: Optional[Iterable[str]]) -> Iterator[Tuple[str, Tuple[str, ...]]]:
+        if targets is not None:
+            return ((target, (target,)) for target in targets)
+        entries = (entry for entry in self.scan() if entry.kind == EntryKind.DATA_WITH_PARITY)
+        return ((target, tuple(entry.path for entry in members))
+                for target, members in groupby(entries, key=lambda entry: entry.target))
+
+    def created(self, result: FileResult):
+        """Record the parity just created in the kept entries, or in those of the walk still going on."""
+        entries = self.entries if self.entries is not None else self.walking
+        if entries is None:
+            return
+        name = result.target[:-len(".par2")] if result.target.endswith(".par2") else result.target
+        written = tuple(parity_files(name, self.store))
+        for path in written:
+            entries[path] = ScanEntry(EntryKind.PARITY, path)
+        for file in result.files:
+            entries[file] = ScanEntry(EntryKind.DATA_WITH_PARITY, file, written, result.target)
+
+    def results(self, operation: str, jobs: Iterable[Tuple[str, Tuple[str, ...]]]) -> Iterator[FileResult]:
+        """Hand the jobs to the executor as slots free up and yield their results as they complete. Jobs not handed
+        out yet are dropped when the iterator is closed early, the ones running finish in the background."""
+        executor = self.executor
+        if executor is None:
+            if self.owned_executor is None:
+                self.owned_executor = ThreadPoolExecutor(self.processes)
+            executor = self.owned_executor
+        iterator = iter(jobs)
+        pending = set()
+        try:
+            while True:
+                while len(pending) < self.processes:
+                    target_files = next(iterator, None)
+                    if target_files is None:
+                        break
+                    pending.add(executor.submit(run_job, operation, *target_files, self.settings, self.report))
+                if not pending:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        finally:
+            for future in pending:
+                future.cancel()
@@ -0,0 +1,219 @@
+import itertools
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import click
+
+from constants import DEFAULT_BLOCK_COUNT, DEFAULT_REDUNDANCY
+from scrub import SIZE_UNITS
+from faults import corrupt_head
+
+CORPUS_REGEX = re.compile(r"(\d+)\s*x\s*(\d+)\s*([KMGT]?)(?:i?B)?")
+FILES_PER_DIRECTORY = 1000
+WRITE_SIZE = 16 * 2 ** 20
+MODES = ("create", "verify", "repair")
+PAR2TORTILLA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "par2tortilla.py")
+
+
+def parse_corpus(corpus: str) -> List[Tuple[int, int]]:
+    """'100000x4K,3x2G' is 100000 files of 4 KiB and 3 files of 2 GiB, returned as [(100000, 4096), (3, 2 ** 31)]."""
+    spec = []
+    for part in corpus.split(","):
+        match = CORPUS_REGEX.fullmatch(part.strip())
+        if match is None:
+            raise ValueError(f"Invalid corpus '{part}', expected e.g. '100000x4K' or '3x2G'.")
+        count, size, unit = match.groups()
+        spec.append((int(count), int(size) * SIZE_UNITS[unit or "B"]))
+    return spec
+
+
+class Corpus:
+    """Synthetic data set of random files, laid out like test.Context, but sized by a corpus spec."""
+
+    def __init__(self, spec: List[Tuple[int, int]]):
+        self.spec = spec
+        self.test_files = []
+        sizes = (size for count, size in spec for _ in range(count))
+        for i, size in enumerate(sizes):
+            self.test_files.append((f"d{i // FILES_PER_DIRECTORY:04d}/f{i:07d}.bin", size))
+
+    @property
+    def file_count(self) -> int:
+        return len(self.test_files)
+
+    @property
+    def total_size(self) -> int:
+        return sum(size for _, size in self.test_files)
+
+    def create_test_data(self):
+        print(f"creating {self.file_count} files, {self.total_size} bytes...")
+        for file_name, size in self.test_files:
+            Path(file_name).parent.mkdir(parents=True, exist_ok=True)
+            with open(file_name, "wb") as f:
+                for offset in range(0, size, WRITE_SIZE):
+                    f.write(os.urandom(min(WRITE_SIZE, size - offset)))
+
+    def corrupt_test_data(self, corruption_percent: float, seed: int):
+        rng = random.Random(seed)
+        for file_name, _ in self.test_files:
+            corrupt_head(file_name, corruption_percent, rng)
+
+    def clean(self):
+        """Remove everything the runs left behind, parity and backups, keeping only the corpus."""
+        keep = {os.path.normpath(file_name) for file_name, _ in self.test_files}
+        for directory, _, names in os.walk(os.curdir):
+            for name in names:
+                path = os.path.normpath(os.path.join(directory, name))
+                if path not in keep:
+                    os.remove(path)
+
+
+def time_run(args: List[str]) -> Tuple[float, int]:
+    """Run par2tortilla and return the wall time it took and its exit code."""
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, PAR2TORTILLA, "run", *args], stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start, process.returncode
+
+
+def bench_settings(corpus: Corpus, processes: int, block_count: int, redundancy: int, corruption_percent: float,
+                   repeat: int, seed: int = 0) -> List[dict]:
+    """Time create, verify and verify with repair on the corpus, best of `repeat` runs each."""
+    options = ["-p", str(processes), "--block-count", str(block_count), "--redundancy", str(redundancy)]
+    seconds = {mode: [] for mode in MODES}
+    exit_codes = {mode: 0 for mode in MODES}
+    for _ in range(repeat):
+        corpus.clean()
+        for mode, args in (("create", ["--create"]), ("verify", ["--verify"]), ("repair", ["--verify", "--repair"])):
+            if mode == "repair":
+                corpus.corrupt_test_data(corruption_percent, seed)
+            took, exit_code = time_run(options + args + [os.curdir])
+            seconds[mode].append(took)
+            exit_codes[mode] = exit_codes[mode] or exit_code
+
+    results = []
+    for mode in MODES:
+        best = min(seconds[mode])
+        results.append({"mode": mode, "processes": processes, "block_count": block_count, "redundancy": redundancy,
+                        "seconds": best, "files": corpus.file_count, "bytes": corpus.total_size,
+                        "files_per_second": corpus.file_count / best,
+                        "mib_per_second": corpus.total_size / 2 ** 20 / best, "exit_code": exit_codes[mode]})
+    return results
+
+
+def result_key(result: dict) -> Tuple:
+    return result["mode"], result["processes"], result["block_count"], result["redundancy"]
+
+
+def regressions(baseline: dict, current: dict, threshold: float) -> List[Tuple[Tuple, float, float]]:
+    """(key, baseline seconds, current seconds) of the runs that got slower by more than threshold percent.
+
+    Runs are matched by mode and settings, only results of the same corpus are compared.
+    """
+    if baseline["corpus"] != current["corpus"]:
+        raise ValueError(f"Corpus differs, '{baseline['corpus']}' against '{current['corpus']}'.")
+    before: Dict[Tuple, float] = {result_key(result): result["seconds"] for result in baseline["results"]}
+    slower = []
+    for result in current["results"]:
+        key = result_key(result)
+        if key in before and result["seconds"] > before[key] * (1 + threshold / 100):
+            slower.append((key, before[key], result["seconds"]))
+    return slower
+
+
+def int_list(value: str) -> List[int]:
+    return [int(part) for part in value.split(",")]
+
+
+@click.group()
+def main():
+    """Time par2tortilla runs on synthetic corpora and compare the results."""
+    pass
+
+
+@main.command()
+@click.option("--corpus", "corpus", default="1000x4K,10x8M", show_default=True,
+              help="Files to generate, COUNTxSIZE separated by commas, e.g. 100000x4K,10000x8M,3x2G.")
+@click.option("-p", "--processes", "processes", default="2", show_default=True,
+              help="Comma separated --processes values to run with.")
+@click.option("--block-count", "block_count", default=str(DEFAULT_BLOCK_COUNT), show_default=True,
+              help="Comma separated --block-count values to run with.")
+@click.option("--redundancy", "redundancy", default=str(DEFAULT_REDUNDANCY), show_default=True,
+              help="Comma separated --redundancy values to run with.")
+@click.option("--corruption", "corruption_percent", default=1.0, show_default=True,
+              help="Percent of every file corrupted before the repair run.")
+@click.option("--seed", "seed", default=0, show_default=True,
+              help="Seed of the corruption, the same seed damages the same bytes in the same way.")
+@click.option("--repeat", "repeat", default=1, show_default=True, help="Runs per setting, the fastest one counts.")
+@click.option("--work-directory", "work_directory", type=click.Path(file_okay=False), default=None,
+              help="Where the corpus is generated, a temporary directory by default.")
+@click.option("-o", "--output", "output", type=click.Path(dir_okay=False), required=True,
+              help="JSON file the results are written to.")
+def run(corpus, processes, block_count, redundancy, corruption_percent, seed, repeat, work_directory, output):
+    try:
+        spec = parse_corpus(corpus)
+        settings = list(itertools.product(int_list(processes), int_list(block_count), int_list(redundancy)))
+    except ValueError as e:
+        click.echo(e)
+        exit(1)
+
+    output = os.path.abspath(output)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(dir=work_directory) as directory:
+        os.chdir(directory)
+        try:
+            data = Corpus(spec)
+            data.create_test_data()
+            results = []
+            for settings_processes, settings_block_count, settings_redundancy in settings:
+                results += bench_settings(data, settings_processes, settings_block_count, settings_redundancy,
+                                          corruption_percent, repeat, seed)
+        finally:
+            os.chdir(cwd)
+
+    for result in results:
+        failed = f", FAILED with exit code {result['exit_code']}" if result["exit_code"] else ""
+        click.echo(f"{result['mode']:>6} -p {result['processes']} -b {result['block_count']} "
+                   f"-r {result['redundancy']}: {result['seconds']:.2f} s, {result['files_per_second']:.1f} files/s, "
+                   f"{result['mib_per_second']:.1f} MiB/s{failed}")
+    with open(output, "w") as f:
+        json.dump({"created": datetime.now(timezone.utc).isoformat(), "python": sys.version, "corpus": corpus,
+                   "results": results}, f, indent=2)
+
+
+@main.command()
+@click.option("--threshold", "threshold", default=10.0, show_default=True,
+              help="Percent a run may get slower before it counts as a regression.")
+@click.argument("baseline", type=click.Path(exists=True, dir_okay=False))
+@click.argument("current", type=click.Path(exists=True, dir_okay=False))
+def compare(threshold, baseline, current):
+    """Exit with 1 if any run in CURRENT is slower than the same run in BASELINE."""
+    with open(baseline) as f:
+        baseline = json.load(f)
+    with open(current) as f:
+        current = json.load(f)
+
+    try:
+        slower = regressions(baseline, current, threshold)
+    except ValueError as e:
+        click.echo(e)
+        exit(1)
+
+    for (mode, processes, block_count, redundancy), before, after in slower:
+        click.echo(f"REGRESSION {mode} -p {processes} -b {block_count} -r {redundancy}: "
+                   f"{before:.2f} s -> {after:.2f} s (+{(after / before - 1) * 100:.0f}%)")
+    if slower:
+        exit(1)
+    click.echo(f"No regressions over {threshold}%.")
+
+
+if __name__ == "__main__":
+    main()
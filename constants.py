@@ -1,13 +1,53 @@
 from enum import Enum
+from typing import NamedTuple
 
 DEFAULT_PARITY_FILE_COUNT: int = 1
 DEFAULT_REDUNDANCY: int = 10
 DEFAULT_BLOCK_COUNT: int = 500
+DEFAULT_REVERIFY_DAYS: int = 30
+DEFAULT_GROUP_MAX_SIZE: int = 256  # MiB
+DEFAULT_MEMORY_BUDGET: int = 1024  # MiB
+DEFAULT_SCHEDULE_WINDOW: int = 1024
+DEFAULT_DEBOUNCE: float = 2.0  # seconds
+DEFAULT_NATIVE_MAX_SIZE: int = 1  # MiB, par2 is faster above
+
+GROUP_PREFIX: str = "par2tortilla-group-"
+DEDUP_MODES = ("inode", "content")
+
+THREAD_BYTES: int = 256 * 2 ** 20  # data one par2 thread is given
+MIN_MEMORY: int = 16  # MiB
 
 
 class FileStatus(Enum):
     OK = 1
     REPAIRABLE = 2
     FUBAR = 3
-    PARITY_DAMAGED = 4  # TODO
+    PARITY_DAMAGED = 4
     REPAIRED = 5
+    CREATED = 6
+    TIMED_OUT = 7
+    FAILED = 8  # par2 complained on stderr or said something unexpected
+
+
+class SetHealth(Enum):
+    HEALTHY = 1
+    DEGRADED = 2  # packets or recovery slices lost, the rest still repairs
+    UNUSABLE = 3  # no main packet, descriptions or recovery slices left
+
+
+class DuplicateKind(Enum):
+    HARDLINK = 1  # same inode
+    COPY = 2  # same size and SHA-256
+
+
+class EntryKind(Enum):
+    DATA_WITH_PARITY = 1
+    DATA_WITHOUT_PARITY = 2
+    PARITY = 3
+    ORPHAN_PARITY = 4
+    BACKUP = 5
+
+
+class Resources(NamedTuple):
+    threads: int
+    memory: int  # MiB
@@ -0,0 +1,42 @@
+import hashlib
+import mmap
+import os
+import re
+from typing import Iterable, Optional
+
+SHA256_NAME_REGEX = re.compile(r"[0-9a-f]{64}")
+HASH_CHUNK_SIZE = 16 * 2 ** 20
+
+
+def is_content_addressed(file: str) -> bool:
+    """True if the file is named by a SHA-256 digest, the way restic names its repository files."""
+    return SHA256_NAME_REGEX.fullmatch(os.path.basename(file)) is not None
+
+
+def sha256_file(file: str) -> Optional[str]:
+    """Hash the file through a memory map, without copying it into Python buffers. None if it cannot be read.
+
+    hashlib releases the GIL while hashing the chunks, so several files can be hashed on threads at once.
+    """
+    sha256 = hashlib.sha256()
+    try:
+        with open(file, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+                    for offset in range(0, size, HASH_CHUNK_SIZE):
+                        sha256.update(view[offset:offset + HASH_CHUNK_SIZE])
+    except (OSError, ValueError):
+        return None
+    return sha256.hexdigest()
+
+
+def sha256_matches_name(file: str) -> bool:
+    """Hash the file and compare the digest to its name."""
+    return is_content_addressed(file) and sha256_file(file) == os.path.basename(file)
+
+
+def content_matches(files: Iterable[str]) -> bool:
+    """True if there are files and all of them are named by the SHA-256 digest of their content."""
+    files = list(files)
+    return bool(files) and all(sha256_matches_name(file) for file in files)
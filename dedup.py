@@ -0,0 +1,60 @@
+import os
+import shutil
+from typing import Dict, Optional, Tuple
+
+from constants import DuplicateKind
+from content import sha256_file
+
+
+class Duplicates:
+    """Tells which data files of a scan are the same as one seen earlier in it, by inode and, with by_content, by size
+    and SHA-256.
+
+    Only files with more than one link are remembered by inode. By content, the first file of every size is only
+    hashed once a second file of that size turns up, so files of unique sizes are never read.
+    """
+
+    def __init__(self, by_content: bool = False):
+        self.by_content = by_content
+        self.inodes: Dict[Tuple[int, int], str] = {}
+        self.sizes: Dict[int, Optional[str]] = {}  # first file of a size, None once it was hashed
+        self.digests: Dict[Tuple[int, str], str] = {}
+
+    def original(self, path: str, stat: os.stat_result) -> Optional[Tuple[str, DuplicateKind]]:
+        """The file seen earlier that this one duplicates and how, None if it is the first of its kind."""
+        if stat.st_nlink > 1:
+            original = self.inodes.setdefault((stat.st_dev, stat.st_ino), path)
+            if original != path:
+                return original, DuplicateKind.HARDLINK
+        if not self.by_content or stat.st_size == 0:
+            return None
+
+        size = stat.st_size
+        if size not in self.sizes:
+            self.sizes[size] = path
+            return None
+        first = self.sizes[size]
+        if first is not None:
+            self.sizes[size] = None
+            first_digest = sha256_file(first)
+            if first_digest is not None:
+                self.digests.setdefault((size, first_digest), first)
+
+        digest = sha256_file(path)
+        if digest is None:
+            return None
+        original = self.digests.setdefault((size, digest), path)
+        return (original, DuplicateKind.COPY) if original != path else None
+
+
+def restore(original: str, duplicate: str, kind: DuplicateKind):
+    """Make a duplicate the same as its original again after par2 repaired the original.
+
+    par2 writes a repaired file anew, so hard links would keep pointing at the damaged data and copies stay damaged.
+    """
+    temporary = duplicate + ".par2tortilla-tmp"
+    if kind == DuplicateKind.HARDLINK:
+        os.link(original, temporary)
+    else:
+        shutil.copy2(original, temporary)
+    os.replace(temporary, duplicate)
@@ -0,0 +1,91 @@
+import os
+import struct
+from typing import Iterable, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows, no FIEMAP, files are ordered by inode number
+    fcntl = None
+
+FS_IOC_FIEMAP = 0xC020660B  # _IOWR('f', 11, struct fiemap)
+FIEMAP = struct.Struct("=QQIIII")  # start, length, flags, mapped extents, extent count, reserved
+FIEMAP_EXTENT = struct.Struct("=QQQQQIIII")  # logical, physical, length, 2 reserved, flags, 3 reserved
+FIEMAP_EXTENT_UNKNOWN = 0x2  # not allocated yet, e.g. delayed allocation of data still being written back
+WILLNEED_SIZE = 16 * 2 ** 20  # head of the next file read ahead while the current one is hashed
+
+# posix_fadvise hints, None where the platform has none
+SEQUENTIAL = getattr(os, "POSIX_FADV_SEQUENTIAL", None)
+WILLNEED = getattr(os, "POSIX_FADV_WILLNEED", None)
+DONTNEED = getattr(os, "POSIX_FADV_DONTNEED", None)
+
+
+def physical_offset(path: str) -> Optional[int]:
+    """Where the first extent of the file starts on the device, by FIEMAP. None for empty files, files not allocated
+    yet and on file systems or platforms without FIEMAP."""
+    if fcntl is None:
+        return None
+    request = bytearray(FIEMAP.pack(0, 2 ** 64 - 1, 0, 0, 1, 0) + bytes(FIEMAP_EXTENT.size))
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, request)
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+    if FIEMAP.unpack_from(request)[3] == 0:
+        return None
+    extent = FIEMAP_EXTENT.unpack_from(request, FIEMAP.size)
+    if extent[5] & FIEMAP_EXTENT_UNKNOWN:
+        return None
+    return extent[1]
+
+
+def layout_key(path: str) -> Tuple[int, int]:
+    """Sort key placing files in the order their data lies on disk, by physical offset where FIEMAP tells it and by
+    inode number, which roughly follows allocation, where it does not."""
+    offset = physical_offset(path)
+    if offset is not None:
+        return 0, offset
+    try:
+        return 1, os.stat(path).st_ino
+    except OSError:
+        return 2, 0
+
+
+def advise(fd: int, advice: Optional[int], offset: int = 0, length: int = 0):
+    """posix_fadvise where there is one, hints are not worth failing over."""
+    if advice is None:
+        return
+    try:
+        os.posix_fadvise(fd, offset, length, advice)
+    except OSError:
+        pass
+
+
+def will_need(path: str, length: int = WILLNEED_SIZE):
+    """Have the kernel start reading the head of a file in the background."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        advise(fd, WILLNEED, 0, length)
+    finally:
+        os.close(fd)
+
+
+def drop_cached(paths: Iterable[str]):
+    """Evict the clean pages of the files from the page cache, so a pass over the whole tree does not push out what
+    other processes keep cached."""
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            advise(fd, DONTNEED)
+        finally:
+            os.close(fd)
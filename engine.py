@@ -0,0 +1,381 @@
+import asyncio
+import functools
+import heapq
+import itertools
+import os
+import time
+from asyncio.subprocess import PIPE
+from typing import Awaitable, Callable, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple, TypeVar
+
+from constants import FileStatus, MIN_MEMORY, Resources, SetHealth, THREAD_BYTES
+from content import content_matches
+from diskio import drop_cached
+from metrics import Call, Metrics
+from par2encode import NativeEncoder, rebuild_parity
+from par2format import ParityHealth, check_parity, mismatched_files, verify_in_process
+from scanner import target_files
+from store import ParityStore, base_path
+from throttle import Governor
+from utils import group_index, par2create_args, par2create_group_args, par2create_status, par2repair_args, \
+    par2repair_status, par2verify_args, par2verify_status
+
+Item = TypeVar("Item")
+Result = TypeVar("Result")
+
+_EXHAUSTED = object()
+
+
+def run_unordered(job: Callable[[Item], Awaitable[Result]], items: Iterable[Item],
+                  concurrency: int) -> Iterator[Tuple[Item, Result]]:
+    """Run the job for every item on a private event loop and yield (item, result) pairs as the jobs complete.
+
+    At most `concurrency` jobs run at once. Items are only pulled from the iterable when a slot is free, so a
+    streaming scan keeps feeding jobs while it walks. Closing the generator early cancels the jobs still running.
+    """
+    loop = asyncio.new_event_loop()
+    iterator = iter(items)
+    pending = {}
+    try:
+        while True:
+            while len(pending) < concurrency:
+                item = next(iterator, _EXHAUSTED)
+                if item is _EXHAUSTED:
+                    break
+                pending[loop.create_task(job(item))] = item
+            if not pending:
+                break
+
+            done, _ = loop.run_until_complete(asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED))
+            for task in done:
+                yield pending.pop(task), task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        loop.run_until_complete(loop.shutdown_default_executor())
+        loop.close()
+
+
+def par2_resources(size: int, budget: Resources) -> Resources:
+    """Threads and memory for one par2 invocation working on `size` bytes, capped by the global budget.
+
+    Small files get a single thread and the minimal memory, so many of them run side by side. Every THREAD_BYTES of
+    data add a thread, and the memory limit grows with the data up to the whole budget.
+    """
+    threads = min(max(1, -(-size // THREAD_BYTES)), budget.threads)
+    memory = min(max(MIN_MEMORY, -(-size // 2 ** 20)), budget.memory)
+    return Resources(threads, memory)
+
+
+async def governed(job: Callable[[Item, Resources], Awaitable[Result]], item: Item, resources: Resources, size: int,
+                   governor: Optional[Governor]) -> Result:
+    """Run the job once the governor lets it through and report back how long it took. admit gives its slot back
+    itself when cancelled, once it returned done does, however the job ends."""
+    if governor is None:
+        return await job(item, resources)
+    await governor.admit(size)
+    started = time.monotonic()
+    try:
+        return await job(item, resources)
+    finally:
+        governor.done(time.monotonic() - started, size)
+
+
+def run_scheduled(job: Callable[[Item, Resources], Awaitable[Result]], items: Iterable[Tuple[Item, int]],
+                  concurrency: int, budget: Resources, window: int,
+                  governor: Optional[Governor] = None, ordered: bool = False,
+                  stop: Optional[Callable[[], bool]] = None) -> Iterator[Tuple[Item, Result]]:
+    """Like run_unordered, but for (item, size) pairs. Jobs are given resources sized by par2_resources and admitted
+    while the threads and memory they hold together stay within the budget.
+
+    Up to `window` items are read ahead and started largest first, so the big files do not end up at the tail of the
+    run, or in the order they came in when ordered. A job too large to fit waits until enough is released, smaller
+    ones do not overtake it meanwhile. With a governor, started jobs additionally wait for it to let them through.
+    Once stop() says so when a job is about to start, the items read ahead are dropped and no more are read, the
+    jobs running are still waited for.
+    """
+    loop = asyncio.new_event_loop()
+    iterator = iter(items)
+    exhausted = False
+    counter = itertools.count()
+    waiting = []
+    pending = {}
+    used_threads = 0
+    used_memory = 0
+    try:
+        while True:
+            while not exhausted and len(waiting) < window:
+                pair = next(iterator, _EXHAUSTED)
+                if pair is _EXHAUSTED:
+                    exhausted = True
+                    break
+                item, size = pair
+                rank = 0 if ordered else -size
+                heapq.heappush(waiting, (rank, next(counter), item, size, par2_resources(size, budget)))
+
+            while waiting and len(pending) < concurrency:
+                if stop is not None and stop():
+                    waiting.clear()
+                    exhausted = True
+                    break
+                _, _, item, size, resources = waiting[0]
+                if pending and (used_threads + resources.threads > budget.threads
+                                or used_memory + resources.memory > budget.memory):
+                    break
+                heapq.heappop(waiting)
+                used_threads += resources.threads
+                used_memory += resources.memory
+                task = loop.create_task(governed(job, item, resources, size, governor))
+                pending[task] = item, resources
+            if not pending:
+                break
+
+            done, _ = loop.run_until_complete(asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED))
+            for task in done:
+                item, resources = pending.pop(task)
+                used_threads -= resources.threads
+                used_memory -= resources.memory
+                yield item, task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        loop.run_until_complete(loop.shutdown_default_executor())
+        loop.close()
+
+
+async def run_par2(args: List[str], timeout: Optional[float], priority: Sequence[str] = (),
+                   call: Optional[Call] = None) -> Optional[Tuple[bytes, bytes]]:
+    """Run par2 and return its stdout and stderr, None if it did not finish within timeout seconds.
+
+    `priority` is a command prefix such as nice or ionice. par2 is killed when it times out or when the job is
+    cancelled. Its exit code and CPU time go to the call, when given one.
+    """
+    process = await asyncio.create_subprocess_exec(*priority, *args, stdout=PIPE, stderr=PIPE)
+    if call is not None:
+        call.child_started()
+    try:
+        return await asyncio.wait_for(process.communicate(), timeout)
+    except asyncio.TimeoutError:
+        return None
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        if call is not None:
+            call.child_finished(process.returncode)
+
+
+def data_size(target, store: Optional[ParityStore] = None) -> int:
+    """Bytes of data a call works on, the target is a data file, the index of a grouped set or a list of files."""
+    files = target if isinstance(target, list) else target_files(target, store.index(target) if store else None)
+    try:
+        return sum(os.path.getsize(file) for file in files)
+    except OSError:
+        return 0
+
+
+def measured(operation: str):
+    """Record an Event for every call of a par2 coroutine given `metrics`. The coroutine gets the Call to fill in."""
+    def decorator(function):
+        @functools.wraps(function)
+        async def wrapper(target, *args, metrics: Optional[Metrics] = None, **kwargs) -> FileStatus:
+            if metrics is None:
+                return await function(target, *args, **kwargs)
+            path = group_index(target) if isinstance(target, list) else target
+            call = metrics.call(operation, path, data_size(target, kwargs.get("store")))
+            status = await function(target, *args, call=call, **kwargs)
+            metrics.record(call, status)
+            return status
+        return wrapper
+    return decorator
+
+
+async def native_create(native: NativeEncoder, index: str, files: List[str], parity_file_count: int, redundancy: int,
+                        block_count: Optional[int], block_size: Optional[int], call: Optional[Call],
+                        report: Callable[[str], None] = print) -> Optional[FileStatus]:
+    """CREATED, or None when the native encoder rejects the settings, e.g. a block size giving more slices than PAR2
+    allows, and par2 should have a go. It rejects them before writing anything."""
+    started = time.perf_counter()
+    try:
+        await native.create(index, files, parity_file_count, redundancy, block_count, block_size, base_path(files[0]))
+    except ValueError as e:
+        report(f"native encoder cannot create '{index}', falling back to par2: {e}")
+        return None
+    finally:
+        if call is not None:
+            call.in_process(time.perf_counter() - started)
+    return FileStatus.CREATED
+
+
+@measured("create")
+async def par2create(file: str, parity_file_count: int, redundancy: int, block_count: Optional[int],
+                     timeout: Optional[float] = None, resources: Optional[Resources] = None,
+                     priority: Sequence[str] = (), store: Optional[ParityStore] = None,
+                     call: Optional[Call] = None, block_size: Optional[int] = None,
+                     native: Optional[NativeEncoder] = None, report: Callable[[str], None] = print) -> FileStatus:
+    report(f"creating par2 parity for '{file}'...")
+    if native is not None and native.accepts(data_size([file])):
+        index = store.create_index(file) if store is not None else file + ".par2"
+        status = await native_create(native, index, [file], parity_file_count, redundancy, block_count, block_size,
+                                     call, report)
+        if status is not None:
+            return status
+    if store is None:
+        args = par2create_args(file, parity_file_count, redundancy, block_count, resources, block_size=block_size)
+    else:
+        args = par2create_group_args(store.create_index(file), [file], parity_file_count, redundancy, block_count,
+                                     resources, base_path(file), block_size)
+    output = await run_par2(args, timeout, priority, call)
+    if output is None:
+        return FileStatus.TIMED_OUT
+    return par2create_status(file, *output, report)
+
+
+@measured("create")
+async def par2create_group(files: List[str], parity_file_count: int, redundancy: int, block_count: Optional[int],
+                           timeout: Optional[float] = None, resources: Optional[Resources] = None,
+                           priority: Sequence[str] = (), store: Optional[ParityStore] = None,
+                           call: Optional[Call] = None, block_size: Optional[int] = None,
+                           native: Optional[NativeEncoder] = None,
+                           report: Callable[[str], None] = print) -> FileStatus:
+    index = group_index(files)
+    report(f"creating par2 parity for {len(files)} files in '{index}'...")
+    if native is not None and native.accepts(data_size(files)):
+        status = await native_create(native, store.create_index(index) if store is not None else index, files,
+                                     parity_file_count, redundancy, block_count, block_size, call, report)
+        if status is not None:
+            return status
+    if store is None:
+        args = par2create_group_args(index, files, parity_file_count, redundancy, block_count, resources,
+                                     block_size=block_size)
+    else:
+        args = par2create_group_args(store.create_index(index), files, parity_file_count, redundancy, block_count,
+                                     resources, base_path(index), block_size)
+    output = await run_par2(args, timeout, priority, call)
+    if output is None:
+        return FileStatus.TIMED_OUT
+    return par2create_status(index, *output, report)
+
+
+@measured("verify")
+async def par2verify(file: str, in_process: bool = True, timeout: Optional[float] = None,
+                     resources: Optional[Resources] = None, content_addressed: bool = False,
+                     priority: Sequence[str] = (), store: Optional[ParityStore] = None,
+                     call: Optional[Call] = None, report: Callable[[str], None] = print) -> FileStatus:
+    report(f"verifying file '{file}'...")
+    index = store.index(file) if store is not None else None
+    started = time.perf_counter()
+    try:
+        if content_addressed and await asyncio.to_thread(content_matches, target_files(file, index)):
+            return FileStatus.OK
+        # hashlib releases the GIL while hashing, a worker thread keeps the event loop responsive
+        if in_process and await asyncio.to_thread(verify_in_process, file, index):
+            return FileStatus.OK
+    finally:
+        if call is not None:
+            call.in_process(time.perf_counter() - started)
+
+    if store is None:
+        args = par2verify_args(file, resources)
+    else:
+        args = par2verify_args(index, resources, base_path(file))
+    output = await run_par2(args, timeout, priority, call)
+    if output is None:
+        return FileStatus.TIMED_OUT
+    return par2verify_status(file, *output, report)
+
+
+@measured("repair")
+async def par2repair(file: str, timeout: Optional[float] = None, resources: Optional[Resources] = None,
+                     priority: Sequence[str] = (), store: Optional[ParityStore] = None,
+                     call: Optional[Call] = None, report: Callable[[str], None] = print) -> FileStatus:
+    report(f"repairing file '{file}'...")
+    if store is None:
+        args = par2repair_args(file, resources)
+    else:
+        args = par2repair_args(store.index(file), resources, base_path(file))
+    output = await run_par2(args, timeout, priority, call)
+    if output is None:
+        return FileStatus.TIMED_OUT
+    return par2repair_status(file, *output, report)
+
+
+async def scrub_parity(target: str, parity_files: Sequence[str], rebuild: bool = False,
+                       store: Optional[ParityStore] = None,
+                       report: Callable[[str], None] = print) -> Tuple[ParityHealth, FileStatus]:
+    """Check the PAR2 files of a target packet by packet. With rebuild, only the damaged files of a degraded set are
+    rewritten, CREATED then. PARITY_DAMAGED is a set left degraded or unusable."""
+    report(f"checking parity of '{target}'...")
+    health = await asyncio.to_thread(check_parity, parity_files)
+    if health.health == SetHealth.HEALTHY:
+        return health, FileStatus.OK
+    if not rebuild or health.health == SetHealth.UNUSABLE:
+        return health, FileStatus.PARITY_DAMAGED
+
+    index = store.index(target) if store is not None else target if target.endswith(".par2") else target + ".par2"
+    try:
+        await asyncio.to_thread(rebuild_parity, health, index, base_path(target))
+    except ValueError as e:
+        report(f"ERROR '{target}' - {e}")
+        return health, FileStatus.PARITY_DAMAGED
+    return health, FileStatus.CREATED
+
+
+class ChainResult(NamedTuple):
+    """Outcome of every step a chain of jobs took for one target, None for steps it did not take."""
+    target: str
+    created: Optional[FileStatus] = None
+    verified: Optional[FileStatus] = None
+    repaired: Optional[FileStatus] = None
+    reverified: Optional[FileStatus] = None
+    # absolute paths of the members of a grouped set the verify found damaged, None when not looked for or not known
+    damaged: Optional[Tuple[str, ...]] = None
+
+
+async def create_chain(target: str, create: Callable[..., Awaitable[FileStatus]],
+                       verify: Optional[Callable[..., Awaitable[FileStatus]]] = None,
+                       resources: Optional[Resources] = None) -> ChainResult:
+    """Create the parity of a target and, when given a verify job, verify it straight away."""
+    created = await create(resources=resources)
+    if verify is None or created != FileStatus.CREATED:
+        return ChainResult(target, created=created)
+    return ChainResult(target, created=created, verified=await verify(target, resources=resources))
+
+
+async def cache_dropped(chain: Callable[..., Awaitable[ChainResult]], files: Sequence[str],
+                        resources: Optional[Resources] = None) -> ChainResult:
+    """Run a chain and evict the files it read, the data and PAR2 files the scan found for its target, from the page
+    cache once it is done with them."""
+    result = await chain(resources=resources)
+    await asyncio.to_thread(drop_cached, files)
+    return result
+
+
+async def verify_chain(target: str, verify: Callable[..., Awaitable[FileStatus]],
+                       repair: Optional[Callable[..., Awaitable[FileStatus]]] = None,
+                       resources: Optional[Resources] = None,
+                       damaged: Optional[Callable[[str], Awaitable[Optional[Tuple[str, ...]]]]] = None) -> ChainResult:
+    """Verify a target and, when given a repair job, repair it as soon as it turns out repairable and verify again.
+    Given a damaged job, the members a damaged target consists of are told apart before the repair touches them."""
+    verified = await verify(target, resources=resources)
+    found = None
+    if damaged is not None and verified in (FileStatus.REPAIRABLE, FileStatus.FUBAR):
+        found = await damaged(target)
+    if repair is None or verified != FileStatus.REPAIRABLE:
+        return ChainResult(target, verified=verified, damaged=found)
+
+    repaired = await repair(target, resources=resources)
+    if repaired != FileStatus.REPAIRED:
+        return ChainResult(target, verified=verified, repaired=repaired, damaged=found)
+    return ChainResult(target, verified=verified, repaired=repaired,
+                       reverified=await verify(target, resources=resources), damaged=found)
+
+
+async def damaged_members(target: str, store: Optional[ParityStore] = None) -> Optional[Tuple[str, ...]]:
+    """Absolute paths of the members of a grouped recovery set that do not match their descriptions."""
+    index = store.index(target) if store is not None else None
+    mismatched = await asyncio.to_thread(mismatched_files, target, index)
+    return tuple(os.path.abspath(path) for path in mismatched) if mismatched is not None else None
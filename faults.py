@@ -0,0 +1,85 @@
+import mmap
+import os
+import random
+from typing import List, Optional
+
+from par2format import HEADER, iter_packet_headers
+from scanner import volume_files
+
+WRITE_SIZE = 16 * 2 ** 20
+
+
+def write_random(file_name: str, offset: int, length: int, rng: random.Random):
+    """Overwrite length bytes at offset with random data, in writes of at most WRITE_SIZE bytes."""
+    with open(file_name, "r+b") as f:
+        f.seek(offset)
+        for start in range(offset, offset + length, WRITE_SIZE):
+            f.write(rng.randbytes(min(WRITE_SIZE, offset + length - start)))
+
+
+def corrupt_head(file_name: str, corruption_percent: float, rng: random.Random) -> int:
+    """Overwrite the first corruption_percent of the file with random data. Returns the bytes overwritten."""
+    length = int(os.path.getsize(file_name) * (corruption_percent / 100))
+    print(f"corrupting first {length} bytes of '{file_name}'...")
+    write_random(file_name, 0, length, rng)
+    return length
+
+
+def flip_bits(file_name: str, count: int, rng: random.Random) -> List[int]:
+    """Flip count random bits of the file in place. Returns the byte offsets touched."""
+    offsets = []
+    with open(file_name, "r+b") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return offsets
+        with mmap.mmap(f.fileno(), 0) as data:
+            for _ in range(count):
+                offset = rng.randrange(len(data))
+                data[offset] ^= 1 << rng.randrange(8)
+                offsets.append(offset)
+    return offsets
+
+
+def zero_blocks(file_name: str, block_size: int, count: int, rng: random.Random) -> List[int]:
+    """Zero count distinct random block_size aligned ranges of the file, like lost sectors. Returns their offsets."""
+    size = os.path.getsize(file_name)
+    blocks = -(-size // block_size)
+    offsets = sorted(block * block_size for block in rng.sample(range(blocks), min(count, blocks)))
+    with open(file_name, "r+b") as f:
+        for offset in offsets:
+            f.seek(offset)
+            f.write(bytes(min(block_size, size - offset)))
+    return offsets
+
+
+def truncate(file_name: str, keep_percent: float) -> int:
+    """Cut the file to keep_percent of its size, like an interrupted copy. Returns the new size."""
+    size = int(os.path.getsize(file_name) * (keep_percent / 100))
+    os.truncate(file_name, size)
+    return size
+
+
+def delete_volumes(index: str, count: int, rng: random.Random) -> List[str]:
+    """Remove count random volumes of the recovery set. Returns the files removed."""
+    volumes = volume_files(index)
+    removed = sorted(rng.sample(volumes, min(count, len(volumes))))
+    for volume in removed:
+        os.remove(volume)
+    return removed
+
+
+def damage_packets(par2_file: str, count: int, rng: random.Random, packet_type: Optional[bytes] = None) -> List[int]:
+    """Flip a byte in the body of count random packets of a PAR2 file, of packet_type only when given, so their
+    MD5 no longer matches. Returns the offsets of the packets damaged."""
+    with open(par2_file, "r+b") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return []
+        with mmap.mmap(f.fileno(), 0) as data:
+            packets = [(header.offset, header.length - HEADER.size) for header in iter_packet_headers(data)
+                       if packet_type is None or header.type == packet_type]
+            damaged = sorted(rng.sample(packets, min(count, len(packets))))
+            for offset, length in damaged:
+                if length:
+                    data[offset + HEADER.size + rng.randrange(length)] ^= 0xFF
+                else:  # nothing but the header, break the hash itself
+                    data[offset + 16] ^= 0xFF
+    return [offset for offset, _ in damaged]
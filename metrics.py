@@ -0,0 +1,162 @@
+import json
+import os
+import time
+from bisect import bisect_left
+from collections import Counter
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from constants import FileStatus
+
+try:
+    import resource
+except ImportError:  # Windows, CPU time of children is not available
+    resource = None
+
+DURATION_BUCKETS = (0.01, 0.1, 1, 10, 60, 600, 3600)  # seconds
+PHASES = ("scan", "classify", "in-process", "subprocess")
+
+
+class Event(NamedTuple):
+    """What one par2create, par2verify or par2repair call did, written as a JSON line."""
+    operation: str
+    path: str
+    size: int
+    started: float  # unix time
+    wall: float
+    cpu: Optional[float]  # of the par2 child, None without one or when other children ran alongside it
+    exit_code: Optional[int]  # of the par2 child, None without one
+    status: str
+
+
+class Call:
+    """Measurements of a call taken while it runs."""
+
+    def __init__(self, metrics: "Metrics", operation: str, path: str, size: int):
+        self.metrics = metrics
+        self.operation = operation
+        self.path = path
+        self.size = size
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.cpu = None
+        self.exit_code = None
+        self.child_start = None
+        self.child_rusage = None
+        self.child_generation = None
+        self.child_alone = True
+
+    def child_started(self):
+        self.metrics.children_running += 1
+        self.metrics.children_started += 1
+        self.child_start = time.perf_counter()
+        self.child_rusage = resource.getrusage(resource.RUSAGE_CHILDREN) if resource is not None else None
+        self.child_generation = self.metrics.children_started
+        self.child_alone = self.metrics.children_running == 1
+
+    def child_finished(self, exit_code: Optional[int]):
+        """Called once the child was reaped. Its CPU time is only known when no other child overlapped with it."""
+        self.metrics.children_running -= 1
+        self.metrics.timings["subprocess"] += time.perf_counter() - self.child_start
+        self.exit_code = exit_code
+        if self.child_rusage is None:
+            return
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu = usage.ru_utime + usage.ru_stime - self.child_rusage.ru_utime - self.child_rusage.ru_stime
+        self.metrics.children_cpu += cpu
+        if self.child_alone and self.child_generation == self.metrics.children_started:
+            self.cpu = (self.cpu or 0.0) + cpu
+
+    def in_process(self, seconds: float):
+        self.metrics.timings["in-process"] += seconds
+
+
+class Metrics:
+    """Collects an Event per call, aggregated into duration histograms and byte counters per operation.
+
+    Events are appended to a JSON lines file as they come, the aggregates can be written as a node_exporter textfile.
+    Timings sum up the seconds spent in each phase over all jobs, which run side by side, so they may exceed the wall
+    time of the run.
+    """
+
+    def __init__(self, events_path: Optional[str] = None):
+        self.events_file = open(events_path, "a") if events_path is not None else None
+        self.timings = Counter()
+        self.buckets: Dict[str, List[int]] = {}
+        self.durations = Counter()
+        self.calls = Counter()
+        self.bytes = Counter()
+        self.cpu = Counter()
+        self.children_running = 0
+        self.children_started = 0
+        self.children_cpu = 0.0
+        self.started = time.perf_counter()
+
+    def call(self, operation: str, path: str, size: int) -> Call:
+        return Call(self, operation, path, size)
+
+    def record(self, call: Call, status: FileStatus) -> Event:
+        event = Event(call.operation, call.path, call.size, call.started, time.perf_counter() - call.start, call.cpu,
+                      call.exit_code, status.name)
+        buckets = self.buckets.setdefault(event.operation, [0] * (len(DURATION_BUCKETS) + 1))
+        buckets[bisect_left(DURATION_BUCKETS, event.wall)] += 1
+        self.durations[event.operation] += event.wall
+        self.calls[event.operation, event.status] += 1
+        self.bytes[event.operation] += event.size
+        if event.cpu is not None:
+            self.cpu[event.operation] += event.cpu
+
+        if self.events_file is not None:
+            self.events_file.write(json.dumps(event._asdict()) + "\n")
+            self.events_file.flush()
+        return event
+
+    def textfile(self) -> str:
+        """The aggregates in the Prometheus text exposition format."""
+        lines = ["# HELP par2tortilla_call_duration_seconds Wall time of par2create, par2verify and par2repair calls.",
+                 "# TYPE par2tortilla_call_duration_seconds histogram"]
+        for operation, buckets in sorted(self.buckets.items()):
+            cumulative = 0
+            for bound, count in zip(DURATION_BUCKETS + (float("inf"),), buckets):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else str(bound)
+                lines.append(f'par2tortilla_call_duration_seconds_bucket{{operation="{operation}",le="{le}"}} '
+                             f'{cumulative}')
+            lines.append(f'par2tortilla_call_duration_seconds_sum{{operation="{operation}"}} '
+                         f'{self.durations[operation]}')
+            lines.append(f'par2tortilla_call_duration_seconds_count{{operation="{operation}"}} {cumulative}')
+
+        lines += ["# HELP par2tortilla_calls_total Calls by operation and resulting status.",
+                  "# TYPE par2tortilla_calls_total counter"]
+        lines += [f'par2tortilla_calls_total{{operation="{operation}",status="{status}"}} {count}'
+                  for (operation, status), count in sorted(self.calls.items())]
+        lines += ["# HELP par2tortilla_bytes_total Bytes of data the calls worked on.",
+                  "# TYPE par2tortilla_bytes_total counter"]
+        lines += [f'par2tortilla_bytes_total{{operation="{operation}"}} {count}'
+                  for operation, count in sorted(self.bytes.items())]
+        lines += ["# HELP par2tortilla_cpu_seconds_total CPU time of the par2 children of calls that ran alone.",
+                  "# TYPE par2tortilla_cpu_seconds_total counter"]
+        lines += [f'par2tortilla_cpu_seconds_total{{operation="{operation}"}} {seconds}'
+                  for operation, seconds in sorted(self.cpu.items())]
+        lines += ["# HELP par2tortilla_phase_seconds Seconds spent per phase, summed over all jobs.",
+                  "# TYPE par2tortilla_phase_seconds gauge"]
+        lines += [f'par2tortilla_phase_seconds{{phase="{phase}"}} {self.timings[phase]}' for phase in PHASES]
+        lines += ["# HELP par2tortilla_children_cpu_seconds CPU time of all par2 children.",
+                  "# TYPE par2tortilla_children_cpu_seconds gauge",
+                  f"par2tortilla_children_cpu_seconds {self.children_cpu}",
+                  "# HELP par2tortilla_last_run_timestamp_seconds When the run finished.",
+                  "# TYPE par2tortilla_last_run_timestamp_seconds gauge",
+                  f"par2tortilla_last_run_timestamp_seconds {time.time()}"]
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, textfile_path: str):
+        """Written aside and renamed, so node_exporter never reads half of it."""
+        with open(textfile_path + ".tmp", "w") as f:
+            f.write(self.textfile())
+        os.replace(textfile_path + ".tmp", textfile_path)
+
+    def profile(self) -> List[Tuple[str, float]]:
+        return [("wall", time.perf_counter() - self.started)] + [(phase, self.timings[phase]) for phase in PHASES]
+
+    def close(self):
+        if self.events_file is not None:
+            self.events_file.close()
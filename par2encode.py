@@ -0,0 +1,296 @@
+import asyncio
+import hashlib
+import os
+import struct
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+
+from constants import SetHealth
+from par2format import CREATOR_TYPE, FILE_DESC_TYPE, HASH_16K_SIZE, HEADER, IFSC_TYPE, MAGIC, MAIN_TYPE, \
+    RECOVERY_SLICE_TYPE, ParityFile, ParityHealth, file_matches
+
+try:
+    import numpy
+except ImportError:  # the native encoder is optional, par2 creates parity without it
+    numpy = None
+
+GF_POLYNOMIAL = 0x1100B  # x^16 + x^12 + x^3 + x + 1, the generator of PAR 2.0
+GF_ORDER = 65535
+MAX_INPUT_SLICES = 32768
+MAX_RECOVERY_SLICES = 65535
+CHUNK_WORDS = 2 ** 20  # products computed per NumPy operation, bounds the temporaries
+CREATOR = b"par2tortilla"
+
+_tables = None
+
+
+class SourceFile(NamedTuple):
+    path: str
+    name: str  # as stored in the File Description packet, relative to the base directory
+    length: int
+    md5: bytes
+    md5_16k: bytes
+    file_id: bytes
+    slices: List[Tuple[bytes, int]]  # MD5 and CRC32 of every slice, zero padded to the slice size
+
+
+def available() -> bool:
+    return numpy is not None
+
+
+def gf_tables():
+    """Log and antilog tables of GF(2^16). The antilog table is doubled so sums of two logs need no modulo, and the
+    log of 0 points past that at zeros, so products with 0 need no special case."""
+    global _tables
+    if _tables is None:
+        exp = numpy.zeros(3 * GF_ORDER, dtype=numpy.uint16)
+        log = numpy.full(GF_ORDER + 1, 2 * GF_ORDER, dtype=numpy.int32)
+        value = 1
+        for power in range(GF_ORDER):
+            exp[power] = value
+            log[value] = power
+            value <<= 1
+            if value & 0x10000:
+                value ^= GF_POLYNOMIAL
+        exp[GF_ORDER:2 * GF_ORDER] = exp[:GF_ORDER]
+        _tables = exp, log
+    return _tables
+
+
+def input_slice_logs(count: int) -> List[int]:
+    """Logs of the constants of the input slices, the powers of 2 coprime to 65535 in increasing order."""
+    logs = []
+    power = 1
+    while len(logs) < count:
+        if power % 3 and power % 5 and power % 17 and power % 257:
+            logs.append(power)
+        power += 1
+    return logs
+
+
+def slice_size_for(lengths: List[int], block_count: int) -> int:
+    """Smallest multiple of 4 that splits the files into at most block_count slices."""
+    if block_count < len(lengths):
+        raise ValueError(f"{len(lengths)} files do not fit into {block_count} blocks.")
+
+    def slices(size: int) -> int:
+        return sum(-(-length // size) for length in lengths)
+
+    low = max(1, -(-sum(lengths) // block_count) // 4)
+    high = max(low, -(-max(sum(lengths), 1) // max(1, block_count - len(lengths))) // 4 + 1)
+    while low < high:
+        middle = (low + high) // 2
+        if slices(middle * 4) <= block_count:
+            high = middle
+        else:
+            low = middle + 1
+    return low * 4
+
+
+def recovery_slice_count(input_slices: int, redundancy: int) -> int:
+    """Rounded like par2, at least one recovery slice for any redundancy."""
+    count = (input_slices * redundancy + 50) // 100
+    return max(count, 1) if redundancy > 0 else 0
+
+
+def packet(recovery_set_id: bytes, packet_type: bytes, body: bytes) -> bytes:
+    body += b"\0" * (-len(body) % 4)
+    hashed = recovery_set_id + packet_type + body
+    return HEADER.pack(MAGIC, HEADER.size + len(body), hashlib.md5(hashed).digest(), recovery_set_id,
+                       packet_type) + body
+
+
+def hash_file(path: str, name: str, slice_size: int) -> SourceFile:
+    md5 = hashlib.md5()
+    length = 0
+    slices = []
+    with open(path, "rb") as f:
+        head = f.read(HASH_16K_SIZE)
+        f.seek(0)
+        while True:
+            data = f.read(slice_size)
+            if not data:
+                break
+            md5.update(data)
+            length += len(data)
+            padded = data + b"\0" * (slice_size - len(data))
+            slices.append((hashlib.md5(padded).digest(), zlib.crc32(padded)))
+    md5_16k = hashlib.md5(head).digest()
+    encoded_name = name.encode("utf-8", errors="surrogateescape")
+    file_id = hashlib.md5(md5_16k + struct.pack("<Q", length) + encoded_name).digest()
+    return SourceFile(path, name, length, md5.digest(), md5_16k, file_id, slices)
+
+
+def encode(files: List[SourceFile], slice_size: int, exponents: Sequence[int]) -> "numpy.ndarray":
+    """Recovery slices of the given exponents, one row of 16 bit words each, the input slices in the order of files.
+
+    Recovery slice e is the sum over the input slices i of c_i^e * d_i, with c_i = 2^n_i. Its log is n_i * e, so a
+    multiply-accumulate is an antilog lookup of the summed logs per word, vectorized over all exponents and a batch of
+    input slices at once. Tiny slices of small files are batched by the hundreds, large ones go one at a time.
+    """
+    exp, log = gf_tables()
+    count = sum(len(file.slices) for file in files)
+    data = bytearray(count * slice_size)
+    position = 0
+    for file in files:
+        with open(file.path, "rb") as f:
+            f.readinto(memoryview(data)[position:position + file.length])
+        position += len(file.slices) * slice_size
+    words = slice_size // 2
+    slice_logs = log[numpy.frombuffer(data, dtype="<u2").reshape(count, words)]
+
+    recovery = numpy.zeros((len(exponents), words), dtype=numpy.uint16)
+    exponent_column = numpy.array(list(exponents), dtype=numpy.int64)[:, None]
+    constant_logs = numpy.array(input_slice_logs(count), dtype=numpy.int64)
+    batch = max(1, CHUNK_WORDS // max(1, len(exponents) * words))
+    for start in range(0, count, batch):
+        coefficient_logs = (exponent_column * constant_logs[start:start + batch] % GF_ORDER).astype(numpy.int32)
+        products = exp[coefficient_logs[:, :, None] + slice_logs[None, start:start + batch]]
+        recovery ^= numpy.bitwise_xor.reduce(products, axis=1)
+    return recovery
+
+
+def volume_names(index: str, recovery_slices: int, parity_file_count: int) -> List[Tuple[str, range]]:
+    """'f.bin.vol0+5.par2' style names of uniformly sized volumes and the exponents each one holds."""
+    stem = index[:-len(".par2")]
+    volumes = min(parity_file_count, recovery_slices)
+    width = len(str(recovery_slices))
+    names = []
+    first = 0
+    for volume in range(volumes):
+        count = recovery_slices // volumes + (volume < recovery_slices % volumes)
+        names.append((f"{stem}.vol{first:0{width}d}+{count:0{width}d}.par2", range(first, first + count)))
+        first += count
+    return names
+
+
+def create_recovery_set(index: str, files: List[str], parity_file_count: int, redundancy: int,
+                        block_count: Optional[int], block_size: Optional[int] = None,
+                        base_directory: Optional[str] = None) -> List[str]:
+    """Write a PAR 2.0 recovery set protecting the files, as par2 c -u would. Returns the PAR2 files written.
+
+    The index holds the main, file description, IFSC and creator packets, every volume the recovery slices plus a
+    copy of those. File names are stored relative to base_directory, the directory of the index by default.
+    """
+    base_directory = base_directory if base_directory is not None else os.path.dirname(index) or os.curdir
+    lengths = [os.path.getsize(file) for file in files]
+    slice_size = block_size if block_size is not None else slice_size_for(lengths, block_count)
+    if slice_size % 4:
+        raise ValueError(f"Block size {slice_size} is not a multiple of 4.")
+
+    sources = [hash_file(file, os.path.relpath(file, base_directory).replace(os.sep, "/"), slice_size)
+               for file in files]
+    sources.sort(key=lambda source: source.file_id[::-1])  # par2 orders IDs as little endian 128 bit numbers
+    input_slices = sum(len(source.slices) for source in sources)
+    recovery_slices = recovery_slice_count(input_slices, redundancy)
+    if not 0 < input_slices <= MAX_INPUT_SLICES or recovery_slices > MAX_RECOVERY_SLICES:
+        raise ValueError(f"{input_slices} input and {recovery_slices} recovery slices are out of the PAR2 range.")
+
+    main_body = struct.pack("<QI", slice_size, len(sources)) + b"".join(source.file_id for source in sources)
+    recovery_set_id = hashlib.md5(main_body).digest()
+    critical = critical_packets(recovery_set_id, main_body, sources)
+
+    written = [index]
+    with open(index, "wb") as f:
+        f.write(critical)
+    recovery = encode(sources, slice_size, range(recovery_slices))
+    for volume, exponents in volume_names(index, recovery_slices, parity_file_count):
+        write_volume(volume, recovery_set_id, exponents, [recovery[exponent] for exponent in exponents], critical)
+        written.append(volume)
+    return written
+
+
+def critical_packets(recovery_set_id: bytes, main_body: bytes, sources: List[SourceFile]) -> bytes:
+    """Main, file description, IFSC and creator packets, what the index holds and every volume repeats."""
+    critical = [packet(recovery_set_id, MAIN_TYPE, main_body)]
+    for source in sources:
+        critical.append(packet(recovery_set_id, FILE_DESC_TYPE,
+                               source.file_id + source.md5 + source.md5_16k + struct.pack("<Q", source.length)
+                               + source.name.encode("utf-8", errors="surrogateescape")))
+        critical.append(packet(recovery_set_id, IFSC_TYPE,
+                               source.file_id + b"".join(md5 + struct.pack("<I", crc) for md5, crc in source.slices)))
+    return b"".join(critical) + packet(recovery_set_id, CREATOR_TYPE, CREATOR)
+
+
+def write_volume(volume: str, recovery_set_id: bytes, exponents: Sequence[int], rows: List["numpy.ndarray"],
+                 critical: bytes):
+    with open(volume, "wb") as f:
+        for exponent, row in zip(exponents, rows):
+            f.write(packet(recovery_set_id, RECOVERY_SLICE_TYPE,
+                           struct.pack("<I", exponent) + row.astype("<u2").tobytes()))
+        f.write(critical)
+
+
+def rebuild_parity(health: ParityHealth, index: str, base_directory: Optional[str] = None) -> List[str]:
+    """Rewrite only the damaged or missing files of a degraded recovery set, from the descriptions that survived in
+    the others and the data, instead of creating the whole set anew. Returns the files rewritten.
+
+    The data has to match its descriptions first, parity computed from damaged data would protect the damage. Files
+    are written aside and renamed over the damaged ones, so an interrupted rebuild leaves the set as it was.
+    """
+    if health.health != SetHealth.DEGRADED:
+        raise ValueError(f"Only a degraded recovery set can be rebuilt, '{index}' is {health.health.name}.")
+    base_directory = base_directory if base_directory is not None else os.path.dirname(index) or os.curdir
+    recovery_set = health.recovery_set
+    main = recovery_set.main
+    sources = []
+    for file_id in main.recovery_file_ids:
+        description = recovery_set.files[file_id]
+        path = os.path.join(base_directory, description.name)
+        if not file_matches(path, description):
+            raise ValueError(f"'{path}' does not match its description, repair it first.")
+        sources.append(SourceFile(path, description.name, description.length, description.md5, description.md5_16k,
+                                  file_id, recovery_set.checksums[file_id]))
+
+    damaged = [file for file in health.files if file.damaged]
+    if not any(not file.expected for file in health.files):
+        damaged.append(ParityFile(index, 1, (), ()))
+    exponents = sorted({exponent for file in damaged for exponent in file.expected})
+    if exponents and numpy is None:
+        raise ValueError("Rebuilding recovery volumes needs NumPy.")
+    rows = dict(zip(exponents, encode(sources, main.slice_size, exponents))) if exponents else {}
+
+    main_body = struct.pack("<QI", main.slice_size, len(main.recovery_file_ids)) \
+        + b"".join(main.recovery_file_ids + main.non_recovery_file_ids)
+    critical = critical_packets(recovery_set.recovery_set_id, main_body, sources)
+    for file in damaged:
+        if file.expected:
+            write_volume(file.path + ".tmp", recovery_set.recovery_set_id, file.expected,
+                         [rows[exponent] for exponent in file.expected], critical)
+        else:
+            with open(file.path + ".tmp", "wb") as f:
+                f.write(critical)
+        os.replace(file.path + ".tmp", file.path)
+    return [file.path for file in damaged]
+
+
+class NativeEncoder:
+    """Creates recovery sets in a pool of worker processes instead of spawning par2 for each of them.
+
+    Only data up to max_size bytes is taken, par2 is faster on large files than the NumPy encoder. With no processes,
+    recovery sets are encoded in a thread of the calling process, for callers that already run in a worker.
+    """
+
+    def __init__(self, processes: int, max_size: int):
+        if numpy is None:
+            raise RuntimeError("The native encoder needs NumPy.")
+        self.processes = processes
+        self.max_size = max_size
+        self.pool = None
+
+    def accepts(self, size: int) -> bool:
+        return 0 < size <= self.max_size
+
+    async def create(self, index: str, files: List[str], parity_file_count: int, redundancy: int,
+                     block_count: Optional[int], block_size: Optional[int] = None,
+                     base_directory: Optional[str] = None) -> List[str]:
+        if self.pool is None and self.processes:
+            self.pool = ProcessPoolExecutor(self.processes)
+        return await asyncio.get_running_loop().run_in_executor(
+            self.pool, create_recovery_set, index, files, parity_file_count, redundancy, block_count, block_size,
+            base_directory)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
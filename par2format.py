@@ -0,0 +1,305 @@
+import hashlib
+import mmap
+import os
+import re
+import struct
+from typing import Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+from constants import SetHealth
+from diskio import SEQUENTIAL, advise, will_need
+
+MAGIC = b"PAR2\0PKT"
+HEADER = struct.Struct("<8sQ16s16s16s")
+MAIN_TYPE = b"PAR 2.0\0Main\0\0\0\0"
+FILE_DESC_TYPE = b"PAR 2.0\0FileDesc"
+IFSC_TYPE = b"PAR 2.0\0IFSC\0\0\0\0"
+RECOVERY_SLICE_TYPE = b"PAR 2.0\0RecvSlic"
+CREATOR_TYPE = b"PAR 2.0\0Creator\0"
+
+HASH_16K_SIZE = 16384
+READ_SIZE = 4 * 2 ** 20
+VOLUME_REGEX = re.compile(r"\.vol(\d+)\+(\d+)\.par2$")
+
+
+class Packet(NamedTuple):
+    offset: int
+    recovery_set_id: bytes
+    type: bytes
+    body: bytes
+
+
+class MainPacket(NamedTuple):
+    slice_size: int
+    recovery_file_ids: Tuple[bytes, ...]
+    non_recovery_file_ids: Tuple[bytes, ...]
+
+
+class FileDescription(NamedTuple):
+    file_id: bytes
+    md5: bytes
+    md5_16k: bytes
+    length: int
+    name: str
+
+
+class RecoverySet(NamedTuple):
+    recovery_set_id: bytes
+    main: MainPacket
+    files: Dict[bytes, FileDescription]
+    checksums: Dict[bytes, List[Tuple[bytes, int]]]
+
+
+class PacketHeader(NamedTuple):
+    offset: int
+    length: int  # header included
+    recovery_set_id: bytes
+    type: bytes
+
+
+def iter_packet_headers(data: bytes) -> Iterator[PacketHeader]:
+    """Yield the headers of the packets of a PAR2 file whose own MD5 is correct, without copying their bodies.
+    Damaged packets are skipped."""
+    view = memoryview(data)
+    try:
+        position = data.find(MAGIC)
+        while position != -1 and position + HEADER.size <= len(data):
+            magic, length, packet_md5, recovery_set_id, packet_type = HEADER.unpack_from(data, position)
+            if length < HEADER.size or length % 4 != 0 or position + length > len(data) \
+                    or hashlib.md5(view[position + 32:position + length]).digest() != packet_md5:
+                position = data.find(MAGIC, position + len(MAGIC))
+                continue
+
+            yield PacketHeader(position, length, recovery_set_id, packet_type)
+            position = data.find(MAGIC, position + length)
+    finally:
+        view.release()
+
+
+def iter_packets(data: bytes) -> Iterator[Packet]:
+    """Yield the packets of a PAR2 file whose own MD5 is correct. Damaged packets are skipped."""
+    for header in iter_packet_headers(data):
+        yield Packet(header.offset, header.recovery_set_id, header.type,
+                     data[header.offset + HEADER.size:header.offset + header.length])
+
+
+def parse_main(body: bytes) -> MainPacket:
+    slice_size, recovery_file_count = struct.unpack_from("<QI", body)
+    file_ids = [body[i:i + 16] for i in range(12, len(body), 16)]
+    return MainPacket(slice_size, tuple(file_ids[:recovery_file_count]), tuple(file_ids[recovery_file_count:]))
+
+
+def parse_file_description(body: bytes) -> FileDescription:
+    file_id, md5, md5_16k, length = struct.unpack_from("<16s16s16sQ", body)
+    name = body[56:].rstrip(b"\0").decode("utf-8", errors="surrogateescape")
+    return FileDescription(file_id, md5, md5_16k, length, name)
+
+
+def parse_ifsc(body: bytes) -> Tuple[bytes, List[Tuple[bytes, int]]]:
+    checksums = [struct.unpack_from("<16sI", body, offset) for offset in range(16, len(body), 20)]
+    return body[:16], checksums
+
+
+class ParityFile(NamedTuple):
+    """What a scrub found in one PAR2 file."""
+    path: str
+    damaged_bytes: int  # not covered by an intact packet, or the whole size if the file is gone
+    exponents: Tuple[int, ...]  # of the intact recovery slices
+    expected: Tuple[int, ...]  # exponents the volume name promises, none for the index
+
+    @property
+    def damaged(self) -> bool:
+        return self.damaged_bytes > 0 or not set(self.expected) <= set(self.exponents)
+
+
+class ParityHealth(NamedTuple):
+    health: SetHealth
+    recovery_set: Optional[RecoverySet]  # put together from the intact packets of all the files
+    files: List[ParityFile]
+    recovery_blocks: int  # intact and distinct
+    expected_blocks: int
+
+    @property
+    def damaged_files(self) -> List[str]:
+        return [file.path for file in self.files if file.damaged]
+
+
+def read_recovery_set(par2_file: str) -> Optional[RecoverySet]:
+    """Parse the description packets of a PAR2 file, None if it contains no intact main packet. The file is mapped
+    rather than read, recovery volumes carry the descriptions too but mostly slices that are skipped."""
+    with open(par2_file, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            packets = [Packet(header.offset, header.recovery_set_id, header.type,
+                              data[header.offset + HEADER.size:header.offset + header.length])
+                       for header in iter_packet_headers(data)
+                       if header.type in (MAIN_TYPE, FILE_DESC_TYPE, IFSC_TYPE)]
+    return recovery_set_of(packets)
+
+
+def file_matches(path: str, description: FileDescription) -> bool:
+    """Compare a data file against its File Description packet: length, MD5 of the first 16 KiB, then full MD5."""
+    try:
+        if os.stat(path).st_size != description.length:
+            return False
+    except OSError:
+        return False
+
+    md5 = hashlib.md5()
+    md5_16k = hashlib.md5()
+    hashed_16k = 0
+    buffer = bytearray(READ_SIZE)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as f:
+        advise(f.fileno(), SEQUENTIAL)
+        while True:
+            read = f.readinto(buffer)
+            if not read:
+                break
+            if hashed_16k < HASH_16K_SIZE:
+                head = min(read, HASH_16K_SIZE - hashed_16k)
+                md5_16k.update(view[:head])
+                hashed_16k += head
+                if hashed_16k == min(HASH_16K_SIZE, description.length) and md5_16k.digest() != description.md5_16k:
+                    return False
+            md5.update(view[:read])
+
+    return md5.digest() == description.md5
+
+
+def verify_in_process(file: str, index_file: Optional[str] = None) -> bool:
+    """True if every file of the recovery set in 'file.par2', or in 'file' itself for grouped sets, matches its
+    description. An index_file kept elsewhere, in a parity store, is read instead.
+
+    False means only that the in-process check could not confirm the files, the par2 binary has the final say.
+    """
+    if index_file is None:
+        index_file = file if file.endswith(".par2") else file + ".par2"
+    try:
+        recovery_set = read_recovery_set(index_file)
+    except OSError:
+        return False
+    if recovery_set is None or not recovery_set.main.recovery_file_ids:
+        return False
+
+    base_directory = os.path.dirname(file)
+    descriptions = [recovery_set.files.get(file_id) for file_id in recovery_set.main.recovery_file_ids]
+    if None in descriptions:
+        return False
+    paths = [os.path.join(base_directory, description.name) for description in descriptions]
+    for i, (path, description) in enumerate(zip(paths, descriptions)):
+        if i + 1 < len(paths):
+            will_need(paths[i + 1])  # read ahead the next member of a group while this one is hashed
+        if not file_matches(path, description):
+            return False
+    return True
+
+
+def mismatched_files(file: str, index_file: Optional[str] = None) -> Optional[List[str]]:
+    """Paths of the files of a recovery set, named as in verify_in_process, that do not match their description.
+    None if the descriptions cannot be read, which member is damaged is not known then."""
+    if index_file is None:
+        index_file = file if file.endswith(".par2") else file + ".par2"
+    try:
+        recovery_set = read_recovery_set(index_file)
+    except OSError:
+        return None
+    if recovery_set is None:
+        return None
+
+    base_directory = os.path.dirname(file)
+    mismatched = []
+    for file_id in recovery_set.main.recovery_file_ids:
+        description = recovery_set.files.get(file_id)
+        if description is None:
+            return None
+        path = os.path.join(base_directory, description.name)
+        if not file_matches(path, description):
+            mismatched.append(path)
+    return mismatched
+
+
+def volume_exponents(par2_file: str) -> Tuple[int, ...]:
+    """Exponents of the recovery slices a 'f.bin.vol10+5.par2' volume holds by its name, none for an index."""
+    match = VOLUME_REGEX.search(par2_file)
+    if match is None:
+        return ()
+    first, count = int(match.group(1)), int(match.group(2))
+    return tuple(range(first, first + count))
+
+
+def check_parity(par2_files: Sequence[str]) -> ParityHealth:
+    """Read the PAR2 files of a recovery set front to back and check every packet against its own MD5.
+
+    Only the description packets are kept, of a recovery slice just its exponent, so a set is checked in little
+    memory however large its volumes are. The set is healthy when nothing is damaged, degraded when some packets or
+    recovery slices are lost but the description of every file survives in one of the files along with at least one
+    recovery slice, and unusable otherwise. A set without any volumes, created with no redundancy, needs no slices.
+    """
+    files = []
+    packets = []
+    slices = []  # (recovery set ID, exponent, body length) of the intact recovery slices
+    for par2_file in par2_files:
+        expected = volume_exponents(par2_file)
+        try:
+            with open(par2_file, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                if size == 0:
+                    files.append(ParityFile(par2_file, 1, (), expected))
+                    continue
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    if hasattr(data, "madvise"):
+                        data.madvise(mmap.MADV_SEQUENTIAL)
+                    covered = 0
+                    exponents = []
+                    for header in iter_packet_headers(data):
+                        covered += header.length
+                        body = header.offset + HEADER.size
+                        if header.type == RECOVERY_SLICE_TYPE and header.length >= HEADER.size + 4:
+                            exponent = struct.unpack_from("<I", data, body)[0]
+                            exponents.append(exponent)
+                            slices.append((header.recovery_set_id, exponent, header.length - HEADER.size))
+                        elif header.type in (MAIN_TYPE, FILE_DESC_TYPE, IFSC_TYPE):
+                            packets.append(Packet(header.offset, header.recovery_set_id, header.type,
+                                                  data[body:header.offset + header.length]))
+        except FileNotFoundError:
+            files.append(ParityFile(par2_file, 1, (), expected))
+            continue
+        files.append(ParityFile(par2_file, size - covered, tuple(exponents), expected))
+
+    recovery_set = recovery_set_of(packets)
+    expected_blocks = len({exponent for file in files for exponent in file.expected})
+    if recovery_set is None:
+        return ParityHealth(SetHealth.UNUSABLE, None, files, 0, expected_blocks)
+
+    slice_length = 4 + recovery_set.main.slice_size
+    recovery_blocks = len({exponent for recovery_set_id, exponent, length in slices
+                           if recovery_set_id == recovery_set.recovery_set_id and length == slice_length})
+    described = all(file_id in recovery_set.files and file_id in recovery_set.checksums
+                    for file_id in recovery_set.main.recovery_file_ids)
+    if not described or (recovery_blocks == 0 and expected_blocks > 0):
+        health = SetHealth.UNUSABLE
+    elif any(file.damaged for file in files) or not any(not file.expected for file in files):
+        health = SetHealth.DEGRADED
+    else:
+        health = SetHealth.HEALTHY
+    return ParityHealth(health, recovery_set, files, recovery_blocks, expected_blocks)
+
+
+def recovery_set_of(packets: List[Packet]) -> Optional[RecoverySet]:
+    """The recovery set of the first intact main packet, its descriptions taken from wherever they survived."""
+    main_packet = next((packet for packet in packets if packet.type == MAIN_TYPE), None)
+    if main_packet is None:
+        return None
+    files = {}
+    checksums = {}
+    for packet in packets:
+        if packet.recovery_set_id != main_packet.recovery_set_id:
+            continue
+        if packet.type == FILE_DESC_TYPE:
+            description = parse_file_description(packet.body)
+            files[description.file_id] = description
+        elif packet.type == IFSC_TYPE:
+            file_id, file_checksums = parse_ifsc(packet.body)
+            checksums[file_id] = file_checksums
+    return RecoverySet(main_packet.recovery_set_id, parse_main(main_packet.body), files, checksums)
@@ -1,11 +1,29 @@
-import multiprocessing
-import re
+import asyncio
+import os
+import signal
+from collections import Counter
 from functools import partial
+from itertools import groupby
+from typing import List, Optional, Tuple
 
 import click
 
-from constants import DEFAULT_PARITY_FILE_COUNT, DEFAULT_REDUNDANCY, DEFAULT_BLOCK_COUNT, FileStatus
-from utils import glob_files, par2create, par2verify, par2repair
+import engine
+import par2encode
+from constants import DEFAULT_PARITY_FILE_COUNT, DEFAULT_REDUNDANCY, DEFAULT_BLOCK_COUNT, DEFAULT_REVERIFY_DAYS, \
+    DEFAULT_GROUP_MAX_SIZE, DEFAULT_DEBOUNCE, DEFAULT_MEMORY_BUDGET, DEFAULT_NATIVE_MAX_SIZE, DEFAULT_SCHEDULE_WINDOW, \
+    DEDUP_MODES, DuplicateKind, EntryKind, FileStatus, Resources, SetHealth
+from dedup import Duplicates, restore
+from diskio import drop_cached
+from metrics import Metrics
+from policy import ParityPolicy, Policy, load_rules
+from scanner import ScanEntry, bucket_files, disk_order as disk_ordered, scan_directories
+from scrub import Budget, Journal, in_shard, parse_shard
+from state import StateDB
+from store import ParityStore, merge, split
+from throttle import Governor, IONICE_CLASSES, priority_prefix
+from utils import group_index
+from watch import parity_files, watch as watch_directory
 
 
 @click.group()
@@ -25,107 +43,585 @@ def main():
               help="PAR2 file count. Uniform size.")
 @click.option("--redundancy", "redundancy", default=DEFAULT_REDUNDANCY, show_default=True, help="PAR2 redundancy.")
 @click.option("--block-count", "block_count", default=DEFAULT_BLOCK_COUNT, show_default=True, help="PAR2 block count.")
+@click.option("--policy", "policy_file", type=click.Path(exists=True, dir_okay=False), default=None,
+              help="JSON rules picking parity file count, redundancy, block count or size per file by glob, size and "
+                   "age. Overrides the three options above for the files they match.")
+@click.option("--auto-policy/--no-auto-policy", "auto_policy", default=False, show_default=True,
+              help="Scale block size, redundancy and parity file count to each file's size instead of using the "
+                   "same settings for all.")
+@click.option("--group/--no-group", "group", default=False, show_default=True,
+              help="Create one recovery set per bucket of files sharing a directory instead of one per file.")
+@click.option("--group-max-size", "group_max_size", default=DEFAULT_GROUP_MAX_SIZE, show_default=True,
+              help="Size limit of a --group bucket in MiB. A bucket holds at most --block-count files.")
+@click.option("--native-create/--no-native-create", "native_create", default=False, show_default=True,
+              help="Create parity in --processes worker processes with the NumPy PAR2 encoder instead of spawning par2 "
+                   "for every file. Needs NumPy.")
+@click.option("--native-max-size", "native_max_size", default=DEFAULT_NATIVE_MAX_SIZE, show_default=True,
+              help="Size limit in MiB of a file or --group bucket for --native-create, par2 creates the larger ones.")
 @click.option("-p", "--processes", "processes", default=2, show_default=True, help="Process files simultaneously.")
+@click.option("--cpu-budget", "cpu_budget", default=os.cpu_count(), show_default=True,
+              help="Threads all par2 invocations may use together. Each gets -t sized by the data it works on.")
+@click.option("--memory-budget", "memory_budget", default=DEFAULT_MEMORY_BUDGET, show_default=True,
+              help="MiB of memory all par2 invocations may use together. Each gets -m sized by its data.")
+@click.option("--schedule-window", "schedule_window", default=DEFAULT_SCHEDULE_WINDOW, show_default=True,
+              help="Jobs read ahead from the scan and started largest first.")
+@click.option("--disk-order/--no-disk-order", "disk_order", default=False, show_default=True,
+              help="Start jobs in the order their files lie on disk, by FIEMAP offset or inode, instead of largest "
+                   "first. Saves seeks on spinning disks.")
+@click.option("--io-limit", "io_limit", default=None, type=float,
+              help="MiB/s of data jobs may start on, shared by all of them.")
+@click.option("--files-limit", "files_limit", default=None, type=float,
+              help="Targets per second jobs may start on, shared by all of them.")
+@click.option("--backoff/--no-backoff", "backoff", default=False, show_default=True,
+              help="Run fewer jobs and lower the limits while jobs take longer per MiB than they used to.")
+@click.option("--nice", "nice", default=None, type=click.IntRange(-20, 19),
+              help="Run par2 with this niceness.")
+@click.option("--ionice", "ionice", default=None, type=click.Choice(list(IONICE_CLASSES)),
+              help="Run par2 in this I/O scheduling class.")
+@click.option("--drop-cache/--no-drop-cache", "drop_cache", default=False, show_default=True,
+              help="Evict data and PAR2 files from the page cache once their jobs are done with them.")
+@click.option("--timeout", "timeout", default=None, type=float,
+              help="Seconds after which a single par2 invocation is killed and counted as timed out.")
+@click.option("--verify-created/--no-verify-created", "verify_created", default=False, show_default=True,
+              help="Verify parities right after creating them.")
+@click.option("--fast-verify/--no-fast-verify", "fast_verify", default=True, show_default=True,
+              help="Check files against their PAR2 hashes in-process, run par2 only for files that do not match.")
+@click.option("--content-addressed/--no-content-addressed", "content_addressed", default=False, show_default=True,
+              help="Files named by the SHA-256 of their content, like in a restic repository, are verified by hashing "
+                   "them. par2 only checks the files that do not match their name.")
+@click.option("--parity-store", "parity_store", type=click.Path(file_okay=False), default=None,
+              help="Directory mirroring DIRECTORY where the PAR2 files live instead of beside the data.")
+@click.option("--dedup", "dedup", default=None, type=click.Choice(DEDUP_MODES),
+              help="Create and verify hard links of a file, or with 'content' also files of the same size and "
+                   "SHA-256, only once and share the result.")
+@click.option("--state-db", "state_db", type=click.Path(dir_okay=False), default=None,
+              help="SQLite index remembering verify results, used to skip files that are not due.")
+@click.option("--reverify-after", "reverify_after", default=DEFAULT_REVERIFY_DAYS, show_default=True,
+              help="Days after which an unchanged file that verified OK is verified again. Needs --state-db.")
+@click.option("--shard", "shard", default=None,
+              help="Only work on shard K of N, e.g. 3/7. Paths are partitioned by a stable hash.")
+@click.option("--budget", "budget", default=None,
+              help="Stop handing out work after this much time (e.g. 6h) or data (e.g. 500G).")
+@click.option("--checkpoint", "checkpoint", type=click.Path(dir_okay=False), default=None,
+              help="Journal of finished verifies, an interrupted or budgeted scrub resumes from it.")
+@click.option("--events", "events", type=click.Path(dir_okay=False), default=None,
+              help="Append an event per par2 create, verify and repair call to this JSON lines file.")
+@click.option("--textfile", "textfile", type=click.Path(dir_okay=False), default=None,
+              help="Write call duration histograms and throughput counters to this node_exporter textfile.")
+@click.option("--profile/--no-profile", "profile", default=False, show_default=True,
+              help="Print where the time went: scanning, classifying, in-process hashing and par2.")
+@click.option("--cached/--no-cached", "cached", default=False, show_default=True,
+              help="Print the summary recorded in --state-db by the last run instead of scanning the directory.")
 @click.argument("directory", type=click.Path())
-def run(create, verify, repair, parity_file_count, redundancy, block_count, processes, directory):
+def run(create, verify, repair, parity_file_count, redundancy, block_count, policy_file, auto_policy, group,
+        group_max_size, native_create, native_max_size, processes, cpu_budget, memory_budget, schedule_window,
+        disk_order, io_limit, files_limit, backoff, nice, ionice, drop_cache, timeout, verify_created, fast_verify,
+        content_addressed, parity_store, dedup, state_db, reverify_after, shard, budget, checkpoint, events, textfile,
+        profile, cached, directory):
     if repair and not verify:
         click.echo("Cannot use --repair without --verify!")
         exit(1)
 
-    all_files: set = glob_files(directory)
+    if cached and state_db is None:
+        click.echo("Cannot use --cached without --state-db!")
+        exit(1)
 
-    data_files = set(filter(lambda s: not s.endswith(".par2"), all_files))
-    parity_files = set(filter(lambda s: s.endswith(".par2"), all_files))
+    if native_create and not par2encode.available():
+        click.echo("Cannot use --native-create without NumPy!")
+        exit(1)
 
-    files_without_parity = set()
-    for file_name in data_files:
-        assumed_parity_name = file_name + ".par2"
-        if assumed_parity_name not in parity_files:
-            files_without_parity.add(file_name)
+    try:
+        shard = parse_shard(shard) if shard is not None else None
+        spending = Budget(budget)
+        journal = Journal(checkpoint, directory, shard) if checkpoint is not None else None
+        rules = load_rules(policy_file) if policy_file is not None else []
+    except ValueError as e:
+        click.echo(e)
+        exit(1)
 
-    files_with_parity: set = data_files.difference(files_without_parity)
+    state = StateDB(state_db) if state_db is not None else None
 
-    parity_without_files = set()
-    vol_regex = re.compile(r"^.*\.vol\d+\+\d+\.par2$")
-    for file_name in parity_files:
-        if vol_regex.match(file_name):
-            assumed_data_file = ".".join(file_name.split(".")[:-2])
-        else:
-            assumed_data_file = ".".join(file_name.split(".")[:-1])
-        if assumed_data_file not in data_files:
-            parity_without_files.add(file_name)
+    if cached and not create and not verify:
+        summary = state.summary(directory)
+        state.close()
+        if summary is None:
+            click.echo(f"No summary of '{directory}' found in '{state_db}'.")
+            exit(1)
+        echo_summary(summary)
+        exit(0)
+
+    counts = Counter()
+    skipped = Counter()
+    stats = {}
+    created_members = {}
+    verified_members = {}
+    verified_duplicates = {}
+    verify_targets = {}
+    scan_complete = False
+
+    priority = priority_prefix(nice, ionice)
+    store = ParityStore(parity_store, directory) if parity_store is not None else None
+    policy = Policy(ParityPolicy(parity_file_count, redundancy, block_count), rules, auto_policy) \
+        if rules or auto_policy else None
+    duplicates = Duplicates(dedup == "content") if dedup is not None else None
+    metrics = Metrics(events) if events is not None or textfile is not None or profile else None
+    timings = metrics.timings if metrics is not None else None
+    native = par2encode.NativeEncoder(processes, native_max_size * 2 ** 20) if native_create else None
+    create_file = partial(engine.par2create, parity_file_count=parity_file_count, redundancy=redundancy,
+                          block_count=block_count, timeout=timeout, priority=priority, store=store, metrics=metrics,
+                          native=native)
+    create_files = partial(engine.par2create_group, parity_file_count=parity_file_count, redundancy=redundancy,
+                           block_count=block_count, timeout=timeout, priority=priority, store=store, metrics=metrics,
+                           native=native)
+    verify_file = partial(engine.par2verify, in_process=fast_verify, timeout=timeout,
+                          content_addressed=content_addressed, priority=priority, store=store, metrics=metrics)
+    repair_file = partial(engine.par2repair, timeout=timeout, priority=priority, store=store,
+                          metrics=metrics) if repair else None
+    find_damaged = partial(engine.damaged_members, store=store)
+
+    def owned(path: str) -> bool:
+        """Files of our own bookkeeping that happen to live in the scanned tree."""
+        return (state is not None and state.owns(path)) or (journal is not None and journal.owns(path))
+
+    def is_due(entry: ScanEntry) -> bool:
+        if state is None:
+            return True
+        stats[entry.path] = os.stat(entry.path)
+        return state.is_due(entry.path, stats[entry.path], entry.parity_files, reverify_after)
+
+    def wanted(target: str) -> bool:
+        if shard is not None and not in_shard(os.path.relpath(target, directory), shard):
+            return False
+        return True
+
+    def deduplicated(entry: ScanEntry) -> bool:
+        """Whether the entry is a duplicate of a data file seen earlier, which is created or verified in its place.
+
+        A hard link without parity is covered by the parity of its original. A copy gets parity of its own, since it
+        can rot or outlive its original, and only its verify is left to the original while their content is the same.
+        Duplicates of an original with parity wait for the verify result of its chain. Once that chain finished, its
+        original is forgotten, so a duplicate found later is verified on its own. Content mode hashes files of
+        colliding sizes right here, on the scan, one at a time, jobs are not handed out meanwhile.
+        """
+        if entry.kind not in (EntryKind.DATA_WITH_PARITY, EntryKind.DATA_WITHOUT_PARITY):
+            return False
+        found = duplicates.original(entry.path, os.stat(entry.path))
+        if found is None:
+            if entry.kind == EntryKind.DATA_WITH_PARITY:
+                verify_targets[entry.path] = entry.target
+            return False
+
+        original, kind = found
+        target = verify_targets.get(original)
+        if entry.kind == EntryKind.DATA_WITHOUT_PARITY:
+            if kind == DuplicateKind.COPY:
+                return False
+            skipped["duplicate"] += 1
+        elif target is None:
+            return False
+        if verify and target is not None:
+            verified_duplicates.setdefault(target, []).append((entry, found))
+        return True
+
+    def cache_dropped(chain, files: List[str]):
+        """The chain, evicting the files from the page cache once it is done with --drop-cache. The PAR2 files a
+        create writes are left out, they are not known without listing the directory again and their pages are mostly
+        still dirty then."""
+        return partial(engine.cache_dropped, chain, files) if drop_cache else chain
+
+    seen_directories = set()
+
+    def forget_deleted(entries: List[ScanEntry]):
+        """Drop the state of the files of a directory that no longer have parity or are gone, by its listing. The
+        directories not seen at all are dropped once the scan is complete."""
+        paths = [entry.path for entry in entries if entry.kind == EntryKind.DATA_WITH_PARITY]
+        if state is None or not paths:
+            return
+        seen_directories.add(os.path.abspath(os.path.dirname(paths[0])))
+        state.forget_missing(os.path.dirname(paths[0]), [os.path.basename(path) for path in paths])
+
+    def chains():
+        """Scan the tree and hand out a chain of jobs per target, with the size of its data, as soon as its directory
+        was classified. Stops handing out chains once the budget is spent."""
+        nonlocal scan_complete
+        for entries in scan_directories(directory, parity_store, timings):
+            entries = [entry for entry in entries if not owned(entry.path)]
+            forget_deleted(entries)
+            if disk_order:
+                entries = disk_ordered(entries)
+            counts.update(entry.kind for entry in entries)
+            if duplicates is not None:
+                entries = [entry for entry in entries if not deduplicated(entry)]
 
-    numeric_extension_regex = re.compile(r".*\.\d+")
-    numeric_extension_files = set(filter(lambda s: numeric_extension_regex.match(s), data_files))
+            if create:
+                files_without_parity = [entry.path for entry in entries if entry.kind == EntryKind.DATA_WITHOUT_PARITY]
+                if group:
+                    buckets = bucket_files(files_without_parity, group_max_size * 2 ** 20, block_count)
+                    create_jobs = ((group_index(files), files, partial(create_files, files)) for files in buckets)
+                else:
+                    create_jobs = ((file_name, [file_name], partial(create_file, file_name))
+                                   for file_name in files_without_parity)
+                for target, files, create_job in create_jobs:
+                    if not wanted(target):
+                        continue
+                    if spending.exhausted():
+                        return
+                    if policy is not None:
+                        create_job = partial(create_job, **policy.for_files(files, directory)._asdict())
+                    size = sum(os.path.getsize(f) for f in files)
+                    spending.spend(size)
+                    created_members[target] = files
+                    chain = partial(engine.create_chain, target, create_job, verify_file if verify_created else None)
+                    yield cache_dropped(chain, files), size
 
-    potential_backup_files = set()
-    for file_name in numeric_extension_files:
-        assumed_data_file = ".".join(file_name.split(".")[:-1])
-        if assumed_data_file in data_files:
-            potential_backup_files.add(file_name)
-            files_without_parity.remove(file_name)
+            if verify:
+                files_with_parity = [entry for entry in entries if entry.kind == EntryKind.DATA_WITH_PARITY]
+                for target, members in groupby(files_with_parity, key=lambda entry: entry.target):
+                    members = list(members)
+                    if not wanted(target):
+                        skipped["shard"] += len(members)
+                        continue
+                    if journal is not None and journal.is_done(target):
+                        skipped["checkpoint"] += len(members)
+                        continue
+                    if not any([is_due(entry) for entry in members]):
+                        skipped["recent"] += len(members)
+                        for entry in members:
+                            stats.pop(entry.path, None)
+                        continue
+                    if spending.exhausted():
+                        return
+                    size = sum(os.path.getsize(entry.path) for entry in members)
+                    spending.spend(size)
+                    verified_members[target] = members
+                    parity = sorted({parity_file for entry in members for parity_file in entry.parity_files})
+                    chain = partial(engine.verify_chain, target, verify_file, repair_file,
+                                    damaged=find_damaged if target.endswith(".par2") else None)
+                    yield cache_dropped(chain, [entry.path for entry in members] + parity), size
+
+        scan_complete = True
 
     if not create and not verify:
-        click.echo(f"Data files with parity: {len(files_with_parity)}")
-        click.echo(f"Data files without parity: {len(files_without_parity)}")
-        click.echo(f"PAR2 files: {len(parity_files)}")
-        click.echo(f"PAR2 files without data files: {len(parity_without_files)}")
-        click.echo(f"Data file backups (?) created by par2repair: {len(potential_backup_files)}")
-        click.echo("Nothing was asked, nothing to do.")
+        if journal is not None:
+            journal.close()
+        for entries in scan_directories(directory, parity_store):
+            entries = [entry for entry in entries if not owned(entry.path)]
+            forget_deleted(entries)
+            counts.update(entry.kind for entry in entries)
+        summary = summarize(counts)
+        if state is not None:
+            state.forget_directories(directory, seen_directories)
+            state.record_summary(directory, summary)
+            state.close()
+        echo_summary(summary)
         exit(0)
 
     if create:
-        if len(files_without_parity) == 0:
-            click.echo("No files without parity found.")
-
         click.echo("Creating parities...")
-        mp_par2create = partial(par2create, parity_file_count=parity_file_count, redundancy=redundancy, block_count=block_count)
-        multiprocessing.Pool(processes).map(mp_par2create, files_without_parity, len(files_without_parity) // processes + 1)
+    if verify:
+        click.echo("Verifying files...")
+
+    created = Counter()
+    created_verified = Counter()
+    verified = Counter()
+    verified_groups = Counter()  # grouped recovery sets, counted once each rather than per member
+    repaired_count = 0
+    repaired_group_count = 0
+    reverified_ok_count = 0
+    resource_budget = Resources(cpu_budget, memory_budget)
+    governor = None
+    if io_limit or files_limit or backoff:
+        governor = Governor(io_limit * 2 ** 20 if io_limit else None, files_limit, processes, backoff)
+
+    def record_verified(entry: ScanEntry, result: engine.ChainResult,
+                        duplicate: Optional[Tuple[str, DuplicateKind]] = None):
+        """Count and store the result for one file. A member of a damaged grouped set that was found intact is OK,
+        the repair of the set did not touch it."""
+        nonlocal repaired_count, reverified_ok_count
+        member = duplicate[0] if duplicate is not None else entry.path
+        if result.damaged is not None and os.path.abspath(member) not in result.damaged:
+            result = engine.ChainResult(result.target, verified=FileStatus.OK)
+        verified[result.verified] += 1
+        if result.repaired == FileStatus.REPAIRED:
+            repaired_count += 1
+            if duplicate is not None:
+                restore(duplicate[0], entry.path, duplicate[1])
+        if result.reverified == FileStatus.OK:
+            reverified_ok_count += 1
+
+        if state is not None:
+            if result.reverified is not None or duplicate is not None:
+                state.record_verify(entry.path, os.stat(entry.path), entry.parity_files,
+                                    result.reverified or result.verified)
+                stats.pop(entry.path, None)
+            else:
+                state.record_verify(entry.path, stats.pop(entry.path), entry.parity_files, result.verified)
+
+    def out_of_time() -> bool:
+        """Checked as each job is about to start, the scan reads far ahead of the jobs running. Chains already handed
+        out but not started are dropped, the pass is not complete then."""
+        nonlocal scan_complete
+        if spending.out_of_time():
+            scan_complete = False
+            return True
+        return False
+
+    for _, result in engine.run_scheduled(lambda chain, resources: chain(resources=resources), chains(), processes,
+                                          resource_budget, schedule_window, governor, disk_order, out_of_time):
+        if result.created is not None:
+            files = created_members.pop(result.target)
+            created[result.created] += len(files)
+            if result.verified is not None:
+                created_verified[result.verified] += len(files)
+            continue
+
+        members = verified_members.pop(result.target)
+        for entry in members:
+            record_verified(entry, result)
+        if result.target.endswith(".par2"):
+            verified_groups[result.verified] += 1
+            if result.repaired == FileStatus.REPAIRED:
+                repaired_group_count += 1
+        if duplicates is not None:
+            for entry in members:
+                verify_targets.pop(entry.path, None)
+            for entry, duplicate in verified_duplicates.pop(result.target, []):
+                record_verified(entry, result, duplicate)
+
+        if journal is not None:
+            journal.record(result.target, result.reverified or result.verified)
+
+    if create:
+        if counts[EntryKind.DATA_WITHOUT_PARITY] == 0:
+            click.echo("No files without parity found.")
+        if created[FileStatus.TIMED_OUT]:
+            click.echo(f"Creating parity timed out for {created[FileStatus.TIMED_OUT]} files.")
+        if created[FileStatus.FAILED]:
+            click.echo(f"Creating parity failed for {created[FileStatus.FAILED]} files.")
+        if duplicates is not None:
+            click.echo(f"Files skipped, covered by the parity of their original: {skipped['duplicate']}")
+        if verify_created:
+            click.echo(f"Created parities verified OK: {created_verified[FileStatus.OK]}/{created[FileStatus.CREATED]}")
 
     if verify:
-        if len(files_with_parity) == 0:
+        if counts[EntryKind.DATA_WITH_PARITY] == 0:
             click.echo("No files with parity found.")
         else:
+            if state is not None:
+                click.echo(f"Files skipped, verified OK within {reverify_after} days and unchanged: "
+                           f"{skipped['recent']}")
+            if shard is not None:
+                click.echo(f"Files skipped, in other shards: {skipped['shard']}")
+            if journal is not None:
+                click.echo(f"Files skipped, already done in this pass: {skipped['checkpoint']}")
+            if duplicates is not None:
+                click.echo(f"Files skipped, duplicates of skipped files: "
+                           f"{sum(len(waiting) for waiting in verified_duplicates.values())}")
+            click.echo(f"Files that are OK: {verified[FileStatus.OK]}")
+            click.echo(f"Files that are damaged but repairable: {verified[FileStatus.REPAIRABLE]}")
+            click.echo(f"Files that are damaged and unrepairable: {verified[FileStatus.FUBAR]}")
+            if verified[FileStatus.TIMED_OUT]:
+                click.echo(f"Files that timed out: {verified[FileStatus.TIMED_OUT]}")
+            if verified[FileStatus.FAILED]:
+                click.echo(f"Files that failed to verify: {verified[FileStatus.FAILED]}")
+            if verified_groups:
+                click.echo(f"Grouped recovery sets that are OK: {verified_groups[FileStatus.OK]}")
+                click.echo(f"Grouped recovery sets that are damaged but repairable: "
+                           f"{verified_groups[FileStatus.REPAIRABLE]}")
+                click.echo(f"Grouped recovery sets that are damaged and unrepairable: "
+                           f"{verified_groups[FileStatus.FUBAR]}")
 
-            files_ok = set()
-            files_repairable = set()
-            files_fubar = set()
+            if repair:
+                click.echo(f"Repaired {repaired_count}/{verified[FileStatus.REPAIRABLE]} files.")
+                click.echo(f"Files verified OK after repair: {reverified_ok_count}/{repaired_count}")
+                if verified_groups:
+                    click.echo(f"Repaired {repaired_group_count}/{verified_groups[FileStatus.REPAIRABLE]} grouped "
+                               f"recovery sets.")
 
-            click.echo("Verifying files...")
-            for file_name, result in multiprocessing.Pool(processes).map(par2verify, files_with_parity,
-                                                                         len(files_with_parity) // processes + 1):
-                if result == FileStatus.OK:
-                    files_ok.add(file_name)
-                elif result == FileStatus.REPAIRABLE:
-                    files_repairable.add(file_name)
-                elif result == FileStatus.FUBAR:
-                    files_fubar.add(file_name)
+    if not scan_complete:
+        click.echo("Budget exhausted, stopped handing out work.")
+    if journal is not None:
+        if scan_complete:
+            click.echo("Pass complete, the next run starts a new one.")
+            journal.finish()
+        else:
+            journal.close()
 
-            click.echo(f"Files that are OK: {len(files_ok)}")
-            click.echo(f"Files that are damaged but repairable: {len(files_repairable)}")
-            click.echo(f"Files that are damaged and unrepairable: {len(files_fubar)}")
+    if state is not None:
+        if scan_complete:
+            state.forget_directories(directory, seen_directories)
+            state.record_summary(directory, summarize(counts))
+        state.close()
+    if native is not None:
+        native.close()
 
-            if repair:
-                click.echo("Repairing files...")
-                repair_counter = 0
-                for result in multiprocessing.Pool(processes).map(par2repair, files_repairable, len(files_repairable) // processes + 1):
-                    if result == FileStatus.REPAIRED:
-                        repair_counter += 1
-                click.echo(f"Repaired {repair_counter}/{len(files_repairable)} files.")
+    if metrics is not None:
+        if textfile is not None:
+            metrics.write_textfile(textfile)
+        if profile:
+            for phase, seconds in metrics.profile():
+                click.echo(f"Time spent, {phase}: {seconds:.2f} s")
+        metrics.close()
+
+
+def summarize(counts: Counter) -> dict:
+    return {"files_with_parity": counts[EntryKind.DATA_WITH_PARITY],
+            "files_without_parity": counts[EntryKind.DATA_WITHOUT_PARITY],
+            "parity_files": counts[EntryKind.PARITY] + counts[EntryKind.ORPHAN_PARITY],
+            "parity_without_files": counts[EntryKind.ORPHAN_PARITY],
+            "potential_backup_files": counts[EntryKind.BACKUP]}
+
+
+def echo_summary(summary: dict):
+    click.echo(f"Data files with parity: {summary['files_with_parity']}")
+    click.echo(f"Data files without parity: {summary['files_without_parity']}")
+    click.echo(f"PAR2 files: {summary['parity_files']}")
+    click.echo(f"PAR2 files without data files: {summary['parity_without_files']}")
+    click.echo(f"Data file backups (?) created by par2repair: {summary['potential_backup_files']}")
+    click.echo("Nothing was asked, nothing to do.")
+
+
+LIST_SCANNED = {"ORPHAN": EntryKind.ORPHAN_PARITY, "BACKUP": EntryKind.BACKUP,
+                "NO_PARITY": EntryKind.DATA_WITHOUT_PARITY}
+LIST_VERIFIED = {"REPAIRABLE": FileStatus.REPAIRABLE, "FUBAR": FileStatus.FUBAR}
+
+
+@main.command(name="list")
+@click.option("--status", "status", required=True, type=click.Choice(list(LIST_VERIFIED) + list(LIST_SCANNED)),
+              help="REPAIRABLE and FUBAR are the results of the last verify recorded in --state-db, the others are "
+                   "found by scanning DIRECTORY.")
+@click.option("--state-db", "state_db", type=click.Path(dir_okay=False), default=None,
+              help="SQLite index of verify results written by run --state-db.")
+@click.option("--parity-store", "parity_store", type=click.Path(file_okay=False), default=None,
+              help="Directory mirroring DIRECTORY where the PAR2 files live instead of beside the data.")
+@click.argument("directory", type=click.Path())
+def list_files(status, state_db, parity_store, directory):
+    """Print the files of DIRECTORY in a state, one per line, as they are found."""
+    if status in LIST_VERIFIED:
+        if state_db is None:
+            click.echo(f"Cannot list {status} files without --state-db!")
+            exit(1)
+        with StateDB(state_db) as state:
+            for path in state.files_with_status(directory, LIST_VERIFIED[status]):
+                click.echo(path)
+        return
+
+    state = StateDB(state_db) if state_db is not None else None
+    for entries in scan_directories(directory, parity_store):
+        for entry in entries:
+            if entry.kind == LIST_SCANNED[status] and not (state is not None and state.owns(entry.path)):
+                click.echo(entry.path)
+    if state is not None:
+        state.close()
+
+
+@main.command()
+@click.option("--rebuild/--no-rebuild", "rebuild", default=False, show_default=True,
+              help="Rewrite only the damaged PAR2 files of degraded recovery sets, from the data once it matches its "
+                   "descriptions. Recovery volumes need NumPy.")
+@click.option("-p", "--processes", "processes", default=2, show_default=True, help="Process files simultaneously.")
+@click.option("--parity-store", "parity_store", type=click.Path(file_okay=False), default=None,
+              help="Directory mirroring DIRECTORY where the PAR2 files live instead of beside the data.")
+@click.argument("directory", type=click.Path())
+def scrub_parity(rebuild, processes, parity_store, directory):
+    """Check every packet of the PAR2 files in DIRECTORY against its MD5 and report degraded and unusable recovery
+    sets. Degraded ones lost packets or recovery slices but still repair, unusable ones lost what a repair needs."""
+    store = ParityStore(parity_store, directory) if parity_store is not None else None
+    # members of a grouped recovery set come one after another and share their target
+    targets = (next(members) for _, members in groupby(
+        (entry for entries in scan_directories(directory, parity_store) for entry in entries
+         if entry.kind == EntryKind.DATA_WITH_PARITY), key=lambda entry: entry.target))
+
+    def job(entry: ScanEntry):
+        return engine.scrub_parity(entry.target, entry.parity_files, rebuild, store)
+
+    counts = Counter()
+    rebuilt = 0
+    for entry, (health, status) in engine.run_unordered(job, targets, processes):
+        counts[health.health] += 1
+        if status == FileStatus.CREATED:
+            rebuilt += 1
+            click.echo(f"REBUILT '{entry.target}' - {', '.join(health.damaged_files) or 'index'}")
+        elif health.health != SetHealth.HEALTHY:
+            click.echo(f"{health.health.name} '{entry.target}' - {health.recovery_blocks}/{health.expected_blocks} "
+                       f"recovery blocks intact, damaged: {', '.join(health.damaged_files) or 'index missing'}")
+
+    click.echo(f"Recovery sets healthy: {counts[SetHealth.HEALTHY]}")
+    click.echo(f"Recovery sets degraded: {counts[SetHealth.DEGRADED]}")
+    click.echo(f"Recovery sets unusable: {counts[SetHealth.UNUSABLE]}")
+    if rebuild:
+        click.echo(f"Rebuilt {rebuilt}/{counts[SetHealth.DEGRADED]} degraded recovery sets.")
+
+
+@main.command()
+@click.option("--parity-file-count", "parity_file_count", default=DEFAULT_PARITY_FILE_COUNT, show_default=True,
+              help="PAR2 file count. Uniform size.")
+@click.option("--redundancy", "redundancy", default=DEFAULT_REDUNDANCY, show_default=True, help="PAR2 redundancy.")
+@click.option("--block-count", "block_count", default=DEFAULT_BLOCK_COUNT, show_default=True, help="PAR2 block count.")
+@click.option("-p", "--processes", "processes", default=2, show_default=True, help="Process files simultaneously.")
+@click.option("--debounce", "debounce", default=DEFAULT_DEBOUNCE, show_default=True,
+              help="Seconds a file has to stay untouched before its parity is created.")
+@click.option("--timeout", "timeout", default=None, type=float,
+              help="Seconds after which a single par2 invocation is killed and counted as timed out.")
+@click.option("--nice", "nice", default=None, type=click.IntRange(-20, 19), help="Run par2 with this niceness.")
+@click.option("--ionice", "ionice", default=None, type=click.Choice(list(IONICE_CLASSES)),
+              help="Run par2 in this I/O scheduling class.")
+@click.option("--drop-cache/--no-drop-cache", "drop_cache", default=False, show_default=True,
+              help="Evict data and PAR2 files from the page cache once their jobs are done with them.")
+@click.option("--parity-store", "parity_store", type=click.Path(file_okay=False), default=None,
+              help="Directory mirroring DIRECTORY where the PAR2 files live instead of beside the data.")
+@click.argument("directory", type=click.Path(exists=True, file_okay=False))
+def watch(parity_file_count, redundancy, block_count, processes, debounce, timeout, nice, ionice, drop_cache,
+          parity_store, directory):
+    """Create parity for files as they land in DIRECTORY and remove it when they go, until interrupted. Linux only."""
+    store = ParityStore(parity_store, directory) if parity_store is not None else None
+    create_file = partial(engine.par2create, parity_file_count=parity_file_count, redundancy=redundancy,
+                          block_count=block_count, timeout=timeout, priority=priority_prefix(nice, ionice), store=store)
+
+    async def create_dropping_cache(file: str) -> FileStatus:
+        status = await create_file(file)
+        await asyncio.to_thread(drop_cached, [file] + parity_files(file, store))
+        return status
+
+    async def watch_until_signal():
+        stop = asyncio.Event()
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            asyncio.get_running_loop().add_signal_handler(signal_number, stop.set)
+        await watch_directory(directory, create_dropping_cache if drop_cache else create_file, processes, debounce,
+                              store, stop, click.echo)
+
+    try:
+        asyncio.run(watch_until_signal())
+    except (OSError, NotImplementedError) as e:
+        click.echo(e)
+        exit(1)
 
 
 @main.command()
 @click.argument('directory', type=click.Path())
 @click.argument('par2-directory', type=click.Path())
-def split_directories():
-    raise NotImplementedError()  # TODO
+def split_directories(directory, par2_directory):
+    """Move the PAR2 files of DIRECTORY to mirrored directories under PAR2_DIRECTORY, for use with --parity-store."""
+    echo_moved(*split(directory, ParityStore(par2_directory, directory)), par2_directory)
 
 
 @main.command()
 @click.argument('directory', type=click.Path())
 @click.argument('par2-directory', type=click.Path())
-def merge_directories():
-    raise NotImplementedError()  # TODO
+def merge_directories(directory, par2_directory):
+    """Move the PAR2 files kept under PAR2_DIRECTORY back beside their data in DIRECTORY."""
+    if not os.path.isdir(par2_directory):
+        click.echo(f"Parity store '{par2_directory}' not found.")
+        exit(1)
+    echo_moved(*merge(directory, ParityStore(par2_directory, directory)), directory)
+
+
+def echo_moved(moved: int, conflicts: List[str], destination: str):
+    click.echo(f"Moved {moved} PAR2 files to '{destination}'.")
+    if conflicts:
+        for conflict in conflicts:
+            click.echo(f"Not overwriting '{conflict}'.")
+        exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,139 @@
+import json
+import os
+import re
+import time
+from fnmatch import fnmatch
+from typing import List, NamedTuple, Optional, Sequence
+
+from scrub import SIZE_UNITS, TIME_UNITS
+
+SIZE_REGEX = re.compile(r"(\d+(?:\.\d+)?)\s*([KMGT]?)(?:i?B)?")
+AGE_REGEX = re.compile(r"(\d+(?:\.\d+)?)\s*([smhd])")
+
+AUTO_MIN_BLOCK_SIZE = 4096  # small files get one block per 4 KiB
+AUTO_MAX_BLOCKS = 2000  # large files get at most this many, and bigger blocks
+AUTO_VOLUME_SIZE = 2 ** 30  # a recovery volume per GiB of data
+AUTO_MAX_VOLUMES = 8
+
+MATCH_KEYS = ("glob", "min_size", "max_size", "min_age", "max_age")
+SETTING_KEYS = ("parity_file_count", "redundancy", "block_count", "block_size")
+
+
+class ParityPolicy(NamedTuple):
+    """par2 create settings of one file, either a block count or a block size."""
+    parity_file_count: int
+    redundancy: int
+    block_count: Optional[int] = None
+    block_size: Optional[int] = None
+
+
+class Rule(NamedTuple):
+    glob: Optional[str]
+    min_size: Optional[int]
+    max_size: Optional[int]
+    min_age: Optional[float]
+    max_age: Optional[float]
+    settings: dict
+
+    def matches(self, path: str, size: int, age: float) -> bool:
+        if self.glob is not None and not fnmatch(path, self.glob):
+            return False
+        if self.min_size is not None and size < self.min_size or self.max_size is not None and size > self.max_size:
+            return False
+        return not (self.min_age is not None and age < self.min_age or self.max_age is not None and age > self.max_age)
+
+
+def parse_size(size) -> int:
+    """'64K', '20GiB' or a plain number of bytes."""
+    match = SIZE_REGEX.fullmatch(str(size).strip())
+    if match is None:
+        raise ValueError(f"Invalid size '{size}', expected e.g. '64K' or '20G'.")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2) or "B"])
+
+
+def parse_age(age) -> float:
+    """'90m', '30d' and so on, in seconds."""
+    match = AGE_REGEX.fullmatch(str(age).strip())
+    if match is None:
+        raise ValueError(f"Invalid age '{age}', expected e.g. '12h' or '30d'.")
+    return float(match.group(1)) * TIME_UNITS[match.group(2)]
+
+
+def parse_rule(rule: dict) -> Rule:
+    unknown = set(rule) - set(MATCH_KEYS) - set(SETTING_KEYS)
+    if unknown:
+        raise ValueError(f"Unknown policy rule keys: {', '.join(sorted(unknown))}.")
+    if "block_count" in rule and "block_size" in rule:
+        raise ValueError("A policy rule sets either block_count or block_size, not both.")
+    settings = {key: rule[key] for key in SETTING_KEYS if key in rule}
+    if "block_size" in settings:
+        settings["block_size"] = parse_size(settings["block_size"])
+        if settings["block_size"] % 4:
+            raise ValueError(f"Block size {settings['block_size']} is not a multiple of 4.")
+    return Rule(rule.get("glob"),
+                parse_size(rule["min_size"]) if "min_size" in rule else None,
+                parse_size(rule["max_size"]) if "max_size" in rule else None,
+                parse_age(rule["min_age"]) if "min_age" in rule else None,
+                parse_age(rule["max_age"]) if "max_age" in rule else None,
+                settings)
+
+
+def load_rules(rules_path: str) -> List[Rule]:
+    """Rules are a JSON list of objects, the first one matching a file decides its settings, e.g.
+
+    [{"glob": "*.log", "redundancy": 5}, {"max_size": "64K", "block_size": 4096, "redundancy": 30},
+     {"min_size": "1G", "min_age": "30d", "block_count": 2000, "parity_file_count": 4}]
+
+    Settings a rule leaves out come from the auto mode or the command line.
+    """
+    with open(rules_path) as f:
+        try:
+            rules = json.load(f)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Invalid policy file '{rules_path}': {e}")
+    if not isinstance(rules, list) or not all(isinstance(rule, dict) for rule in rules):
+        raise ValueError(f"Invalid policy file '{rules_path}', expected a list of rules.")
+    return [parse_rule(rule) for rule in rules]
+
+
+def auto_policy(size: int, base: ParityPolicy) -> ParityPolicy:
+    """Settings scaled to the size of the file.
+
+    Small files get 4 KiB blocks, so a 2 KiB file is one block instead of 500 tiny ones, each with its own checksums.
+    Large files get up to AUTO_MAX_BLOCKS blocks. Redundancy is raised where needed for at least one recovery block,
+    and a recovery volume is added per AUTO_VOLUME_SIZE of data.
+    """
+    blocks = min(AUTO_MAX_BLOCKS, max(1, -(-size // AUTO_MIN_BLOCK_SIZE)))
+    block_size = max(4, -(-max(size, 1) // blocks))
+    block_size += -block_size % 4
+    redundancy = max(base.redundancy, -(-100 // blocks))
+    recovery_blocks = -(-blocks * redundancy // 100)
+    parity_file_count = max(1, min(-(-size // AUTO_VOLUME_SIZE), recovery_blocks, AUTO_MAX_VOLUMES))
+    return ParityPolicy(parity_file_count, redundancy, block_size=block_size)
+
+
+class Policy:
+    """Picks the par2 create settings of each file from the rules, the auto mode or the command line defaults."""
+
+    def __init__(self, base: ParityPolicy, rules: Sequence[Rule] = (), auto: bool = False):
+        self.base = base
+        self.rules = rules
+        self.auto = auto
+
+    def for_file(self, path: str, size: int, mtime: float, now: Optional[float] = None) -> ParityPolicy:
+        policy = auto_policy(size, self.base) if self.auto else self.base
+        age = (time.time() if now is None else now) - mtime
+        for rule in self.rules:
+            if rule.matches(path, size, age):
+                settings = dict(rule.settings)
+                if "block_count" in settings or "block_size" in settings:
+                    settings.setdefault("block_count", None)
+                    settings.setdefault("block_size", None)
+                return policy._replace(**settings)
+        return policy
+
+    def for_files(self, files: List[str], directory: str) -> ParityPolicy:
+        """Settings of a recovery set protecting all the files, decided by the first one and their total size."""
+        stats = [os.stat(file) for file in files]
+        return self.for_file(os.path.relpath(files[0], directory), sum(stat.st_size for stat in stats),
+                             max(stat.st_mtime for stat in stats))
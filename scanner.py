@@ -0,0 +1,240 @@
+import hashlib
+import os
+import re
+import time
+from collections import Counter
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+from constants import EntryKind, GROUP_PREFIX
+from diskio import layout_key
+from par2format import RecoverySet, read_recovery_set
+
+VOL_REGEX = re.compile(r"vol\d+\+\d+")
+
+
+class ScanEntry(NamedTuple):
+    kind: EntryKind
+    path: str
+    parity_files: Tuple[str, ...] = ()
+    # what par2 is pointed at to verify or repair the file, the file itself or the index of its grouped recovery set
+    target: str = ""
+
+
+def scan_tree(directory: str, parity_root: Optional[str] = None) -> Iterator[ScanEntry]:
+    """Walk the directory with os.scandir and classify the files of each directory as soon as it was listed."""
+    for entries in scan_directories(directory, parity_root):
+        yield from entries
+
+
+def scan_directories(directory: str, parity_root: Optional[str] = None,
+                     timings: Optional[Counter] = None) -> Iterator[List[ScanEntry]]:
+    """Walk the directory with os.scandir and yield the classified entries of one directory at a time.
+
+    PAR2 files live beside their data files, so one listing is all that is needed to tell data files with and without
+    parity, orphaned PAR2 files and backups left by par2repair apart. With a parity root, the PAR2 files live in the
+    mirrored directory under it instead, which is listed alongside. PAR2 files left in the data tree are then orphans.
+    Seconds spent listing and classifying are added to timings under 'scan' and 'classify'.
+    """
+    if not os.path.exists(directory):
+        raise FileNotFoundError(directory)
+    if not os.path.isdir(directory):
+        raise NotADirectoryError(directory)
+
+    root = os.path.normpath(directory)
+    skipped = os.path.abspath(parity_root) if parity_root is not None else None
+    stack = [root]
+    while stack:
+        started = time.perf_counter()
+        current = stack.pop()
+        names = []
+        with os.scandir(current) as iterator:
+            for entry in iterator:
+                if entry.is_dir(follow_symlinks=False):
+                    if os.path.abspath(entry.path) != skipped:
+                        stack.append(_join(current, entry.name))
+                elif entry.is_file():
+                    names.append(entry.name)
+
+        stray_names = []
+        parity_directory = None
+        if parity_root is not None:
+            parity_directory = os.path.normpath(os.path.join(parity_root, os.path.relpath(current, root)))
+            stray_names = [name for name in names if name.endswith(".par2")]
+            names = [name for name in names if not name.endswith(".par2")] + list_parity(parity_directory)
+        listed = time.perf_counter()
+
+        entries = list(classify_directory(current, names, parity_directory)) \
+            + [ScanEntry(EntryKind.ORPHAN_PARITY, _join(current, name)) for name in stray_names]
+        if timings is not None:
+            timings["scan"] += listed - started
+            timings["classify"] += time.perf_counter() - listed
+        yield entries
+
+
+def list_parity(parity_directory: str) -> List[str]:
+    """Names of the PAR2 files in a directory of a parity store, empty if it does not exist."""
+    try:
+        with os.scandir(parity_directory) as iterator:
+            return [entry.name for entry in iterator if entry.name.endswith(".par2") and entry.is_file()]
+    except FileNotFoundError:
+        return []
+
+
+def classify_directory(directory: str, names: List[str],
+                       parity_directory: Optional[str] = None) -> Iterator[ScanEntry]:
+    """Classify the file names of a single directory in one pass over them.
+
+    PAR2 names are looked up in parity_directory when given, their targets keep pointing into the data directory.
+    Data files sharing a grouped recovery set are yielded one after another, so consumers can group them by target.
+    """
+    if parity_directory is None:
+        parity_directory = directory
+
+    data_names = set()
+    parity_names = []
+    for name in names:
+        if name.endswith(".par2"):
+            parity_names.append(name)
+        else:
+            data_names.add(name)
+
+    parity_of = {}
+    group_parity_of = {}
+    for name in parity_names:
+        data_name = parity_data_name(name)
+        if data_name.startswith(GROUP_PREFIX):
+            group_parity_of.setdefault(data_name, []).append(name)
+        elif data_name in data_names:
+            parity_of.setdefault(data_name, []).append(name)
+            yield ScanEntry(EntryKind.PARITY, _join(parity_directory, name))
+        else:
+            yield ScanEntry(EntryKind.ORPHAN_PARITY, _join(parity_directory, name))
+
+    grouped = set()
+    for group, group_parity_names in group_parity_of.items():
+        index = _join(directory, group + ".par2")
+        volumes = [_join(parity_directory, name) for name in sorted(group_parity_names) if name != group + ".par2"]
+        members = [name for name in group_members(_join(parity_directory, group + ".par2"), volumes)
+                   if name in data_names and name not in parity_of]
+        kind = EntryKind.PARITY if members else EntryKind.ORPHAN_PARITY
+        for name in group_parity_names:
+            yield ScanEntry(kind, _join(parity_directory, name))
+
+        group_parity_files = tuple(_join(parity_directory, name) for name in group_parity_names)
+        for name in members:
+            grouped.add(name)
+            yield ScanEntry(EntryKind.DATA_WITH_PARITY, _join(directory, name), group_parity_files, index)
+
+    for name in data_names:
+        if name in grouped:
+            continue
+        path = _join(directory, name)
+        if name in parity_of:
+            yield ScanEntry(EntryKind.DATA_WITH_PARITY, path,
+                            tuple(_join(parity_directory, parity_name) for parity_name in parity_of[name]), path)
+            continue
+
+        head, _, extension = name.rpartition(".")
+        if head in data_names and extension.isdigit():
+            yield ScanEntry(EntryKind.BACKUP, path)
+        else:
+            yield ScanEntry(EntryKind.DATA_WITHOUT_PARITY, path)
+
+
+def group_members(index: str, volumes: Optional[Sequence[str]] = None) -> List[str]:
+    """Names of the data files protected by a grouped recovery set, empty if neither its index nor its volumes are
+    readable. Every volume carries the description packets as well, so a set that lost its index is still found.
+    Volumes not given are looked up beside the index when it is needed."""
+    recovery_set = _read_recovery_set(index)
+    if recovery_set is None:
+        if volumes is None:
+            volumes = volume_files(index)
+        for volume in volumes:
+            recovery_set = _read_recovery_set(volume)
+            if recovery_set is not None:
+                break
+        else:
+            return []
+    return [recovery_set.files[file_id].name for file_id in recovery_set.main.recovery_file_ids
+            if file_id in recovery_set.files]
+
+
+def target_files(target: str, index: Optional[str] = None) -> List[str]:
+    """Data files par2 checks when pointed at the target, a data file or the index of a grouped recovery set.
+
+    The index is read from where it actually lives, when that is not the target itself.
+    """
+    if not target.endswith(".par2"):
+        return [target]
+    return [_join(os.path.dirname(target) or os.curdir, name) for name in group_members(index or target)]
+
+
+def group_name(names: Iterable[str]) -> str:
+    """Stable name of the recovery set protecting the given data file names."""
+    return GROUP_PREFIX + hashlib.md5("\n".join(sorted(names)).encode("utf-8", errors="surrogateescape")).hexdigest()
+
+
+def bucket_files(files: Iterable[str], max_size: int, max_files: int) -> Iterator[List[str]]:
+    """Collect consecutive files of the same directory into buckets of at most max_size bytes and max_files files.
+
+    The scan hands out files directory by directory, so buckets are yielded as soon as the walk leaves a directory.
+    A single file larger than max_size gets a bucket of its own.
+    """
+    bucket = []
+    bucket_size = 0
+    for file in files:
+        size = os.path.getsize(file)
+        if bucket and (os.path.dirname(file) != os.path.dirname(bucket[0]) or bucket_size + size > max_size
+                       or len(bucket) >= max_files):
+            yield bucket
+            bucket = []
+            bucket_size = 0
+        bucket.append(file)
+        bucket_size += size
+    if bucket:
+        yield bucket
+
+
+def volume_files(index: str) -> List[str]:
+    """The 'f.bin.vol00+10.par2' volumes beside the index 'f.bin.par2', whether or not the index itself exists."""
+    directory = os.path.dirname(index) or os.curdir
+    stem = os.path.basename(index)[:-len(".par2")]
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    return sorted(os.path.join(directory, name) for name in names
+                  if name.startswith(stem + ".") and name.endswith(".par2")
+                  and VOL_REGEX.fullmatch(name[len(stem) + 1:-len(".par2")]))
+
+
+def disk_order(entries: List[ScanEntry]) -> List[ScanEntry]:
+    """Entries of one directory with the data files in on-disk order. The members of a grouped recovery set stay
+    together, at the place of the member lying first."""
+    keys = {}
+    for entry in entries:
+        if entry.kind in (EntryKind.DATA_WITH_PARITY, EntryKind.DATA_WITHOUT_PARITY):
+            key = layout_key(entry.path)
+            target = entry.target or entry.path
+            keys[target] = min(keys.get(target, key), key)
+    return sorted(entries, key=lambda entry: keys.get(entry.target or entry.path, (3, 0)))
+
+
+def parity_data_name(parity_name: str) -> str:
+    """'f.bin.par2' and 'f.bin.vol00+50.par2' both belong to 'f.bin'."""
+    head = parity_name[:-len(".par2")]
+    data_name, _, volume = head.rpartition(".")
+    if data_name and VOL_REGEX.fullmatch(volume):
+        return data_name
+    return head
+
+
+def _read_recovery_set(par2_file: str) -> Optional[RecoverySet]:
+    try:
+        return read_recovery_set(par2_file)
+    except (OSError, ValueError):  # ValueError is mmap refusing a file truncated meanwhile
+        return None
+
+
+def _join(directory: str, name: str) -> str:
+    return name if directory == os.curdir else os.path.join(directory, name)
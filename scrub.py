@@ -0,0 +1,128 @@
+import hashlib
+import os
+import re
+import time
+from typing import Optional, Set, Tuple
+
+from constants import FileStatus
+
+BUDGET_REGEX = re.compile(r"(\d+(?:\.\d+)?)\s*([smhd]|[KMGT](?:i?B)?|B)")
+TIME_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+SIZE_UNITS = {"B": 1, "K": 2 ** 10, "M": 2 ** 20, "G": 2 ** 30, "T": 2 ** 40}
+
+JOURNAL_HEADER = "# par2tortilla checkpoint"
+# statuses of a check that ran to its end, targets that timed out or failed are left for the resumed run
+COMPLETED = frozenset({FileStatus.OK, FileStatus.REPAIRABLE, FileStatus.REPAIRED, FileStatus.FUBAR,
+                       FileStatus.CREATED})
+
+
+def parse_shard(shard: str) -> Tuple[int, int]:
+    """'3/7' is the third of seven shards, returned as (3, 7)."""
+    try:
+        k, n = (int(part) for part in shard.split("/"))
+    except ValueError:
+        raise ValueError(f"Invalid shard '{shard}', expected K/N.")
+    if not 1 <= k <= n:
+        raise ValueError(f"Invalid shard '{shard}', K has to be between 1 and N.")
+    return k, n
+
+
+def in_shard(path: str, shard: Tuple[int, int]) -> bool:
+    """Stable partition of paths, the same path lands in the same shard on every machine and every run.
+
+    The path should be relative to the scanned directory, so that nodes mounting the tree elsewhere agree.
+    """
+    k, n = shard
+    digest = hashlib.md5(path.replace(os.sep, "/").encode("utf-8", errors="surrogateescape")).digest()
+    return int.from_bytes(digest[:8], "little") % n == k - 1
+
+
+class Budget:
+    """Limit of time or bytes a single invocation may spend.
+
+    Lowercase units are time ('90m', '6h', '1d'), uppercase ones binary sizes ('500M', '20G', '2TiB').
+    """
+
+    def __init__(self, budget: Optional[str]):
+        self.seconds = None
+        self.size = None
+        self.started = time.monotonic()
+        self.spent = 0
+        if budget is None:
+            return
+
+        match = BUDGET_REGEX.fullmatch(budget.strip())
+        if match is None:
+            raise ValueError(f"Invalid budget '{budget}', expected e.g. '6h' or '500G'.")
+        value, unit = float(match.group(1)), match.group(2)
+        if unit in TIME_UNITS:
+            self.seconds = value * TIME_UNITS[unit]
+        else:
+            self.size = int(value * SIZE_UNITS[unit[0]])
+
+    def spend(self, size: int):
+        self.spent += size
+
+    def out_of_time(self) -> bool:
+        return self.seconds is not None and time.monotonic() - self.started >= self.seconds
+
+    def exhausted(self) -> bool:
+        return self.out_of_time() or self.size is not None and self.spent >= self.size
+
+
+class Journal:
+    """Append-only record of the targets done in the current pass over a directory.
+
+    Each finished target is flushed as one line, so a killed run loses nothing it finished. Once a pass went over
+    the whole directory the journal is removed and the next run starts a new pass.
+    """
+
+    def __init__(self, journal_path: str, directory: str, shard: Optional[Tuple[int, int]]):
+        self.journal_path = journal_path
+        self.directory = directory
+        self.header = f"{JOURNAL_HEADER} {os.path.abspath(directory)} shard {'%d/%d' % shard if shard else 'all'}"
+        self.done: Set[str] = set()
+
+        if os.path.exists(journal_path):
+            with open(journal_path, "r", encoding="utf-8", errors="surrogateescape") as f:
+                header = f.readline().rstrip("\n")
+                if header != self.header:
+                    raise ValueError(f"Checkpoint '{journal_path}' belongs to another scrub: {header}")
+                line = ""
+                for line in f:
+                    _, tab, relative = line.rstrip("\n").partition("\t")
+                    if line.endswith("\n") and tab:  # a line cut short by a crash is skipped, its target done again
+                        self.done.add(relative)
+            self.file = open(journal_path, "a", encoding="utf-8", errors="surrogateescape")
+            if line and not line.endswith("\n"):
+                self.file.write("\n")
+        else:
+            self.file = open(journal_path, "w", encoding="utf-8", errors="surrogateescape")
+            self.file.write(self.header + "\n")
+            self.file.flush()
+
+    def owns(self, file: str) -> bool:
+        return os.path.abspath(file) == os.path.abspath(self.journal_path)
+
+    def relative(self, target: str) -> str:
+        return os.path.relpath(target, self.directory)
+
+    def is_done(self, target: str) -> bool:
+        return self.relative(target) in self.done
+
+    def record(self, target: str, status: FileStatus):
+        """Mark the target done, unless its check did not complete."""
+        if status not in COMPLETED:
+            return
+        relative = self.relative(target)
+        self.done.add(relative)
+        self.file.write(f"{status.name}\t{relative}\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def finish(self):
+        """The pass went over everything, forget it."""
+        self.close()
+        os.remove(self.journal_path)
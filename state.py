@@ -0,0 +1,174 @@
+import os
+import sqlite3
+import time
+from typing import Dict, Iterable, Iterator, Optional, Set, Tuple
+
+from constants import FileStatus
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS directories (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS files (
+    directory_id INTEGER NOT NULL REFERENCES directories (id),
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    parity_files TEXT NOT NULL,
+    verified_at REAL,
+    status INTEGER,
+    PRIMARY KEY (directory_id, name)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS files_status ON files (status);
+CREATE TABLE IF NOT EXISTS summary (
+    directory TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value INTEGER NOT NULL,
+    PRIMARY KEY (directory, key)
+);
+"""
+
+INSERT_FILE = ("INSERT OR REPLACE INTO files (directory_id, name, size, mtime_ns, inode, parity_files, verified_at, "
+               "status) VALUES (?, ?, ?, ?, ?, ?, ?, ?)")
+
+SQLITE_SUFFIXES = ("", "-journal", "-wal", "-shm")
+COMMIT_EVERY = 1000  # verify results per transaction, a killed run loses at most that many
+
+
+class StateDB:
+    """Persistent index of data files, their stat info and the result of their last verification.
+
+    Directories are interned, a file is stored as the id of its directory and its name, so the path of a directory
+    holding thousands of files is stored once.
+    """
+
+    def __init__(self, db_path: str, commit_every: int = COMMIT_EVERY):
+        self.db_path = os.path.abspath(db_path)
+        self.connection = sqlite3.connect(self.db_path)
+        self.directory_ids: Dict[str, int] = {}
+        self.commit_every = commit_every
+        self.uncommitted = 0
+        self.connection.executescript(SCHEMA)
+
+    def _directory_id(self, directory: str, create: bool) -> Optional[int]:
+        if directory in self.directory_ids:
+            return self.directory_ids[directory]
+        row = self.connection.execute("SELECT id FROM directories WHERE path = ?", (directory,)).fetchone()
+        if row is None:
+            if not create:
+                return None
+            row = (self.connection.execute("INSERT INTO directories (path) VALUES (?)", (directory,)).lastrowid,)
+        self.directory_ids[directory] = row[0]
+        return row[0]
+
+    def _key(self, file: str, create: bool = False) -> Tuple[Optional[int], str]:
+        directory, name = os.path.split(os.path.abspath(file))
+        return self._directory_id(directory, create), name
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+    def owns(self, file: str) -> bool:
+        """True if the file is the database itself or one of its sqlite side files."""
+        return os.path.abspath(file) in {self.db_path + suffix for suffix in SQLITE_SUFFIXES}
+
+    def is_due(self, file: str, stat: os.stat_result, parity_files: Iterable[str], reverify_after_days: float,
+               now: Optional[float] = None) -> bool:
+        """Decide whether a file has to be verified again.
+
+        A file is due when it was never verified, when its last result was not OK, when its stat info or set of
+        parity files changed since, or when the last verification is older than reverify_after_days.
+        """
+        key = self._key(file)
+        row = self.connection.execute(
+            "SELECT size, mtime_ns, inode, parity_files, verified_at, status FROM files "
+            "WHERE directory_id = ? AND name = ?", key).fetchone() if key[0] is not None else None
+        if row is None:
+            return True
+
+        size, mtime_ns, inode, known_parity_files, verified_at, status = row
+        if verified_at is None or status != FileStatus.OK.value:
+            return True
+        if (size, mtime_ns, inode) != (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+            return True
+        if known_parity_files != _join_parity_files(parity_files):
+            return True
+
+        now = time.time() if now is None else now
+        return now - verified_at >= reverify_after_days * 86400
+
+    def record_verify(self, file: str, stat: os.stat_result, parity_files: Iterable[str], status: FileStatus,
+                      verified_at: Optional[float] = None):
+        self.connection.execute(INSERT_FILE, self._key(file, create=True) + (
+            stat.st_size, stat.st_mtime_ns, stat.st_ino, _join_parity_files(parity_files),
+            time.time() if verified_at is None else verified_at, status.value))
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self.connection.commit()
+        self.uncommitted = 0
+
+    def forget_missing(self, directory: str, names: Iterable[str]):
+        """Drop the rows of files of the directory that are not among the names it holds now."""
+        directory_id = self._directory_id(os.path.abspath(directory), create=False)
+        if directory_id is None:
+            return
+        known = {name for name, in self.connection.execute("SELECT name FROM files WHERE directory_id = ?",
+                                                           (directory_id,))}
+        self.connection.executemany("DELETE FROM files WHERE directory_id = ? AND name = ?",
+                                    [(directory_id, name) for name in known.difference(names)])
+
+    def forget_directories(self, directory: str, seen: Set[str]):
+        """Drop the rows of the directories under the directory that a complete scan did not find files in."""
+        directory = os.path.abspath(directory)
+        prefix = directory.rstrip(os.sep) + os.sep
+        rows = self.connection.execute(
+            "SELECT id, path FROM directories WHERE path = ? OR substr(path, 1, ?) = ?",
+            (directory, len(prefix), prefix)).fetchall()
+        gone = [(directory_id, path) for directory_id, path in rows if path not in seen]
+        self.connection.executemany("DELETE FROM files WHERE directory_id = ?", [row[:1] for row in gone])
+        self.connection.executemany("DELETE FROM directories WHERE id = ?", [row[:1] for row in gone])
+        for _, path in gone:
+            self.directory_ids.pop(path, None)
+        self.commit()
+
+    def files_with_status(self, directory: str, status: FileStatus) -> Iterator[str]:
+        """Stream the files under the directory whose last verification ended with the status."""
+        directory = os.path.abspath(directory)
+        prefix = directory.rstrip(os.sep) + os.sep
+        cursor = self.connection.execute(
+            "SELECT directories.path, files.name FROM files JOIN directories ON directories.id = files.directory_id "
+            "WHERE files.status = ? AND (directories.path = ? OR substr(directories.path, 1, ?) = ?)",
+            (status.value, directory, len(prefix), prefix))
+        for path, name in cursor:
+            yield os.path.join(path, name)
+
+    def record_summary(self, directory: str, counts: Dict[str, int]):
+        directory = os.path.abspath(directory)
+        self.connection.execute("DELETE FROM summary WHERE directory = ?", (directory,))
+        self.connection.executemany("INSERT INTO summary (directory, key, value) VALUES (?, ?, ?)",
+                                    [(directory, key, value) for key, value in counts.items()])
+        self.commit()
+
+    def summary(self, directory: str) -> Optional[Dict[str, int]]:
+        """Counts recorded by the last scan of the directory, None if it was never scanned."""
+        rows = self.connection.execute("SELECT key, value FROM summary WHERE directory = ?",
+                                       (os.path.abspath(directory),)).fetchall()
+        if not rows:
+            return None
+        return dict(rows)
+
+
+def _join_parity_files(parity_files: Iterable[str]) -> str:
+    return "\n".join(sorted(os.path.basename(f) for f in parity_files))
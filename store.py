@@ -0,0 +1,82 @@
+import os
+import shutil
+from typing import List, Tuple
+
+from constants import EntryKind
+from scanner import scan_directories
+
+
+class ParityStore:
+    """PAR2 files kept under a separate root instead of beside the data, in directories mirroring the data tree.
+
+    Paths handed around stay the ones of the data tree, the store maps them to where their parity lives. par2 is
+    pointed at the parity there and told with -B where the data is.
+    """
+
+    def __init__(self, root: str, directory: str):
+        self.root = root
+        self.directory = directory
+
+    def locate(self, path: str) -> str:
+        """Where a path of the data tree is mirrored in the store."""
+        return os.path.normpath(os.path.join(self.root, os.path.relpath(path, self.directory)))
+
+    def index(self, target: str) -> str:
+        """Index file of the recovery set of a target, a data file or the index of a grouped recovery set."""
+        return self.locate(target if target.endswith(".par2") else target + ".par2")
+
+    def create_index(self, target: str) -> str:
+        """Like index, but creates the directory the recovery set is about to be written to."""
+        index = self.index(target)
+        os.makedirs(os.path.dirname(index), exist_ok=True)
+        return index
+
+    def owns(self, path: str) -> bool:
+        root = os.path.abspath(self.root)
+        return os.path.commonpath([root, os.path.abspath(path)]) == root
+
+
+def base_path(target: str) -> str:
+    """Directory par2 resolves the data file names of a recovery set against."""
+    return os.path.dirname(target) or os.curdir
+
+
+def move_files(moves: List[Tuple[str, str]]) -> Tuple[int, List[str]]:
+    """Move files, renaming them where source and destination share a file system and copying them otherwise.
+
+    Existing destinations are never overwritten, they are returned as conflicts and their sources stay in place.
+    """
+    moved = 0
+    conflicts = []
+    for source, destination in moves:
+        if os.path.exists(destination):
+            conflicts.append(destination)
+            continue
+        os.makedirs(os.path.dirname(destination) or os.curdir, exist_ok=True)
+        shutil.move(source, destination)
+        moved += 1
+    return moved, conflicts
+
+
+def split(directory: str, store: ParityStore) -> Tuple[int, List[str]]:
+    """Move every PAR2 file of the data tree into the store."""
+    moves = []
+    for entries in scan_directories(directory):
+        moves += [(entry.path, store.locate(entry.path)) for entry in entries
+                  if entry.kind in (EntryKind.PARITY, EntryKind.ORPHAN_PARITY) and not store.owns(entry.path)]
+    return move_files(moves)
+
+
+def merge(directory: str, store: ParityStore) -> Tuple[int, List[str]]:
+    """Move every PAR2 file of the store back beside the data and remove the store directories left empty."""
+    moves = []
+    for current, _, names in os.walk(store.root):
+        relative = os.path.relpath(current, store.root)
+        moves += [(os.path.join(current, name), os.path.normpath(os.path.join(directory, relative, name)))
+                  for name in names if name.endswith(".par2")]
+    result = move_files(moves)
+
+    for current, _, _ in os.walk(store.root, topdown=False):
+        if not os.listdir(current):
+            os.rmdir(current)
+    return result
@@ -1,13 +1,44 @@
+import asyncio
+import hashlib
+import json
 import os
+import random
+import struct
+import sqlite3
 import subprocess
+import sys
+import time
 import unittest
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+from functools import partial
+
 from click.testing import CliRunner
 
+import api
+import benchmark
 import par2tortilla
-from constants import DEFAULT_PARITY_FILE_COUNT, DEFAULT_BLOCK_COUNT, DEFAULT_REDUNDANCY
-from utils import corrupt_file, par2create, glob_files
+import content
+import dedup
+import diskio
+import engine
+import faults
+import metrics
+import par2encode
+import par2format
+import policy
+import scrub
+import throttle
+import utils
+import watch
+from constants import DEFAULT_PARITY_FILE_COUNT, DEFAULT_BLOCK_COUNT, DEFAULT_REDUNDANCY, GROUP_PREFIX, DuplicateKind, \
+    EntryKind, FileStatus, Resources, SetHealth
+from scanner import ScanEntry, bucket_files, classify_directory, disk_order, group_name, scan_tree, target_files
+from state import StateDB
+from store import ParityStore
+from utils import corrupt_file, group_index, par2create, glob_files
 
 CWD = None
 TEST_FILE_SIZE = 2 ** 20
@@ -98,6 +129,46 @@ def par2verify_test(file: str, expect_damage: bool, repair_possible: bool):
             assert b"Repair is not possible" in stdout, "repair should not be possible but message not found"
 
 
+def par2_packet(recovery_set_id: bytes, packet_type: bytes, body: bytes) -> bytes:
+    body += b"\0" * (-len(body) % 4)
+    tail = recovery_set_id + packet_type + body
+    return par2format.MAGIC + struct.pack("<Q", 64 + len(body)) + hashlib.md5(tail).digest() + tail
+
+
+def write_par2_index(file_name: str, slice_size: int = 4096):
+    """A minimal hand made 'file.par2' with main, file description and IFSC packets."""
+    write_par2_set(file_name + ".par2", [file_name], slice_size)
+
+
+def write_par2_set(index_file: str, file_names: list, slice_size: int = 4096):
+    """A minimal hand made recovery set index protecting files of the index's directory."""
+    file_ids = []
+    packets = []
+    for file_name in file_names:
+        with open(file_name, "rb") as f:
+            data = f.read()
+        name = os.path.basename(file_name).encode()
+        md5_16k = hashlib.md5(data[:par2format.HASH_16K_SIZE]).digest()
+        file_id = hashlib.md5(md5_16k + struct.pack("<Q", len(data)) + name).digest()
+        file_ids.append(file_id)
+
+        checksums = b""
+        for offset in range(0, len(data), slice_size):
+            piece = data[offset:offset + slice_size].ljust(slice_size, b"\0")
+            checksums += hashlib.md5(piece).digest() + struct.pack("<I", 0)
+
+        packets.append((par2format.FILE_DESC_TYPE,
+                        file_id + hashlib.md5(data).digest() + md5_16k + struct.pack("<Q", len(data)) + name))
+        packets.append((par2format.IFSC_TYPE, file_id + checksums))
+
+    main_body = struct.pack("<QI", slice_size, len(file_ids)) + b"".join(file_ids)
+    recovery_set_id = hashlib.md5(main_body).digest()
+    with open(index_file, "wb") as f:
+        f.write(par2_packet(recovery_set_id, par2format.MAIN_TYPE, main_body))
+        for packet_type, body in packets:
+            f.write(par2_packet(recovery_set_id, packet_type, body))
+
+
 class TestsPar2Baseline(unittest.TestCase):
     """Some basic tests testing almost only the behavior of par2."""
 
@@ -208,6 +279,55 @@ class TestsPar2TortillaRun(unittest.TestCase):
             assert f"PAR2 files without data files: {self.context.parity_file_count + 1}" in result.output
             assert f"Data file backups (?) created by par2repair: 0" in result.output
 
+    def test_create_verify_created(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            self.context.create_test_data()
+            result = runner.invoke(par2tortilla.main, ["run", "--create", "--verify-created", "./"])
+            assert result.exit_code == 0
+            assert f"Created parities verified OK: {len(self.context.test_files)}/{len(self.context.test_files)}" \
+                   in result.output
+
+    def test_create_grouped(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            self.context.create_test_data()
+            result = runner.invoke(par2tortilla.main, ["run", "--create", "--group", "./"])
+            assert result.exit_code == 0
+
+            directory_count = len({os.path.dirname(f) for f in self.context.test_files})
+            result = runner.invoke(par2tortilla.main, ["run", "./"])
+            assert result.exit_code == 0
+            assert f"Data files with parity: {len(self.context.test_files)}" in result.output
+            assert f"Data files without parity: 0" in result.output
+            assert f"PAR2 files: {directory_count * (self.context.parity_file_count + 1)}" in result.output
+
+            self.context.corrupt_test_data(1)
+            result = runner.invoke(par2tortilla.main, ["run", "--verify", "--repair", "./"])
+            assert result.exit_code == 0
+            assert f"Files that are damaged but repairable: {len(self.context.test_files)}" in result.output
+            assert f"Repaired {len(self.context.test_files)}/{len(self.context.test_files)} files." in result.output
+            assert f"Grouped recovery sets that are damaged but repairable: {directory_count}" in result.output
+            assert f"Repaired {directory_count}/{directory_count} grouped recovery sets." in result.output
+
+    def test_repair_grouped_one_damaged(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            Path("d").mkdir()
+            for i in range(3):
+                Path(f"d/f{i}.bin").write_bytes(os.urandom(TEST_FILE_SIZE))
+            result = runner.invoke(par2tortilla.main, ["run", "--create", "--group", "d"])
+            assert result.exit_code == 0
+
+            corrupt_file("d/f1.bin", 5, seed=1)
+            result = runner.invoke(par2tortilla.main, ["run", "--verify", "--repair", "d"])
+            assert result.exit_code == 0
+            assert "Files that are damaged but repairable: 1" in result.output
+            assert "Files that are OK: 2" in result.output
+            assert "Repaired 1/1 files." in result.output
+            assert "Grouped recovery sets that are damaged but repairable: 1" in result.output
+            assert "Repaired 1/1 grouped recovery sets." in result.output
+
     def test_create_no_files(self):
         runner = CliRunner()
         with runner.isolated_filesystem():
@@ -295,6 +415,8 @@ class TestsPar2TortillaRun(unittest.TestCase):
             result = runner.invoke(par2tortilla.main, ["run", "--verify", "--repair", "./"])
             assert result.exit_code == 0
             assert f"Repaired {len(self.context.test_files)}/{len(self.context.test_files)} files." in result.output
+            assert f"Files verified OK after repair: {len(self.context.test_files)}/{len(self.context.test_files)}" \
+                   in result.output
 
             result = runner.invoke(par2tortilla.main, ["run", "--verify", "./"])
             assert result.exit_code == 0
@@ -332,5 +454,1465 @@ class TestsPar2TortillaRun(unittest.TestCase):
             assert f"Data file backups (?) created by par2repair: {len(self.context.test_files)}" in result.output
 
 
+class TestsScanner(unittest.TestCase):
+
+    def setUp(self):
+        self.context = Context()
+
+    def test_scan_matches_glob(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            self.context.create_test_data()
+            entries = list(scan_tree("./"))
+            assert {entry.path for entry in entries} == self.context.globbed_files
+            assert {entry.kind for entry in entries} == {EntryKind.DATA_WITHOUT_PARITY}
+
+    def test_classify_directory(self):
+        names = ["f.bin", "f.bin.par2", "f.bin.vol00+25.par2", "f.bin.vol25+25.par2", "f.bin.1",
+                 "g.bin", "h.bin.par2", "h.bin.vol0+1.par2", "x.vol0+1"]
+        kinds = {entry.path: entry.kind for entry in classify_directory("d", names)}
+        assert kinds == {os.path.join("d", "f.bin"): EntryKind.DATA_WITH_PARITY,
+                         os.path.join("d", "f.bin.par2"): EntryKind.PARITY,
+                         os.path.join("d", "f.bin.vol00+25.par2"): EntryKind.PARITY,
+                         os.path.join("d", "f.bin.vol25+25.par2"): EntryKind.PARITY,
+                         os.path.join("d", "f.bin.1"): EntryKind.BACKUP,
+                         os.path.join("d", "g.bin"): EntryKind.DATA_WITHOUT_PARITY,
+                         os.path.join("d", "h.bin.par2"): EntryKind.ORPHAN_PARITY,
+                         os.path.join("d", "h.bin.vol0+1.par2"): EntryKind.ORPHAN_PARITY,
+                         os.path.join("d", "x.vol0+1"): EntryKind.DATA_WITHOUT_PARITY}
+
+        parity = [entry.parity_files for entry in classify_directory("d", names) if entry.path.endswith("f.bin")][0]
+        assert len(parity) == 3
+
+    def test_scan_grouped(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            self.context.create_test_data()
+            members = ["a1/f1.bin", "a1/f2.bin"]
+            index = os.path.join("a1", group_name(os.path.basename(f) for f in members) + ".par2")
+            write_par2_set(index, members)
+            Path(index[:-len(".par2")] + ".vol00+10.par2").touch()
+
+            entries = list(scan_tree("./"))
+            kinds = {entry.path: entry.kind for entry in entries}
+            assert kinds[index] == EntryKind.PARITY
+            assert [entry.path for entry in entries if entry.kind == EntryKind.DATA_WITH_PARITY] == members
+            assert {entry.target for entry in entries if entry.kind == EntryKind.DATA_WITH_PARITY} == {index}
+            assert par2format.verify_in_process(index)
+
+            result = runner.invoke(par2tortilla.main, ["run", "./"])
+            assert result.exit_code == 0
+            assert f"Data files with parity: 2" in result.output
+            assert f"Data files without parity: {len(self.context.test_files) - 2}" in result.output
+            assert f"PAR2 files: 2" in result.output
+            assert f"PAR2 files without data files: 0" in result.output
+
+            for file_name in members:
+                Path(file_name).unlink()
+            kinds = {entry.path: entry.kind for entry in scan_tree("./")}
+            assert kinds[index] == EntryKind.ORPHAN_PARITY
+
+    def test_bucket_files(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            self.context.create_test_data()
+            files = [entry.path for entry in scan_tree("./")]
+            buckets = list(bucket_files(files, 2 * TEST_FILE_SIZE, 10))
+            assert sorted(f for bucket in buckets for f in bucket) == sorted(files)
+            for bucket in buckets:
+                assert len(bucket) <= 2
+                assert len({os.path.dirname(f) for f in bucket}) == 1
+            assert max(len(bucket) for bucket in bucket_files(files, 10 * TEST_FILE_SIZE, 1)) == 1
+
+    def test_scan_missing_directory(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            with self.assertRaises(FileNotFoundError):
+                list(scan_tree("missing/"))
+            Path("file").touch()
+            with self.assertRaises(NotADirectoryError):
+                list(scan_tree("file"))
+
+
+class TestsPar2Format(unittest.TestCase):
+
+    def setUp(self):
+        self.context = Context()
+
+    def test_read_recovery_set(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            self.context.create_test_data()
+            file_name = self.context.test_files[0]
+            write_par2_index(file_name)
+
+            recovery_set = par2format.read_recovery_set(file_name + ".par2")
+            assert recovery_set.main.slice_size == 4096
+            assert len(recovery_set.main.recovery_file_ids) == 1
+            description = recovery_set.files[recovery_set.main.recovery_file_ids[0]]
+            assert description.name == os.path.basename(file_name)
+            assert description.length == TEST_FILE_SIZE
+            assert len(recovery_set.checksums[description.file_id]) == TEST_FILE_SIZE // 4096
+
+    def test_verify_in_process(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            self.context.create_test_data()
+            for file_name in self.context.test_files:
+                write_par2_index(file_name)
+                assert par2format.verify_in_process(file_name)
+
+            corrupt_file(self.context.test_files[0], 0.001)
+            assert not par2format.verify_in_process(self.context.test_files[0])
+
+            with open(self.context.test_files[1], "ab") as f:
+                f.write(b"\0")
+            assert not par2format.verify_in_process(self.context.test_files[1])
+
+            Path(self.context.test_files[2] + ".par2").unlink()
+            assert not par2format.verify_in_process(self.context.test_files[2])
+
+    def test_mismatched_files(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            Path("d").mkdir()
+            members = [f"d/f{i}.bin" for i in range(3)]
+            for name in members:
+                Path(name).write_bytes(os.urandom(10000))
+            index = os.path.join("d", group_name(os.path.basename(f) for f in members) + ".par2")
+            write_par2_set(index, members)
+            assert par2format.mismatched_files(index) == []
+
+            corrupt_file(members[1], 5)
+            assert par2format.mismatched_files(index) == [members[1]]
+            assert par2format.mismatched_files("d/missing.par2") is None
+
+            damaged = asyncio.run(engine.damaged_members(index))
+            assert damaged == (os.path.abspath(members[1]),)
+
+    def test_damaged_packet_is_skipped(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            self.context.create_test_data()
+            file_name = self.context.test_files[0]
+            write_par2_index(file_name)
+
+            with open(file_name + ".par2", "rb+") as f:
+                f.seek(70)
+                f.write(b"\xff")
+            assert par2format.read_recovery_set(file_name + ".par2") is None
+            assert not par2format.verify_in_process(file_name)
+
+    def test_verify_in_process_par2_created(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            self.context.create_test_data()
+            self.context.create_parity_for_test_data()
+            for file_name in self.context.globbed_files:
+                assert par2format.verify_in_process(file_name)
+            self.context.corrupt_test_data(5)
+            for file_name in self.context.globbed_files:
+                assert not par2format.verify_in_process(file_name)
+
+
+class TestsEngine(unittest.TestCase):
+
+    def test_run_unordered(self):
+        running = []
+        peak = []
+
+        async def job(item: int) -> int:
+            running.append(item)
+            peak.append(len(running))
+            await asyncio.sleep(0.01 * (item % 3))
+            running.remove(item)
+            return item * 2
+
+        results = dict(engine.run_unordered(job, iter(range(20)), 4))
+        assert results == {i: i * 2 for i in range(20)}
+        assert max(peak) == 4
+
+    def test_run_unordered_close_cancels(self):
+        cancelled = []
+
+        async def job(item: int) -> int:
+            try:
+                await asyncio.sleep(0 if item == 0 else 10)
+            except asyncio.CancelledError:
+                cancelled.append(item)
+                raise
+            return item
+
+        results = engine.run_unordered(job, range(5), 3)
+        assert next(results) == (0, 0)
+        results.close()
+        assert sorted(cancelled) == [1, 2]
+
+    def test_verify_chain(self):
+        statuses = {"ok": [FileStatus.OK], "fixable": [FileStatus.REPAIRABLE, FileStatus.OK],
+                    "broken": [FileStatus.FUBAR], "stubborn": [FileStatus.REPAIRABLE]}
+        calls = []
+
+        async def verify(target: str, resources: Resources = None) -> FileStatus:
+            calls.append(("verify", target))
+            return statuses[target].pop(0)
+
+        async def repair(target: str, resources: Resources = None) -> FileStatus:
+            calls.append(("repair", target))
+            return FileStatus.REPAIRED if target == "fixable" else FileStatus.FUBAR
+
+        chains = [partial(engine.verify_chain, target, verify, repair) for target in statuses]
+        results = {result.target: result for _, result in engine.run_unordered(lambda chain: chain(), chains, 2)}
+        assert results["ok"] == engine.ChainResult("ok", verified=FileStatus.OK)
+        assert results["fixable"] == engine.ChainResult("fixable", verified=FileStatus.REPAIRABLE,
+                                                        repaired=FileStatus.REPAIRED, reverified=FileStatus.OK)
+        assert results["broken"] == engine.ChainResult("broken", verified=FileStatus.FUBAR)
+        assert results["stubborn"] == engine.ChainResult("stubborn", verified=FileStatus.REPAIRABLE,
+                                                         repaired=FileStatus.FUBAR)
+        assert calls.count(("verify", "fixable")) == 2
+
+        statuses["fixable"] = [FileStatus.REPAIRABLE]
+        result = asyncio.run(engine.verify_chain("fixable", verify))
+        assert result == engine.ChainResult("fixable", verified=FileStatus.REPAIRABLE)
+
+        async def damaged(target: str) -> tuple:
+            calls.append(("damaged", target))
+            return "/m1",
+
+        statuses.update(ok=[FileStatus.OK], fixable=[FileStatus.REPAIRABLE, FileStatus.OK])
+        assert asyncio.run(engine.verify_chain("ok", verify, repair, damaged=damaged)).damaged is None
+        result = asyncio.run(engine.verify_chain("fixable", verify, repair, damaged=damaged))
+        assert result.damaged == ("/m1",) and result.reverified == FileStatus.OK
+        assert calls[-4:] == [("verify", "fixable"), ("damaged", "fixable"), ("repair", "fixable"),
+                              ("verify", "fixable")]
+
+    def test_create_chain(self):
+        async def create(resources: Resources = None) -> FileStatus:
+            return FileStatus.CREATED
+
+        async def verify(target: str, resources: Resources = None) -> FileStatus:
+            return FileStatus.OK
+
+        assert asyncio.run(engine.create_chain("f", create)) == engine.ChainResult("f", created=FileStatus.CREATED)
+        assert asyncio.run(engine.create_chain("f", create, verify)) == \
+               engine.ChainResult("f", created=FileStatus.CREATED, verified=FileStatus.OK)
+
+    def test_par2_resources(self):
+        budget = Resources(8, 1024)
+        assert engine.par2_resources(4 * 2 ** 20, budget) == Resources(1, 16)
+        assert engine.par2_resources(600 * 2 ** 20, budget) == Resources(3, 600)
+        assert engine.par2_resources(100 * 2 ** 30, budget) == Resources(8, 1024)
+
+    def test_run_scheduled(self):
+        budget = Resources(4, 4096)
+        started = []
+        running = []
+        peak_threads = []
+
+        async def job(item: str, resources: Resources) -> Resources:
+            started.append(item)
+            running.append(resources.threads)
+            peak_threads.append(sum(running))
+            await asyncio.sleep(0.01)
+            running.remove(resources.threads)
+            return resources
+
+        sizes = {"tiny1": 2 ** 20, "huge": 2 ** 31, "tiny2": 2 ** 20, "big": 2 ** 29, "tiny3": 2 ** 20}
+        results = dict(engine.run_scheduled(job, sizes.items(), 10, budget, 100))
+        assert started == ["huge", "big", "tiny1", "tiny2", "tiny3"]
+        assert results["huge"] == Resources(4, 2048)
+        assert results["tiny1"].threads == 1
+        assert max(peak_threads) <= budget.threads
+
+        started.clear()
+        list(engine.run_scheduled(job, sizes.items(), 10, budget, 1))
+        assert started[0] == "tiny1"
+
+        started.clear()
+        list(engine.run_scheduled(job, sizes.items(), 10, budget, 100, ordered=True))
+        assert started == list(sizes)
+
+    def test_run_par2_timeout(self):
+        start = time.monotonic()
+        sleeper = (sys.executable, "-c", "import time; time.sleep(10)")
+        results = dict(engine.run_unordered(lambda args: engine.run_par2(list(args), 0.2), [sleeper], 1))
+        assert results == {sleeper: None}
+        assert time.monotonic() - start < 5
+
+        echo = (sys.executable, "-c", "print('hi')")
+        stdout, stderr = list(engine.run_unordered(lambda args: engine.run_par2(list(args), None), [echo], 1))[0][1]
+        assert stdout.strip() == b"hi"
+        assert stderr == b""
+
+    def test_par2_failed(self):
+        reported = []
+        assert utils.par2create_status("f", b"", b"", reported.append) == FileStatus.CREATED
+        assert utils.par2create_status("f", b"", b"disk full", reported.append) == FileStatus.FAILED
+        assert utils.par2verify_status("f", b"All files are correct, repair is not required", b"",
+                                       reported.append) == FileStatus.OK
+        assert utils.par2verify_status("f", b"something else", b"", reported.append) == FileStatus.FAILED
+        assert utils.par2repair_status("f", b"", b"oops", reported.append) == FileStatus.FAILED
+        assert len(reported) == 3
+        assert "disk full" in reported[0]
+
+        with CliRunner().isolated_filesystem():
+            Path("d").mkdir()
+            Path("d/f").write_bytes(b"data")
+            failing = (sys.executable, "-c", "import sys; sys.stderr.write('no space left')")  # par2 args go to argv
+            status = asyncio.run(engine.par2create("d/f", 1, 5, 1, priority=failing, report=reported.append))
+            assert status == FileStatus.FAILED
+            assert "no space left" in reported[-1]
+
+
+class TestsContentAddressed(unittest.TestCase):
+
+    def test_sha256_matches_name(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            data = os.urandom(TEST_FILE_SIZE)
+            digest = hashlib.sha256(data).hexdigest()
+            Path("data/00").mkdir(parents=True)
+            file_name = os.path.join("data/00", digest)
+            with open(file_name, "wb") as f:
+                f.write(data)
+            empty_name = hashlib.sha256(b"").hexdigest()
+            Path(empty_name).touch()
+
+            assert content.is_content_addressed(file_name)
+            assert not content.is_content_addressed("data/00/f0.bin")
+            assert content.sha256_matches_name(file_name)
+            assert content.sha256_matches_name(empty_name)
+            assert content.content_matches([file_name, empty_name])
+            assert not content.content_matches([])
+
+            status = asyncio.run(engine.par2verify(file_name, content_addressed=True))
+            assert status == FileStatus.OK
+
+            corrupt_file(file_name, 0.01)
+            assert not content.sha256_matches_name(file_name)
+            assert not content.content_matches([file_name, empty_name])
+            assert not content.sha256_matches_name("missing")
+
+    def test_target_files(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            Path("d").mkdir()
+            members = []
+            for data in (b"a", b"b"):
+                members.append(os.path.join("d", hashlib.sha256(data).hexdigest()))
+                with open(members[-1], "wb") as f:
+                    f.write(data)
+            index = os.path.join("d", group_name(os.path.basename(f) for f in members) + ".par2")
+            write_par2_set(index, members)
+
+            assert target_files(members[0]) == [members[0]]
+            assert sorted(target_files(index)) == sorted(members)
+            assert content.content_matches(target_files(index))
+
+
+class TestsScrub(unittest.TestCase):
+
+    def setUp(self):
+        self.context = Context()
+
+    def test_shard(self):
+        assert scrub.parse_shard("3/7") == (3, 7)
+        for invalid in ["0/7", "8/7", "3", "a/b"]:
+            with self.assertRaises(ValueError):
+                scrub.parse_shard(invalid)
+
+        paths = [f"data/{i:02x}/{i}" for i in range(1000)]
+        shards = [[path for path in paths if scrub.in_shard(path, (k, 7))] for k in range(1, 8)]
+        assert sorted(path for shard in shards for path in shard) == sorted(paths)
+        assert min(len(shard) for shard in shards) > 100
+        assert scrub.in_shard("data/00/0", (1, 7)) == scrub.in_shard("data/00/0", (1, 7))
+
+    def test_budget(self):
+        assert not scrub.Budget(None).exhausted()
+        assert scrub.Budget("6h").seconds == 6 * 3600
+        assert scrub.Budget("90m").seconds == 90 * 60
+        assert scrub.Budget("500M").size == 500 * 2 ** 20
+        assert scrub.Budget("2TiB").size == 2 * 2 ** 40
+        assert scrub.Budget("0s").exhausted()
+        for invalid in ["6", "6x", "m"]:
+            with self.assertRaises(ValueError):
+                scrub.Budget(invalid)
+
+        budget = scrub.Budget("1K")
+        budget.spend(1000)
+        assert not budget.exhausted()
+        budget.spend(24)
+        assert budget.exhausted() and not budget.out_of_time()
+
+    def test_time_budget_cuts_run_short(self):
+        async def job(item: int, resources: Resources) -> int:
+            await asyncio.sleep(0.1)
+            return item
+
+        budget = scrub.Budget("0.5s")
+        start = time.monotonic()
+        results = dict(engine.run_scheduled(job, [(i, 2 ** 20) for i in range(20)], 1, Resources(4, 4096), 1024,
+                                            stop=budget.out_of_time))
+        assert 3 <= len(results) <= 7  # all 20 were read ahead at once, they must not all start
+        assert time.monotonic() - start < 1.5
+
+    def test_journal(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            Path("d").mkdir()
+            journal = scrub.Journal("ck", "d", (1, 2))
+            journal.record(os.path.join("d", "a"), FileStatus.OK)
+            journal.record(os.path.join("d", "c"), FileStatus.TIMED_OUT)
+            journal.record(os.path.join("d", "e"), FileStatus.FAILED)
+            journal.close()
+
+            journal = scrub.Journal("ck", "d", (1, 2))
+            assert journal.is_done(os.path.join("d", "a"))
+            assert not journal.is_done(os.path.join("d", "b"))
+            assert not journal.is_done(os.path.join("d", "c"))
+            assert not journal.is_done(os.path.join("d", "e"))
+            journal.close()
+
+            with self.assertRaises(ValueError):
+                scrub.Journal("ck", "d", (2, 2))
+
+            with open("ck", "a") as f:
+                f.write("garbage\nOK\tf")  # a line without a tab and one cut short by a crash
+            journal = scrub.Journal("ck", "d", (1, 2))
+            assert journal.is_done(os.path.join("d", "a")) and not journal.is_done(os.path.join("d", "f"))
+            journal.record(os.path.join("d", "g"), FileStatus.OK)
+            journal.close()
+            journal = scrub.Journal("ck", "d", (1, 2))
+            assert journal.is_done(os.path.join("d", "g"))
+            journal.finish()
+            assert not Path("ck").exists()
+
+    def test_resumable_scrub(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            self.context.create_test_data()
+            for file_name in self.context.test_files:
+                write_par2_index(file_name)
+
+            verified_count = 0
+            for _ in range(len(self.context.test_files)):
+                result = runner.invoke(par2tortilla.main, ["run", "--verify", "--budget", "1M", "--checkpoint", "ck",
+                                                           "./"])
+                assert result.exit_code == 0
+                assert "Files that are OK: 1" in result.output
+                verified_count += 1
+                if "Pass complete" in result.output:
+                    break
+            assert verified_count == len(self.context.test_files)
+            assert not Path("ck").exists()
+
+            result = runner.invoke(par2tortilla.main, ["run", "--verify", "--shard", "1/2", "./"])
+            assert result.exit_code == 0
+            ok_count = int(result.output.split("Files that are OK: ")[1].split()[0])
+            result = runner.invoke(par2tortilla.main, ["run", "--verify", "--shard", "2/2", "./"])
+            assert result.exit_code == 0
+            other_ok_count = int(result.output.split("Files that are OK: ")[1].split()[0])
+            assert ok_count + other_ok_count == len(self.context.test_files)
+
+            result = runner.invoke(par2tortilla.main, ["run", "--verify", "--shard", "3/2", "./"])
+            assert result.exit_code == 1
+
+
+class TestsThrottle(unittest.TestCase):
+
+    def test_token_bucket(self):
+        bucket = throttle.TokenBucket(100)
+        start = time.monotonic()
+        for _ in range(3):
+            asyncio.run(bucket.acquire(100))
+        assert time.monotonic() - start >= 1.8
+
+    def test_governor_backoff(self):
+        governor = throttle.Governor(concurrency=8, backoff=True)
+        for _ in range(10):
+            governor.active += 1
+            governor.done(1.0, 2 ** 20)
+        assert governor.rate_factor == 1.0
+        assert governor.allowed() == 8
+
+        for _ in range(5):
+            governor.active += 1
+            governor.done(10.0, 2 ** 20)
+        assert governor.rate_factor < 1.0
+        assert 1 <= governor.allowed() < 8
+
+        for _ in range(200):
+            governor.active += 1
+            governor.done(1.0, 2 ** 20)
+        assert governor.rate_factor == 1.0
+
+    def test_run_scheduled_governed(self):
+        running = []
+        peak = []
+
+        async def job(item: int, resources: Resources) -> int:
+            running.append(item)
+            peak.append(len(running))
+            await asyncio.sleep(0.01)
+            running.remove(item)
+            return item
+
+        governor = throttle.Governor(files_per_second=10, concurrency=4)
+        governor.rate_factor = 0.5
+        start = time.monotonic()
+        results = dict(engine.run_scheduled(job, [(i, 2 ** 20) for i in range(15)], 4, Resources(8, 4096), 100,
+                                            governor))
+        assert sorted(results) == list(range(15))
+        assert max(peak) <= 2
+        assert time.monotonic() - start >= 0.8
+        assert governor.active == 0
+
+    def test_governed_cancel(self):
+        async def job(item: int, resources: Resources) -> int:
+            await asyncio.sleep(10)
+            return item
+
+        async def cancel(governor: throttle.Governor, delay: float):
+            task = asyncio.ensure_future(engine.governed(job, 0, Resources(1, 16), 2 ** 20, governor))
+            await asyncio.sleep(delay)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        governor = throttle.Governor(files_per_second=1)
+        governor.files_bucket.tokens = -10  # admit waits for tokens
+        asyncio.run(cancel(governor, 0.1))
+        assert governor.active == 0
+
+        governor = throttle.Governor()
+        asyncio.run(cancel(governor, 0.1))  # cancelled while the job runs
+        assert governor.active == 0
+
+    def test_priority_prefix(self):
+        assert throttle.priority_prefix(None, None) == []
+        assert throttle.priority_prefix(19, "idle") == ["nice", "-n", "19", "ionice", "-c", "3"]
+
+        echo = (sys.executable, "-c", "import os; print(os.nice(0))")
+        run = partial(engine.run_par2, timeout=None, priority=throttle.priority_prefix(5, None))
+        stdout, _ = list(engine.run_unordered(lambda args: run(list(args)), [echo], 1))[0][1]
+        assert int(stdout) >= 5
+
+
+class TestsParityStore(unittest.TestCase):
+
+    def setUp(self):
+        self.context = Context()
+
+    def test_split_merge(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            Path("data").mkdir()
+            os.chdir("data")
+            self.context.create_test_data()
+            members = ["a1/f1.bin", "a1/f2.bin"]
+            for file_name in self.context.test_files:
+                if file_name not in members:
+                    write_par2_index(file_name)
+            index = os.path.join("a1", group_name(os.path.basename(f) for f in members) + ".par2")
+            write_par2_set(index, members)
+            os.chdir("..")
+
+            result = runner.invoke(par2tortilla.main, ["split-directories", "data", "parity"])
+            assert result.exit_code == 0
+            assert f"Moved {len(self.context.test_files) - 1} PAR2 files to 'parity'." in result.output
+            assert not [f for f in glob_files("data") if f.endswith(".par2")]
+            assert Path("parity/a1/a2/f3.bin.par2").is_file()
+            assert Path("parity", index).is_file()
+
+            entries = list(scan_tree("data", "parity"))
+            with_parity = {entry.path: entry for entry in entries if entry.kind == EntryKind.DATA_WITH_PARITY}
+            assert sorted(with_parity) == sorted(os.path.join("data", f) for f in self.context.test_files)
+            assert with_parity[os.path.join("data", "a1/a2/f3.bin")].parity_files == ("parity/a1/a2/f3.bin.par2",)
+            assert with_parity[os.path.join("data", "a1/f1.bin")].target == os.path.join("data", index)
+            assert not [entry for entry in entries if entry.kind == EntryKind.DATA_WITHOUT_PARITY]
+
+            store = ParityStore("parity", "data")
+            for entry in with_parity.values():
+                assert par2format.verify_in_process(entry.target, store.index(entry.target))
+            assert target_files(os.path.join("data", index), store.index(os.path.join("data", index))) \
+                == [os.path.join("data", f) for f in members]
+
+            result = runner.invoke(par2tortilla.main, ["run", "data", "--parity-store", "parity"])
+            assert "Data files with parity: 6" in result.output
+            assert "PAR2 files without data files: 0" in result.output
+
+            Path("data/f0.bin.par2").touch()
+            result = runner.invoke(par2tortilla.main, ["split-directories", "data", "parity"])
+            assert result.exit_code == 1
+            assert "Not overwriting 'parity/f0.bin.par2'." in result.output
+            Path("data/f0.bin.par2").unlink()
+
+            result = runner.invoke(par2tortilla.main, ["merge-directories", "data", "parity"])
+            assert result.exit_code == 0
+            assert f"Moved {len(self.context.test_files) - 1} PAR2 files to 'data'." in result.output
+            assert not Path("parity").exists()
+            assert par2format.verify_in_process("data/a1/a2/f3.bin")
+
+    def test_store_inside_tree(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            self.context.create_test_data()
+            write_par2_index("f0.bin")
+            result = runner.invoke(par2tortilla.main, ["split-directories", "./", ".parity"])
+            assert "Moved 1 PAR2 files to '.parity'." in result.output
+
+            kinds = {entry.path: entry.kind for entry in scan_tree("./", ".parity")}
+            assert kinds["f0.bin"] == EntryKind.DATA_WITH_PARITY
+            assert kinds[".parity/f0.bin.par2"] == EntryKind.PARITY
+            assert EntryKind.ORPHAN_PARITY not in kinds.values()
+
+    def test_par2_args(self):
+        store = ParityStore("/parity", "/data")
+        assert store.index("/data/a/f.bin") == "/parity/a/f.bin.par2"
+        assert store.index("/data/a/group.par2") == "/parity/a/group.par2"
+        assert utils.par2verify_args(store.index("/data/a/f.bin"), base_path="/data/a") \
+            == ["par2", "v", "-q", "-B/data/a", "/parity/a/f.bin.par2"]
+
+
+class TestsBenchmark(unittest.TestCase):
+
+    def test_parse_corpus(self):
+        assert benchmark.parse_corpus("100000x4K, 10x8MiB,3x2G,5x100") \
+            == [(100000, 4096), (10, 8 * 2 ** 20), (3, 2 * 2 ** 30), (5, 100)]
+        for invalid in ["", "4K", "x4K", "10x4Q"]:
+            with self.assertRaises(ValueError):
+                benchmark.parse_corpus(invalid)
+
+    def test_corpus(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            corpus = benchmark.Corpus([(1500, 10), (2, 100)])
+            assert corpus.file_count == 1502
+            assert corpus.total_size == 15200
+            corpus.create_test_data()
+            assert len(glob_files("./")) == 1502
+            assert len(os.listdir("d0000")) == benchmark.FILES_PER_DIRECTORY
+            assert os.path.getsize("d0001/f0001501.bin") == 100
+
+            Path("d0000/f0000000.bin.par2").touch()
+            Path("d0001/f0001501.bin.1").touch()
+            corpus.clean()
+            assert len(glob_files("./")) == 1502
+
+    def test_compare(self):
+        def results(*seconds):
+            return {"corpus": "1x4K", "results": [{"mode": mode, "processes": 2, "block_count": 500, "redundancy": 10,
+                                                   "seconds": s} for mode, s in zip(benchmark.MODES, seconds)]}
+
+        assert benchmark.regressions(results(1.0, 1.0, 1.0), results(1.05, 0.5, 1.2), 10) \
+            == [(("repair", 2, 500, 10), 1.0, 1.2)]
+        with self.assertRaises(ValueError):
+            benchmark.regressions(results(1.0), {"corpus": "2x4K", "results": []}, 10)
+
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            for name, data in (("a.json", results(1.0, 1.0, 1.0)), ("b.json", results(1.0, 1.5, 1.0))):
+                with open(name, "w") as f:
+                    json.dump(data, f)
+            result = runner.invoke(benchmark.main, ["compare", "a.json", "a.json"])
+            assert result.exit_code == 0
+            assert "No regressions over 10.0%." in result.output
+            result = runner.invoke(benchmark.main, ["compare", "a.json", "b.json"])
+            assert result.exit_code == 1
+            assert "REGRESSION verify -p 2 -b 500 -r 10: 1.00 s -> 1.50 s (+50%)" in result.output
+            assert runner.invoke(benchmark.main, ["compare", "--threshold", "60", "a.json", "b.json"]).exit_code == 0
+
+
+class TestsMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.context = Context()
+
+    def test_child_cpu(self):
+        recorder = metrics.Metrics()
+        call = recorder.call("verify", "f", 0)
+        burner = [sys.executable, "-c", "import sys, time\nend = time.process_time() + 0.3\n"
+                                        "while time.process_time() < end: pass\nsys.exit(3)"]
+        asyncio.run(engine.run_par2(burner, None, call=call))
+        event = recorder.record(call, FileStatus.FUBAR)
+        assert event.exit_code == 3
+        assert event.cpu >= 0.25
+        assert event.wall >= event.cpu * 0.5
+        assert recorder.timings["subprocess"] >= 0.25
+
+        calls = [recorder.call("verify", str(i), 0) for i in range(2)]
+        sleeper = [sys.executable, "-c", "import time; time.sleep(0.1)"]
+
+        async def overlapping():
+            await asyncio.gather(*(engine.run_par2(sleeper, None, call=call) for call in calls))
+        asyncio.run(overlapping())
+        assert [call.cpu for call in calls] == [None, None]
+
+    def test_run_events(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            self.context.create_test_data()
+            for file_name in self.context.test_files:
+                write_par2_index(file_name)
+
+            result = runner.invoke(par2tortilla.main, ["run", "--verify", "--events", "events.jsonl", "--textfile",
+                                                       "par2tortilla.prom", "--profile", "./"])
+            assert result.exit_code == 0
+            assert f"Files that are OK: {len(self.context.test_files)}" in result.output
+            for phase in ("wall", "scan", "classify", "in-process", "subprocess"):
+                assert f"Time spent, {phase}: " in result.output
+
+            with open("events.jsonl") as f:
+                events = [json.loads(line) for line in f]
+            assert sorted(event["path"] for event in events) == sorted(self.context.test_files)
+            assert {(event["operation"], event["status"], event["size"], event["exit_code"]) for event in events} \
+                == {("verify", "OK", TEST_FILE_SIZE, None)}
+
+            with open("par2tortilla.prom") as f:
+                textfile = f.read()
+            count = len(self.context.test_files)
+            assert f'par2tortilla_call_duration_seconds_bucket{{operation="verify",le="+Inf"}} {count}' in textfile
+            assert f'par2tortilla_calls_total{{operation="verify",status="OK"}} {count}' in textfile
+            assert f'par2tortilla_bytes_total{{operation="verify"}} {count * TEST_FILE_SIZE}' in textfile
+            assert not Path("par2tortilla.prom.tmp").exists()
+
+
+@unittest.skipUnless(sys.platform.startswith("linux"), "inotify is Linux only")
+class TestsWatch(unittest.TestCase):
+
+    def test_watch(self):
+        created = []
+        messages = []
+
+        async def create(file: str) -> FileStatus:
+            created.append(file)
+            write_par2_index(file)
+            Path(file + ".vol0+1.par2").touch()
+            return FileStatus.CREATED
+
+        def write(file_name: str, data: bytes = b"data"):
+            with open(file_name, "wb") as f:
+                f.write(data)
+
+        async def scenario():
+            stop = asyncio.Event()
+            watcher = asyncio.create_task(watch.watch("d", create, 2, 0.2, stop=stop, report=messages.append))
+            await asyncio.sleep(0.1)
+
+            for i in range(5):
+                write("d/f.bin", b"x" * i)
+                await asyncio.sleep(0.02)
+            write("d/g.bin")
+            Path("d/new/sub").mkdir(parents=True)
+            await asyncio.sleep(0.1)
+            write("d/new/sub/h.bin")
+            await asyncio.sleep(0.6)
+            assert sorted(created) == ["d/f.bin", "d/g.bin", "d/new/sub/h.bin"]
+            assert par2format.verify_in_process("d/f.bin")
+
+            write("d/f.bin", b"changed")
+            os.rename("d/g.bin", "d/g2.bin")
+            Path("d/new/sub/h.bin").unlink()
+            await asyncio.sleep(0.6)
+            stop.set()
+            await watcher
+
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            Path("d").mkdir()
+            asyncio.run(scenario())
+            assert created.count("d/f.bin") == 2
+            assert par2format.verify_in_process("d/f.bin")
+            assert par2format.verify_in_process("d/g2.bin")
+            assert sorted(os.listdir("d")) == ["f.bin", "f.bin.par2", "f.bin.vol0+1.par2", "g2.bin",
+                                               "g2.bin.par2", "g2.bin.vol0+1.par2", "new"]
+            assert os.listdir("d/new/sub") == []
+            assert "Removed 2 PAR2 files of 'd/new/sub/h.bin'." in messages
+
+    def test_watch_command(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            Path("d").mkdir()
+            process = subprocess.Popen([sys.executable, "-u", par2tortilla.__file__, "watch", "--drop-cache", "d"],
+                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            try:
+                assert process.stdout.readline() == b"Watching 'd'...\n"
+            finally:
+                process.terminate()
+                _, stderr = process.communicate(timeout=10)
+            assert process.returncode == 0, stderr
+
+    def test_parity_files(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            for name in ["f.bin", "f.bin.par2", "f.bin.vol00+10.par2", "f.bin2.par2", "g.bin.par2"]:
+                Path(name).touch()
+            assert sorted(watch.parity_files("f.bin")) == ["./f.bin.par2", "./f.bin.vol00+10.par2"]
+            assert watch.remove_parity("f.bin") == 2
+            assert watch.parity_files("f.bin") == []
+
+
+class TestsPolicy(unittest.TestCase):
+
+    def test_parse_rule(self):
+        rule = policy.parse_rule({"glob": "*.log", "max_size": "64K", "min_age": "30d", "block_size": "8K"})
+        assert rule.max_size == 64 * 1024 and rule.min_age == 30 * 24 * 3600
+        assert rule.settings == {"block_size": 8192}
+        for invalid in ({"glob": "*", "redundancy": 5, "colour": "red"}, {"block_count": 10, "block_size": 4096},
+                        {"block_size": 4097}, {"max_size": "lots"}, {"min_age": "30 weeks"}):
+            with self.assertRaises(ValueError):
+                policy.parse_rule(invalid)
+
+    def test_auto_policy(self):
+        base = policy.ParityPolicy(DEFAULT_PARITY_FILE_COUNT, DEFAULT_REDUNDANCY, DEFAULT_BLOCK_COUNT)
+        assert policy.auto_policy(2048, base) == policy.ParityPolicy(1, 100, None, 2048)
+        assert policy.auto_policy(0, base) == policy.ParityPolicy(1, 100, None, 4)
+        assert policy.auto_policy(40 * 1024, base) == policy.ParityPolicy(1, 10, None, 4096)
+        large = policy.auto_policy(20 * 2 ** 30, base)
+        assert large.parity_file_count == policy.AUTO_MAX_VOLUMES and large.redundancy == DEFAULT_REDUNDANCY
+        assert large.block_size % 4 == 0 and -(-20 * 2 ** 30 // large.block_size) <= policy.AUTO_MAX_BLOCKS
+
+    def test_for_file(self):
+        base = policy.ParityPolicy(1, 10, 500)
+        rules = [policy.parse_rule(rule) for rule in ({"glob": "*.log", "redundancy": 5},
+                                                      {"max_size": "64K", "block_size": 4096, "redundancy": 30},
+                                                      {"min_age": "30d", "parity_file_count": 4})]
+        now = time.time()
+        chooser = policy.Policy(base, rules)
+        assert chooser.for_file("a/b.log", 2 ** 20, now, now) == policy.ParityPolicy(1, 5, 500)
+        assert chooser.for_file("a/b.log.1", 1024, now, now) == policy.ParityPolicy(1, 30, None, 4096)
+        assert chooser.for_file("b.bin", 2 ** 20, now - 31 * 24 * 3600, now) == policy.ParityPolicy(4, 10, 500)
+        assert chooser.for_file("b.bin", 2 ** 20, now, now) == base
+
+        auto = policy.Policy(base, rules, auto=True)
+        assert auto.for_file("b.log", 2048, now, now) == policy.ParityPolicy(1, 5, None, 2048)
+        assert auto.for_file("b.bin", 2048, now, now) == policy.ParityPolicy(1, 30, None, 4096)
+        assert auto.for_file("b.bin", 100 * 1024, now, now) == policy.ParityPolicy(1, 10, None, 4096)
+
+    def test_par2create_args(self):
+        assert "-s4096" in utils.par2create_args("f.bin", 1, 10, None, block_size=4096)
+        assert "-b500" in utils.par2create_args("f.bin", 1, 10, 500)
+
+    def test_invalid_policy_file(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            for name, rules in (("unknown.json", '[{"glob": "*", "speed": "fast"}]'), ("object.json", '{"glob": "*"}'),
+                                ("broken.json", "[{")):
+                Path(name).write_text(rules)
+                result = runner.invoke(par2tortilla.main, ["run", "--create", "--policy", name, "./"])
+                assert result.exit_code == 1, name
+                assert "policy" in result.output.lower(), result.output
+
+
+def gf_multiply(a: int, b: int) -> int:
+    """Plain shift-and-add multiplication in GF(2^16), to check the tables of the encoder against."""
+    product = 0
+    while b:
+        if b & 1:
+            product ^= a
+        b >>= 1
+        a <<= 1
+        if a & 0x10000:
+            a ^= par2encode.GF_POLYNOMIAL
+    return product
+
+
+def gf_power(a: int, exponent: int) -> int:
+    result = 1
+    for _ in range(exponent):
+        result = gf_multiply(result, a)
+    return result
+
+
+@unittest.skipUnless(par2encode.available(), "needs NumPy")
+class TestsPar2Encode(unittest.TestCase):
+
+    def test_gf_tables(self):
+        exp, log = par2encode.gf_tables()
+        for a, b in ((1, 1), (2, 3), (0x8000, 2), (0x1234, 0xABCD), (65535, 65535), (4711, 1)):
+            assert exp[log[a] + log[b]] == gf_multiply(a, b)
+        assert par2encode.input_slice_logs(8) == [1, 2, 4, 7, 8, 11, 13, 14]
+
+    def test_slice_size_for(self):
+        assert par2encode.slice_size_for([12345], 500) == 28
+        assert par2encode.slice_size_for([0], 10) == 4
+        size = par2encode.slice_size_for([10, 4000, 100], 50)
+        assert size % 4 == 0 and sum(-(-length // size) for length in [10, 4000, 100]) <= 50
+        with self.assertRaises(ValueError):
+            par2encode.slice_size_for([1, 2, 3], 2)
+
+    def test_recovery_slices(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            contents = {"a.bin": os.urandom(100), "b.bin": os.urandom(37), "c.bin": b""}
+            for name, data in contents.items():
+                Path(name).write_bytes(data)
+            written = par2encode.create_recovery_set("set.par2", list(contents), 2, 100, None, block_size=32)
+            assert written == ["set.par2", "set.vol0+3.par2", "set.vol3+3.par2"]
+            assert par2format.verify_in_process("set.par2")
+
+            recovery_set = par2format.read_recovery_set("set.par2")
+            names = [recovery_set.files[file_id].name for file_id in recovery_set.main.recovery_file_ids]
+            assert sorted(names) == ["a.bin", "b.bin", "c.bin"]
+            slices = [contents[name][offset:offset + 32].ljust(32, b"\0")
+                      for name in names for offset in range(0, len(contents[name]), 32)]
+            assert len(slices) == 6
+            constants = [gf_power(2, n) for n in par2encode.input_slice_logs(len(slices))]
+
+            recovery = {}
+            for volume in written[1:]:
+                for packet in par2format.iter_packets(Path(volume).read_bytes()):
+                    if packet.type == par2format.RECOVERY_SLICE_TYPE:
+                        recovery[struct.unpack_from("<I", packet.body)[0]] = packet.body[4:]
+            assert sorted(recovery) == list(range(6))
+            for exponent in (0, 1, 5):
+                words = [0] * 16
+                for constant, data in zip(constants, slices):
+                    coefficient = gf_power(constant, exponent)
+                    for i, (word,) in enumerate(struct.iter_unpack("<H", data)):
+                        words[i] ^= gf_multiply(coefficient, word)
+                assert recovery[exponent] == struct.pack("<16H", *words), exponent
+
+            # exponent 0 is the XOR of all slices, enough to rebuild any single one of them
+            rebuilt = bytearray(recovery[0])
+            for data in slices[1:]:
+                rebuilt = bytearray(x ^ y for x, y in zip(rebuilt, data))
+            assert bytes(rebuilt) == slices[0]
+
+    def test_par2_repairs_native_parity(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            Path("f.bin").write_bytes(os.urandom(TEST_FILE_SIZE))
+            par2encode.create_recovery_set("f.bin.par2", ["f.bin"], 1, 10, DEFAULT_BLOCK_COUNT)
+            par2verify_test("f.bin", expect_damage=False, repair_possible=True)
+            corrupt_file("f.bin", 5)
+            par2verify_test("f.bin", expect_damage=True, repair_possible=True)
+            subprocess.run(["par2", "r", "-q", "f.bin"], check=True, stdout=subprocess.DEVNULL)
+            assert par2format.verify_in_process("f.bin")
+
+    def test_run_native_create(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            Path("d").mkdir()
+            for i in range(5):
+                Path(f"d/f{i}.bin").write_bytes(os.urandom(1000 * i + 1))
+
+            result = runner.invoke(par2tortilla.main, ["run", "--create", "--native-create", "--group", "-p", "2",
+                                                       "d"])
+            assert result.exit_code == 0, result.output
+            indexes = [name for name in os.listdir("d") if name.startswith(GROUP_PREFIX) and ".vol" not in name]
+            assert len(indexes) == 1 and par2format.verify_in_process(os.path.join("d", indexes[0]))
+
+    def test_native_encoder_accepts(self):
+        native = par2encode.NativeEncoder(1, 2 ** 20)
+        assert native.accepts(1) and native.accepts(2 ** 20)
+        assert not native.accepts(0) and not native.accepts(2 ** 20 + 1)
+        native.close()
+
+    def test_native_create_falls_back(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            Path("f.bin").write_bytes(os.urandom(200000))
+            native = par2encode.NativeEncoder(0, 2 ** 20)
+            reported = []
+            par2 = (sys.executable, "-c", "import sys; print(sys.argv[1:])")  # stands in for par2, args go to argv
+            status = asyncio.run(engine.par2create("f.bin", 1, 5, None, block_size=4, native=native, priority=par2,
+                                                   report=reported.append))  # 50000 slices, more than PAR2 allows
+            assert status == FileStatus.CREATED
+            assert "falling back to par2" in reported[-1]
+            assert not os.path.exists("f.bin.par2")
+
+
+class TestsFaults(unittest.TestCase):
+
+    def test_corrupt_head(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            data = os.urandom(100000)
+            for name in ("a.bin", "b.bin"):
+                Path(name).write_bytes(data)
+                assert faults.corrupt_head(name, 10, random.Random(7)) == 10000
+            a, b = Path("a.bin").read_bytes(), Path("b.bin").read_bytes()
+            assert a == b and len(a) == len(data)
+            assert a[:10000] != data[:10000] and a[10000:] == data[10000:]
+
+            corrupt_file("a.bin", 10, seed=8)
+            assert Path("a.bin").read_bytes() != b
+
+    def test_flip_bits_and_zero_blocks(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            data = bytes(range(256)) * 64
+            Path("f.bin").write_bytes(data)
+            offsets = faults.flip_bits("f.bin", 5, random.Random(1))
+            damaged = Path("f.bin").read_bytes()
+            changed = [i for i in range(len(data)) if damaged[i] != data[i]]
+            assert set(changed) <= set(offsets) and changed
+            assert all(bin(damaged[i] ^ data[i]).count("1") == 1 for i in changed if offsets.count(i) == 1)
+
+            Path("f.bin").write_bytes(data)
+            offsets = faults.zero_blocks("f.bin", 4096, 2, random.Random(1))
+            assert len(offsets) == 2 and all(offset % 4096 == 0 for offset in offsets)
+            damaged = Path("f.bin").read_bytes()
+            for block in range(0, len(data), 4096):
+                expected = bytes(4096) if block in offsets else data[block:block + 4096]
+                assert damaged[block:block + 4096] == expected
+            assert faults.zero_blocks("f.bin", 4096, 2, random.Random(1)) == offsets
+
+            assert faults.truncate("f.bin", 25) == len(data) // 4
+            assert os.path.getsize("f.bin") == len(data) // 4
+            Path("empty.bin").touch()
+            assert faults.flip_bits("empty.bin", 3, random.Random(1)) == []
+
+    def test_delete_volumes(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            names = ["f.bin.par2", "f.bin.vol00+10.par2", "f.bin.vol10+10.par2", "f.bin.vol20+10.par2",
+                     "f.bin2.vol00+10.par2", "g.bin.vol00+10.par2"]
+            for name in names:
+                Path(name).touch()
+            assert faults.volume_files("f.bin.par2") == ["./f.bin.vol00+10.par2", "./f.bin.vol10+10.par2",
+                                                         "./f.bin.vol20+10.par2"]
+            removed = faults.delete_volumes("f.bin.par2", 2, random.Random(3))
+            assert len(removed) == 2 and not any(os.path.exists(volume) for volume in removed)
+            assert len(faults.volume_files("f.bin.par2")) == 1 and os.path.exists("f.bin2.vol00+10.par2")
+
+    def test_damage_packets(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            Path("f.bin").write_bytes(os.urandom(10000))
+            write_par2_index("f.bin", 1024)
+            assert par2format.verify_in_process("f.bin")
+            offsets = faults.damage_packets("f.bin.par2", 1, random.Random(1), par2format.MAIN_TYPE)
+            assert len(offsets) == 1
+            assert par2format.read_recovery_set("f.bin.par2") is None
+
+            write_par2_index("f.bin", 1024)
+            with open("f.bin.par2", "rb") as f:
+                packets = len(list(par2format.iter_packets(f.read())))
+            assert len(faults.damage_packets("f.bin.par2", 10, random.Random(1))) == packets
+            with open("f.bin.par2", "rb") as f:
+                assert list(par2format.iter_packets(f.read())) == []
+
+
+@unittest.skipUnless(par2encode.available(), "needs NumPy")
+class TestsParityScrub(unittest.TestCase):
+
+    def create_set(self) -> list:
+        Path("f.bin").write_bytes(os.urandom(50000))
+        return par2encode.create_recovery_set("f.bin.par2", ["f.bin"], 3, 30, 100)
+
+    def test_check_parity(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            files = self.create_set()
+            health = par2format.check_parity(files)
+            assert health.health == SetHealth.HEALTHY and health.damaged_files == []
+            assert health.recovery_blocks == health.expected_blocks == 30
+
+            faults.damage_packets(files[1], 2, random.Random(1), par2format.RECOVERY_SLICE_TYPE)
+            faults.truncate(files[2], 50)
+            health = par2format.check_parity(files)
+            assert health.health == SetHealth.DEGRADED and health.damaged_files == files[1:3]
+            assert health.recovery_blocks <= 25
+
+            assert par2format.check_parity(files[1:]).health == SetHealth.DEGRADED  # index missing
+            for file in files[1:]:
+                faults.damage_packets(file, 100, random.Random(1), par2format.RECOVERY_SLICE_TYPE)
+            health = par2format.check_parity(files)
+            assert health.health == SetHealth.UNUSABLE and health.recovery_blocks == 0  # no recovery slices left
+            for file in files:
+                faults.damage_packets(file, 1, random.Random(1), par2format.MAIN_TYPE)
+            health = par2format.check_parity(files)
+            assert health.health == SetHealth.UNUSABLE and health.recovery_set is None
+
+    def test_check_parity_no_redundancy(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            Path("f.bin").write_bytes(os.urandom(50000))
+            files = par2encode.create_recovery_set("f.bin.par2", ["f.bin"], 3, 0, 100)
+            assert files == ["f.bin.par2"]
+            health = par2format.check_parity(files)
+            assert health.health == SetHealth.HEALTHY and health.recovery_blocks == health.expected_blocks == 0
+
+            original = Path(files[0]).read_bytes()
+            faults.damage_packets(files[0], 1, random.Random(5), par2format.CREATOR_TYPE)
+            health = par2format.check_parity(files)
+            assert health.health == SetHealth.DEGRADED
+            assert par2encode.rebuild_parity(health, "f.bin.par2") == files
+            assert Path(files[0]).read_bytes() == original
+            faults.damage_packets(files[0], 1, random.Random(5), par2format.FILE_DESC_TYPE)
+            assert par2format.check_parity(files).health == SetHealth.UNUSABLE
+
+    def test_rebuild_parity(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            files = self.create_set()
+            original = {file: Path(file).read_bytes() for file in files}
+            os.remove(files[0])
+            faults.damage_packets(files[2], 3, random.Random(2))
+            health = par2format.check_parity(files)
+            assert sorted(par2encode.rebuild_parity(health, "f.bin.par2")) == sorted(files[:1] + files[2:3])
+            assert all(Path(file).read_bytes() == original[file] for file in files)
+            assert par2format.check_parity(files).health == SetHealth.HEALTHY
+
+            faults.damage_packets(files[3], 1, random.Random(3))
+            faults.flip_bits("f.bin", 1, random.Random(3))
+            with self.assertRaises(ValueError):
+                par2encode.rebuild_parity(par2format.check_parity(files), "f.bin.par2")
+            with self.assertRaises(ValueError):
+                par2encode.rebuild_parity(par2format.check_parity(files[:1]), "f.bin.par2")
+
+    def test_scrub_parity_command(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            Path("d").mkdir()
+            for i in range(3):
+                Path(f"d/f{i}.bin").write_bytes(os.urandom(10000))
+            par2encode.create_recovery_set("d/f0.bin.par2", ["d/f0.bin"], 2, 10, 100)
+            group = [f"d/f{i}.bin" for i in (1, 2)]
+            group_files = par2encode.create_recovery_set(group_index(group), group, 1, 10, 100)
+
+            result = runner.invoke(par2tortilla.main, ["scrub-parity", "d"])
+            assert result.exit_code == 0, result.output
+            assert "Recovery sets healthy: 2" in result.output
+
+            faults.damage_packets("d/f0.bin.vol05+05.par2", 1, random.Random(4))
+            os.remove(group_files[0])
+            result = runner.invoke(par2tortilla.main, ["scrub-parity", "d"])
+            assert "DEGRADED 'd/f0.bin' - 9/10 recovery blocks intact, damaged: d/f0.bin.vol05+05.par2" in result.output
+            assert f"DEGRADED '{group_files[0]}' - 10/10 recovery blocks intact, damaged: index missing" \
+                   in result.output
+            assert "Recovery sets degraded: 2" in result.output  # the group is still known from its volumes
+
+            result = runner.invoke(par2tortilla.main, ["run", "d"])
+            assert "Data files with parity: 3" in result.output and "PAR2 files without data files: 0" in result.output
+
+            result = runner.invoke(par2tortilla.main, ["scrub-parity", "--rebuild", "d"])
+            assert "REBUILT 'd/f0.bin' - d/f0.bin.vol05+05.par2" in result.output
+            assert f"REBUILT '{group_files[0]}' - index" in result.output
+            assert "Rebuilt 2/2 degraded recovery sets." in result.output
+            assert os.path.exists(group_files[0])
+            result = runner.invoke(par2tortilla.main, ["scrub-parity", "d"])
+            assert "Recovery sets healthy: 2" in result.output and "degraded: 0" in result.output
+
+
+class TestsDedup(unittest.TestCase):
+
+    def test_duplicates(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            data = os.urandom(5000)
+            for name in ("a.bin", "copy.bin"):
+                Path(name).write_bytes(data)
+            Path("other.bin").write_bytes(os.urandom(5000))
+            Path("small.bin").write_bytes(b"x")
+            os.link("a.bin", "link.bin")
+            Path("empty1.bin").touch()
+            Path("empty2.bin").touch()
+
+            duplicates = dedup.Duplicates()
+            found = {name: duplicates.original(name, os.stat(name)) for name in
+                     ("a.bin", "copy.bin", "other.bin", "small.bin", "link.bin", "empty1.bin", "empty2.bin")}
+            assert found == {"a.bin": None, "copy.bin": None, "other.bin": None, "small.bin": None,
+                             "link.bin": ("a.bin", DuplicateKind.HARDLINK), "empty1.bin": None, "empty2.bin": None}
+
+            duplicates = dedup.Duplicates(by_content=True)
+            found = {name: duplicates.original(name, os.stat(name)) for name in
+                     ("link.bin", "other.bin", "a.bin", "copy.bin", "small.bin", "empty1.bin", "empty2.bin")}
+            assert found == {"link.bin": None, "other.bin": None, "a.bin": ("link.bin", DuplicateKind.HARDLINK),
+                             "copy.bin": ("link.bin", DuplicateKind.COPY), "small.bin": None, "empty1.bin": None,
+                             "empty2.bin": None}
+            assert duplicates.sizes == {5000: None, 1: "small.bin"}
+
+    def test_restore(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            Path("a.bin").write_bytes(b"damaged")
+            os.link("a.bin", "link.bin")
+            Path("copy.bin").write_bytes(b"damaged")
+            os.rename("a.bin", "a.bin.1")  # the way par2 repairs, the damaged file is kept aside
+            Path("a.bin").write_bytes(b"repaired")
+
+            dedup.restore("a.bin", "link.bin", DuplicateKind.HARDLINK)
+            dedup.restore("a.bin", "copy.bin", DuplicateKind.COPY)
+            assert os.stat("link.bin").st_ino == os.stat("a.bin").st_ino
+            assert Path("copy.bin").read_bytes() == b"repaired"
+            assert os.stat("copy.bin").st_ino != os.stat("a.bin").st_ino
+            assert sorted(os.listdir()) == ["a.bin", "a.bin.1", "copy.bin", "link.bin"]
+
+    @unittest.skipUnless(par2encode.available(), "needs NumPy")
+    def test_run_dedup(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            Path("d/a").mkdir(parents=True)
+            Path("d/b").mkdir()
+            data = os.urandom(5000)
+            Path("d/a/f.bin").write_bytes(data)
+            os.link("d/a/f.bin", "d/b/f.bin")
+            os.link("d/a/f.bin", "d/b/g.bin")
+            Path("d/b/copy.bin").write_bytes(data)
+
+            result = runner.invoke(par2tortilla.main, ["run", "--create", "--native-create", "--dedup", "inode", "d"])
+            assert result.exit_code == 0, result.output
+            assert "Files skipped, covered by the parity of their original: 2" in result.output
+            parity = sorted(name for _, _, names in os.walk("d") for name in names if name.endswith(".par2"))
+            assert len(parity) == 4  # index and volume of the first hard link and of the copy
+
+            result = runner.invoke(par2tortilla.main, ["run", "--verify", "--dedup", "content", "d"])
+            assert result.exit_code == 0, result.output
+            assert result.output.count("verifying file") == 1
+            assert "Files that are OK: 4" in result.output
+
+            Path("d/b/copy2.bin").write_bytes(data)
+            result = runner.invoke(par2tortilla.main, ["run", "--create", "--native-create", "--dedup", "content", "d"])
+            assert result.exit_code == 0, result.output
+            assert "Files skipped, covered by the parity of their original: 2" in result.output  # the hard links
+            assert par2format.verify_in_process("d/b/copy2.bin")  # a copy has parity of its own
+
+            faults.flip_bits("d/b/copy2.bin", 1, random.Random(6))
+            result = runner.invoke(par2tortilla.main, ["run", "--create", "--native-create", "--dedup", "content", "d"])
+            assert result.exit_code == 0, result.output
+            assert "creating par2 parity" not in result.output  # the rotten copy is not taken for a new file
+            assert not par2format.verify_in_process("d/b/copy2.bin")
+
+
+class TestsApi(unittest.TestCase):
+
+    def test_repair_status(self):
+        assert api.repair_status(engine.ChainResult("f", verified=FileStatus.OK)) == FileStatus.OK
+        assert api.repair_status(engine.ChainResult("f", verified=FileStatus.FUBAR)) == FileStatus.FUBAR
+        assert api.repair_status(engine.ChainResult("f", verified=FileStatus.REPAIRABLE,
+                                                    repaired=FileStatus.FUBAR)) == FileStatus.FUBAR
+        assert api.repair_status(engine.ChainResult("f", FileStatus.REPAIRABLE, repaired=FileStatus.REPAIRED,
+                                                    reverified=FileStatus.OK)) == FileStatus.REPAIRED
+
+    @unittest.skipUnless(par2encode.available(), "needs NumPy")
+    def test_scan_create_verify(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem(), ThreadPoolExecutor(2) as executor:
+            Path("d/s").mkdir(parents=True)
+            for name in ("d/a.bin", "d/s/b.bin", "d/s/c.bin"):
+                Path(name).write_bytes(os.urandom(3000))
+
+            messages = []
+            with api.Par2Tortilla("d", native_max_size=1, executor=executor, report=messages.append) as tortilla:
+                assert sorted(entry.path for entry in tortilla.scan()) == ["d/a.bin", "d/s/b.bin", "d/s/c.bin"]
+                Path("d/new.bin").write_bytes(b"not scanned yet")
+
+                results = list(tortilla.create())
+                assert sorted(result.target for result in results) == ["d/a.bin", "d/s/b.bin", "d/s/c.bin"]
+                assert all(result.status == FileStatus.CREATED and result.error is None and result.seconds > 0
+                           for result in results)
+                assert sorted(messages)[0] == "creating par2 parity for 'd/a.bin'..."
+
+                kinds = Counter(entry.kind for entry in tortilla.scan())
+                assert kinds == {EntryKind.DATA_WITH_PARITY: 3, EntryKind.PARITY: 6}
+                verified = {result.target: result.status for result in tortilla.verify()}
+                assert verified == {"d/a.bin": FileStatus.OK, "d/s/b.bin": FileStatus.OK, "d/s/c.bin": FileStatus.OK}
+
+                assert EntryKind.DATA_WITHOUT_PARITY in {entry.kind for entry in tortilla.scan(refresh=True)}
+
+            with api.Par2Tortilla("d", group=True, native_max_size=1, executor=executor) as tortilla:
+                [result] = tortilla.create(["d/new.bin"])
+                assert result.status == FileStatus.CREATED and result.target == group_index(["d/new.bin"])
+                [result] = tortilla.verify([result.target])
+                assert result.operation == "verify" and result.status == FileStatus.OK
+            assert executor.submit(len, "still open").result() == 10
+
+    @unittest.skipUnless(par2encode.available(), "needs NumPy")
+    def test_errors(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            with api.Par2Tortilla(".", native_max_size=1) as tortilla:
+                [result] = tortilla.create(["missing.bin"])
+            assert result.status is None
+            assert result.error.startswith("FileNotFoundError: ")
+            assert not os.path.exists("missing.bin.par2")
+
+
+class TestsDiskIO(unittest.TestCase):
+
+    def test_layout_key(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            Path("a.bin").write_bytes(os.urandom(10000))
+            Path("empty.bin").touch()
+            os.sync()
+            offset = diskio.physical_offset("a.bin")
+            assert offset is None or diskio.layout_key("a.bin") == (0, offset)
+            assert diskio.physical_offset("empty.bin") is None
+            assert diskio.layout_key("empty.bin") == (1, os.stat("empty.bin").st_ino)
+            assert diskio.layout_key("missing.bin") == (2, 0)
+
+            fcntl, diskio.fcntl = diskio.fcntl, None  # as on Windows
+            try:
+                assert diskio.physical_offset("a.bin") is None
+                assert diskio.layout_key("a.bin") == (1, os.stat("a.bin").st_ino)
+            finally:
+                diskio.fcntl = fcntl
+
+            diskio.will_need("a.bin")
+            diskio.drop_cached(["a.bin", "missing.bin"])
+            assert len(Path("a.bin").read_bytes()) == 10000
+
+    def test_disk_order(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            for name in ("c.bin", "a.bin", "g1.bin", "b.bin", "g2.bin"):
+                Path(name).write_bytes(os.urandom(5000))
+            os.sync()
+            entries = [ScanEntry(EntryKind.PARITY, "c.bin.par2"),
+                       ScanEntry(EntryKind.DATA_WITH_PARITY, "c.bin", ("c.bin.par2",), "c.bin"),
+                       ScanEntry(EntryKind.DATA_WITHOUT_PARITY, "a.bin"),
+                       ScanEntry(EntryKind.DATA_WITH_PARITY, "g1.bin", ("group.par2",), "group.par2"),
+                       ScanEntry(EntryKind.DATA_WITH_PARITY, "g2.bin", ("group.par2",), "group.par2"),
+                       ScanEntry(EntryKind.DATA_WITHOUT_PARITY, "b.bin")]
+            ordered = disk_order(entries)
+            assert ordered[-1] == entries[0]
+            paths = [entry.path for entry in ordered[:-1]]
+            assert abs(paths.index("g1.bin") - paths.index("g2.bin")) == 1
+            singles = [path for path in paths if not path.startswith("g")]
+            assert singles == sorted(singles, key=diskio.layout_key)
+
+    @unittest.skipUnless(par2encode.available(), "needs NumPy")
+    def test_run_disk_order_drop_cache(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            Path("d/s").mkdir(parents=True)
+            for name in ("d/a.bin", "d/b.bin", "d/s/c.bin"):
+                Path(name).write_bytes(os.urandom(3000))
+
+            result = runner.invoke(par2tortilla.main, ["run", "--create", "--native-create", "--disk-order",
+                                                       "--drop-cache", "d"])
+            assert result.exit_code == 0, result.output
+            assert result.output.count("creating par2 parity") == 3
+            result = runner.invoke(par2tortilla.main, ["run", "--verify", "--disk-order", "--drop-cache", "d"])
+            assert result.exit_code == 0, result.output
+            assert "Files that are OK: 3" in result.output
+
+
+class TestsStateDB(unittest.TestCase):
+
+    def setUp(self):
+        self.context = Context()
+
+    def test_due_policy(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            self.context.create_test_data()
+            file_name = self.context.test_files[0]
+            parity = [file_name + ".par2"]
+
+            with StateDB("state.db") as state:
+                stat = os.stat(file_name)
+                assert state.is_due(file_name, stat, parity, reverify_after_days=30)
+
+                state.record_verify(file_name, stat, parity, FileStatus.OK, verified_at=1000)
+                assert not state.is_due(file_name, stat, parity, reverify_after_days=30, now=1000 + 86400)
+                assert state.is_due(file_name, stat, parity, reverify_after_days=30, now=1000 + 30 * 86400)
+                assert state.is_due(file_name, stat, parity + [file_name + ".vol0+50.par2"], 30, now=1000)
+
+                corrupt_file(file_name, 5)
+                os.utime(file_name, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+                assert state.is_due(file_name, os.stat(file_name), parity, reverify_after_days=30, now=1000)
+
+                state.record_verify(file_name, stat, parity, FileStatus.REPAIRABLE, verified_at=1000)
+                assert state.is_due(file_name, stat, parity, reverify_after_days=30, now=1000)
+
+    def test_batched_commits(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            Path("a.bin").touch()
+            Path("b.bin").touch()
+
+            def committed() -> int:
+                connection = sqlite3.connect("state.db")
+                try:
+                    return connection.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+                finally:
+                    connection.close()
+
+            with StateDB("state.db", commit_every=2) as state:
+                state.record_verify("a.bin", os.stat("a.bin"), [], FileStatus.OK)
+                assert committed() == 0
+                state.record_verify("b.bin", os.stat("b.bin"), [], FileStatus.OK)
+                assert committed() == 2
+                state.record_verify("a.bin", os.stat("a.bin"), [], FileStatus.FUBAR)
+            with StateDB("state.db") as state:
+                assert list(state.files_with_status(".", FileStatus.FUBAR)) == [os.path.abspath("a.bin")]
+
+    def test_cached_summary(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            self.context.create_test_data()
+
+            result = runner.invoke(par2tortilla.main, ["run", "--cached", "./"])
+            assert result.exit_code == 1
+            assert "Cannot use --cached without --state-db!" in result.output
+
+            result = runner.invoke(par2tortilla.main, ["run", "--state-db", "state.db", "--cached", "./"])
+            assert result.exit_code == 1
+
+            result = runner.invoke(par2tortilla.main, ["run", "--state-db", "state.db", "./"])
+            assert result.exit_code == 0
+            assert f"Data files without parity: {len(self.context.test_files)}" in result.output
+
+            Path(self.context.test_files[0]).unlink()
+
+            result = runner.invoke(par2tortilla.main, ["run", "--state-db", "state.db", "--cached", "./"])
+            assert result.exit_code == 0
+            assert f"Data files without parity: {len(self.context.test_files)}" in result.output
+            assert f"Data file backups (?) created by par2repair: 0" in result.output
+
+    def test_list(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            self.context.create_test_data()
+            for file_name in self.context.test_files[1:]:
+                write_par2_index(file_name)
+            Path("a1/gone.bin.par2").touch()
+            Path("a1/f1.bin.1").touch()
+
+            result = runner.invoke(par2tortilla.main, ["list", "--status", "NO_PARITY", "./"])
+            assert result.output.splitlines() == ["f0.bin"]
+            result = runner.invoke(par2tortilla.main, ["list", "--status", "ORPHAN", "./"])
+            assert result.output.splitlines() == ["a1/gone.bin.par2"]
+            result = runner.invoke(par2tortilla.main, ["list", "--status", "BACKUP", "./"])
+            assert result.output.splitlines() == ["a1/f1.bin.1"]
+
+            result = runner.invoke(par2tortilla.main, ["list", "--status", "FUBAR", "./"])
+            assert result.exit_code == 1
+            assert "Cannot list FUBAR files without --state-db!" in result.output
+
+            with StateDB("../state.db") as state:
+                for file_name, status in (("a1/f2.bin", FileStatus.FUBAR), ("a1/a2/f3.bin", FileStatus.REPAIRABLE),
+                                          ("b1/b2/f5.bin", FileStatus.FUBAR), ("f0.bin", FileStatus.OK)):
+                    state.record_verify(file_name, os.stat(file_name), [], status)
+                state.record_verify("../elsewhere.bin", os.stat("f0.bin"), [], FileStatus.FUBAR)
+
+            result = runner.invoke(par2tortilla.main, ["list", "--status", "FUBAR", "--state-db", "../state.db", "./"])
+            expected = sorted(os.path.abspath(f) for f in ["a1/f2.bin", "b1/b2/f5.bin"])
+            assert sorted(result.output.splitlines()) == expected
+            result = runner.invoke(par2tortilla.main, ["list", "--status", "REPAIRABLE", "--state-db", "../state.db",
+                                                       "a1"])
+            assert result.output.splitlines() == [os.path.abspath("a1/a2/f3.bin")]
+
+            os.remove("b1/b2/f5.bin")
+            for name in os.listdir("a1/a2"):
+                os.remove(os.path.join("a1/a2", name))
+            os.rmdir("a1/a2")
+            result = runner.invoke(par2tortilla.main, ["run", "--state-db", "../state.db", "./"])
+            assert result.exit_code == 0, result.output
+            result = runner.invoke(par2tortilla.main, ["list", "--status", "FUBAR", "--state-db", "../state.db", "./"])
+            assert result.output.splitlines() == [os.path.abspath("a1/f2.bin")]  # deleted files are forgotten
+            result = runner.invoke(par2tortilla.main, ["list", "--status", "REPAIRABLE", "--state-db", "../state.db",
+                                                       "./"])
+            assert result.output == ""
+            with StateDB("../state.db") as state:
+                assert os.path.abspath("../elsewhere.bin") in state.files_with_status("..", FileStatus.FUBAR)
+            os.remove("../state.db")
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,93 @@
+import asyncio
+import time
+from typing import List, Optional
+
+IONICE_CLASSES = {"realtime": 1, "best-effort": 2, "idle": 3}
+
+MIN_RATE_FACTOR = 1 / 16
+BACKOFF_THRESHOLD = 2.0  # recent latency over the baseline that triggers a back-off
+RECOVERY_THRESHOLD = 1.2
+FAST_ALPHA = 0.3
+SLOW_ALPHA = 0.05
+
+
+class TokenBucket:
+    """Rate limit shared by all jobs. Taking more than is available puts the bucket in debt and waits it off."""
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = rate if burst is None else burst
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    async def acquire(self, amount: float, rate_factor: float = 1.0):
+        now = time.monotonic()
+        rate = self.rate * rate_factor
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        self.tokens -= amount
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / rate)
+
+
+class Governor:
+    """Throttles job starts by bytes/s and files/s and backs off when jobs get slow.
+
+    Latency is measured per MiB of data a job works on. When the recent average rises over BACKOFF_THRESHOLD times
+    the long term one, the rates and the number of jobs let through at once are halved, down to MIN_RATE_FACTOR.
+    They recover slowly once latency is back to normal.
+    """
+
+    def __init__(self, bytes_per_second: Optional[float] = None, files_per_second: Optional[float] = None,
+                 concurrency: int = 1, backoff: bool = False):
+        self.bytes_bucket = TokenBucket(bytes_per_second) if bytes_per_second else None
+        self.files_bucket = TokenBucket(files_per_second) if files_per_second else None
+        self.concurrency = concurrency
+        self.backoff = backoff
+        self.rate_factor = 1.0
+        self.active = 0
+        self.recent_latency = None
+        self.baseline_latency = None
+
+    def allowed(self) -> int:
+        return max(1, int(self.concurrency * self.rate_factor))
+
+    async def admit(self, size: int):
+        while self.active >= self.allowed():
+            await asyncio.sleep(0.05)
+        self.active += 1
+        try:
+            if self.files_bucket is not None:
+                await self.files_bucket.acquire(1, self.rate_factor)
+            if self.bytes_bucket is not None:
+                await self.bytes_bucket.acquire(size, self.rate_factor)
+        except BaseException:  # cancelled while waiting for tokens, the job never ran
+            self.active -= 1
+            raise
+
+    def done(self, seconds: float, size: int):
+        self.active -= 1
+        if not self.backoff:
+            return
+
+        latency = seconds / max(size / 2 ** 20, 1)
+        if self.baseline_latency is None:
+            self.recent_latency = self.baseline_latency = latency
+            return
+        self.recent_latency += FAST_ALPHA * (latency - self.recent_latency)
+        self.baseline_latency += SLOW_ALPHA * (latency - self.baseline_latency)
+
+        if self.recent_latency > self.baseline_latency * BACKOFF_THRESHOLD:
+            self.rate_factor = max(MIN_RATE_FACTOR, self.rate_factor / 2)
+        elif self.recent_latency < self.baseline_latency * RECOVERY_THRESHOLD:
+            self.rate_factor = min(1.0, self.rate_factor * 1.1)
+
+
+def priority_prefix(nice: Optional[int], ionice: Optional[str]) -> List[str]:
+    """Command prefix running par2 with a lower CPU and I/O priority."""
+    prefix = []
+    if nice is not None:
+        prefix += ["nice", "-n", str(nice)]
+    if ionice is not None:
+        prefix += ["ionice", "-c", str(IONICE_CLASSES[ionice])]
+    return prefix
@@ -1,10 +1,13 @@
 import glob
 import os
+import random
 import subprocess
 from pathlib import Path
-from typing import Tuple
+from typing import Callable, List, Optional
 
-from constants import FileStatus
+from constants import FileStatus, Resources
+from faults import corrupt_head
+from scanner import group_name
 
 
 def rmdir(directory):
@@ -17,67 +20,101 @@ def rmdir(directory):
     directory.rmdir()
 
 
-def corrupt_file(file_name: str, corruption_percent: float):
-    print(f"reading '{file_name}'...")
-    with open(file_name, "rb+") as f:
-        data = bytearray(f.read())
-        write_stop = int(len(data) * (corruption_percent / 100))
+def corrupt_file(file_name: str, corruption_percent: float, seed: Optional[int] = None):
+    """Overwrite the first corruption_percent of the file with random data, reproducibly when seeded."""
+    corrupt_head(file_name, corruption_percent, random.Random(seed))
 
-        print(f"corrupting first {write_stop} bytes...")
-        write_data = os.urandom(write_stop)
-        for i in range(write_stop):
-            data[i] = write_data[i]
 
-        print(f"writing '{file_name}'...")
-        f.seek(0)
-        f.write(data)
-        f.truncate()
+def par2create_args(file: str, parity_file_count: int, redundancy: int, block_count: Optional[int],
+                    resources: Optional[Resources] = None, base_path: Optional[str] = None,
+                    block_size: Optional[int] = None) -> List[str]:
+    """A block size, when given, replaces the block count."""
+    blocks = f"-s{block_size}" if block_size is not None else f"-b{block_count}"
+    return ["par2", "c", "-q", "-u", f"-n{parity_file_count}", f"-r{redundancy}", blocks,
+            *resource_args(resources), *base_path_args(base_path), file]
 
 
-def par2create(file: str, parity_file_count: int, redundancy: int, block_count: int):
-    print(f"creating par2 parity for '{file}'...")
-    process = subprocess.Popen(
-        ["par2", "c", "-q", "-u", f"-n{parity_file_count}", f"-r{redundancy}", f"-b{block_count}", file],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE)
-    stdout, stderr = process.communicate()
-    assert stderr == b"", f"ERROR '{file}' - {stderr}"  # TODO handle
+def group_index(files: List[str]) -> str:
+    """Index file of the recovery set protecting all the files, which have to share a directory."""
+    return os.path.join(os.path.dirname(files[0]), group_name(os.path.basename(f) for f in files) + ".par2")
 
 
-def par2verify(file: str) -> Tuple[str, FileStatus]:
-    print(f"verifying file '{file}'...")
-    process = subprocess.Popen(["par2", "v", "-q", file],
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE)
-    stdout, stderr = process.communicate()
-    assert stderr == b"", f"ERROR '{file}' - {stderr}"  # TODO handle
+def par2create_group_args(index: str, files: List[str], parity_file_count: int, redundancy: int,
+                          block_count: Optional[int], resources: Optional[Resources] = None,
+                          base_path: Optional[str] = None, block_size: Optional[int] = None) -> List[str]:
+    return par2create_args(index, parity_file_count, redundancy, block_count, resources, base_path, block_size) \
+        + list(files)
+
+
+def par2verify_args(file: str, resources: Optional[Resources] = None, base_path: Optional[str] = None) -> List[str]:
+    return ["par2", "v", "-q", *resource_args(resources), *base_path_args(base_path), file]
+
+
+def par2repair_args(file: str, resources: Optional[Resources] = None, base_path: Optional[str] = None) -> List[str]:
+    return ["par2", "r", "-q", *resource_args(resources), *base_path_args(base_path), file]
+
+
+def base_path_args(base_path: Optional[str]) -> List[str]:
+    """-B points par2 at the data of a recovery set kept in a parity store."""
+    if base_path is None:
+        return []
+    return [f"-B{base_path}"]
+
+
+def resource_args(resources: Optional[Resources]) -> List[str]:
+    if resources is None:
+        return []
+    return [f"-t{resources.threads}", f"-m{resources.memory}"]
+
+
+def par2_failed(file: str, stdout: bytes, stderr: bytes, report: Callable[[str], None] = print) -> FileStatus:
+    """Report what par2 said when its output does not tell a status."""
+    if stderr:
+        report(f"ERROR '{file}' - {stderr}")
+    else:
+        report(f"ERROR '{file}' - Unexpected par2 output: {stdout}")
+    return FileStatus.FAILED
+
+
+def par2create_status(file: str, stdout: bytes, stderr: bytes, report: Callable[[str], None] = print) -> FileStatus:
+    if stderr:
+        return par2_failed(file, stdout, stderr, report)
+    return FileStatus.CREATED
+
+
+def par2verify_status(file: str, stdout: bytes, stderr: bytes, report: Callable[[str], None] = print) -> FileStatus:
+    if stderr:
+        return par2_failed(file, stdout, stderr, report)
 
     if b"All files are correct, repair is not required" in stdout:
-        return file, FileStatus.OK
+        return FileStatus.OK
 
     if b"Repair is required" in stdout:
         if b"Repair is possible" in stdout:
-            return file, FileStatus.REPAIRABLE
+            return FileStatus.REPAIRABLE
         if b"Repair is not possible" in stdout:
-            return file, FileStatus.FUBAR
+            return FileStatus.FUBAR
 
-    print(stdout)
-    raise Exception(f"ERROR '{file}' - Unexpected par2 output ^^^.")
+    return par2_failed(file, stdout, stderr, report)
 
 
-def par2repair(file: str) -> FileStatus:
-    print(f"repairing file '{file}'...")
-    process = subprocess.Popen(["par2", "r", "-q", file],
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE)
-    stdout, stderr = process.communicate()
-    assert stderr == b"", f"ERROR '{file}' - {stderr}"  # TODO handle
+def par2repair_status(file: str, stdout: bytes, stderr: bytes, report: Callable[[str], None] = print) -> FileStatus:
+    if stderr:
+        return par2_failed(file, stdout, stderr, report)
 
     if b"Repair complete" in stdout:
         return FileStatus.REPAIRED
 
-    print(stdout)
-    raise Exception(f"ERROR '{file}' - Unexpected par2 output ^^^.")
+    return par2_failed(file, stdout, stderr, report)
+
+
+def par2create(file: str, parity_file_count: int, redundancy: int, block_count: int) -> FileStatus:
+    print(f"creating par2 parity for '{file}'...")
+    process = subprocess.Popen(par2create_args(file, parity_file_count, redundancy, block_count),
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    stdout, stderr = process.communicate()
+    return par2create_status(file, stdout, stderr)
 
 
 def glob_files(directory: str) -> set:
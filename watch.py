@@ -0,0 +1,186 @@
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import struct
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from constants import FileStatus
+from scanner import parity_data_name
+from store import ParityStore
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT = struct.Struct("iIII")
+READ_SIZE = 64 * 1024
+
+CREATE = "create"
+DELETE = "delete"
+
+
+class Inotify:
+    """Minimal ctypes binding of Linux inotify, watching whole directory trees."""
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library("c")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True) if libc_name else None
+        if self.libc is None or not hasattr(self.libc, "inotify_init1"):
+            raise OSError("inotify is not available, watch needs Linux.")
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self.directories: Dict[int, str] = {}
+
+    def add_watch(self, directory: str):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), directory)
+        self.directories[wd] = directory
+
+    def add_tree(self, directory: str) -> List[str]:
+        """Watch the directory and every directory below it. Returns the files found in them, which may have landed
+        before their directory was watched."""
+        files = []
+        for current, _, names in os.walk(directory):
+            self.add_watch(current)
+            files += [os.path.join(current, name) for name in names]
+        return files
+
+    def read(self) -> List[Tuple[str, int, str]]:
+        """(directory, mask, name) of the events queued so far."""
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b"\0"))
+            offset += EVENT.size + length
+            if mask & IN_IGNORED:
+                self.directories.pop(wd, None)
+            elif mask & IN_Q_OVERFLOW or wd in self.directories:
+                events.append((self.directories.get(wd, ""), mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def parity_files(file: str, store: Optional[ParityStore] = None) -> List[str]:
+    """PAR2 files of a single data file, 'f.bin.par2' and its volumes, found by listing their directory."""
+    directory = os.path.dirname(file) or os.curdir
+    if store is not None:
+        directory = store.locate(directory)
+    name = os.path.basename(file)
+    try:
+        with os.scandir(directory) as iterator:
+            return [os.path.join(directory, entry.name) for entry in iterator
+                    if entry.name.endswith(".par2") and parity_data_name(entry.name) == name]
+    except FileNotFoundError:
+        return []
+
+
+def remove_parity(file: str, store: Optional[ParityStore] = None) -> int:
+    removed = 0
+    for parity_file in parity_files(file, store):
+        try:
+            os.remove(parity_file)
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+async def watch(directory: str, create: Callable[[str], Awaitable[FileStatus]], processes: int, debounce: float,
+                store: Optional[ParityStore] = None, stop: Optional[asyncio.Event] = None,
+                report: Callable[[str], None] = print):
+    """Create parity for files as they land in the directory, until stop is set.
+
+    Files are picked up when they are closed after writing or moved in, and handed to `create` once no event for them
+    came in for `debounce` seconds, with at most `processes` creates running at once. A file written again gets its
+    parity recreated, a deleted or moved away file has its parity removed. Files of grouped recovery sets are not
+    tracked, they keep their set until the next run --create.
+    """
+    stop = stop or asyncio.Event()
+    inotify = Inotify()
+    pending: Dict[str, Tuple[str, float]] = {}
+    running: Dict[str, asyncio.Task] = {}
+    limit = asyncio.Semaphore(processes)
+
+    def queue(path: str, action: str):
+        if not os.path.basename(path).endswith(".par2"):
+            pending[path] = action, time.monotonic()
+
+    def on_events():
+        for parent, mask, name in inotify.read():
+            if mask & IN_Q_OVERFLOW:
+                report("inotify queue overflowed, events were lost. Run --create to catch up.")
+                continue
+            path = os.path.join(parent, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and (store is None or not store.owns(path)):
+                    for file in inotify.add_tree(path):
+                        queue(file, CREATE)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                queue(path, CREATE)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                queue(path, DELETE)
+
+    async def create_parity(path: str):
+        async with limit:
+            if not os.path.isfile(path):
+                return
+            remove_parity(path, store)
+            try:
+                status = await create(path)
+            except Exception as e:  # a daemon keeps going, the file is picked up again when it is written next
+                report(f"ERROR '{path}' - {e}")
+                return
+            report(f"{status.name} parity for '{path}'.")
+
+    loop = asyncio.get_running_loop()
+    for root, directories, _ in os.walk(directory):
+        inotify.add_watch(root)
+        if store is not None:
+            directories[:] = [d for d in directories if not store.owns(os.path.join(root, d))]
+    loop.add_reader(inotify.fd, on_events)
+    report(f"Watching '{directory}'...")
+    try:
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), max(debounce / 4, 0.05))
+            except asyncio.TimeoutError:
+                pass
+
+            now = time.monotonic()
+            # a file still being worked on waits, so two creates of the same file never race
+            due = [path for path, (_, last_event) in pending.items()
+                   if now - last_event >= debounce and path not in running]
+            for path in due:
+                action, _ = pending.pop(path)
+                if action == DELETE:
+                    removed = remove_parity(path, store)
+                    if removed:
+                        report(f"Removed {removed} PAR2 files of '{path}'.")
+                    continue
+                running[path] = asyncio.create_task(create_parity(path))
+                running[path].add_done_callback(lambda _, path=path: running.pop(path))
+    finally:
+        loop.remove_reader(inotify.fd)
+        inotify.close()
+        if running:
+            await asyncio.gather(*running.values(), return_exceptions=True)